@@ -0,0 +1,6 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Helpers shared by the benchmark scripts of the different backends.
+#
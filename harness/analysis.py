@@ -0,0 +1,284 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# The analysis of base-url-change-propagation.ipynb as a module.
+#
+# `load` reads the benchmark CSVs of all backends into one tidy frame,
+# `summarize` computes per-group statistics with a bootstrap confidence
+# interval of the mean, and `plot` draws the figures of the paper without a
+# display. Parsed CSVs are cached by the hash of their contents, so after a
+# new run only the files that changed are parsed again. Rows written after the
+# columns of a CSV changed are in a versioned sibling such as
+# `benchmark-v2.csv` (see harness.results); these are read too.
+#
+# Usage: python3 -m harness.analysis [--summary summary.csv]
+#
+# This needs pandas, numpy and matplotlib (`pip3 install pandas matplotlib`).
+#
+import argparse
+import hashlib
+import os
+import sys
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas
+
+from harness.common import iprint
+from harness.results import OVERHEAD_FIELDS, versions
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# Benchmark CSVs, relative to the repository root.
+SOURCES = OrderedDict([
+    ("juju", "juju/benchmark.csv"),
+    ("k8s", "k8s/benchmark.csv"),
+    ("k8s-volume", "k8s-volume/benchmark.csv"),
+    ("orcon", "orcon/benchmark.csv"),
+    ("orcon-no-initc", "orcon/benchmark-deployments-no-initc.csv"),
+    ("helm", "helm/benchmark.csv"),
+    ("k8s-deployment", "k8s/benchmark-deployment.csv"),
+    ("k8s-statefulset", "k8s/benchmark-statefulset.csv"),
+    ("helm-deployment", "helm/benchmark-deployment.csv"),
+    ("helm-statefulset", "helm/benchmark-statefulset.csv"),
+])
+COLUMNS = ["source", "namespace", "num_consumers", "action", "event",
+           "start", "end", "elapsed", "censored"] + list(OVERHEAD_FIELDS)
+GROUP_BY = ["source", "action", "event", "num_consumers"]
+
+RESAMPLES = 2000
+CONFIDENCE = 0.95
+
+# A series of a figure: the `event` rows of `source` for the change action.
+# Points are drawn `dx` to the right so overlapping series stay visible. The
+# label sits at `label_x` (relative to the largest consumer count) and
+# `label_dy` above the mean there; the maximum is printed at `value_x`.
+Series = namedtuple('Series', [
+    'label', 'source', 'event', 'marker', 'dx', 'label_x', 'label_dy', 'value_x', 'max_consumers'])
+Figure = namedtuple('Figure', ['path', 'title', 'ymax', 'left', 'series'])
+
+FIGURES = OrderedDict([
+    ("propagation", Figure("base_url_propagation.pdf", "Change propagation", 300, -0.8, [
+        Series("pure k8s", "k8s", "pods", "o", 0, 2, 10.8, -0.5, 60),
+        Series("orcon", "orcon", "pods", "o", 0, 2, 0, -0.5, None),
+        Series("helm", "helm", "pods", "x", -0.5, 1.5, 0, -1, None),
+        Series("Juju", "juju", "pods", "o", 0, 2, 0, -0.5, None),
+        Series("Juju agents", "juju", "juju", "x", 0, 2, 0, -0.5, None),
+    ])),
+    ("initc", Figure("initc_impact.pdf", "Change propagation", 60, -0.6, [
+        Series("pure k8s", "k8s", "pods", "o", 0, 1, 3.0, -1, 60),
+        Series("orcon", "orcon", "pods", "o", 1, 2, 0, 0, None),
+        Series("helm", "helm", "pods", "o", -0.5, 0.5, 0, -1.5, None),
+        Series("orcon without initc", "orcon-no-initc", "pods", "o", 0.5, 1.5, 0, -0.5, None),
+    ])),
+    # The StatefulSet updates its pods one at a time, the Deployments don't
+    # (see harness.manifest.TOPOLOGIES).
+    ("topology", Figure("topology_impact.pdf", "Change propagation per topology", 60, -0.6, [
+        Series("Deployment per consumer", "k8s", "pods", "o", 0, 1, 0, -1, None),
+        Series("one Deployment", "k8s-deployment", "pods", "o", 0.5, 1, 0, -1, None),
+        Series("one StatefulSet", "k8s-statefulset", "pods", "x", -0.5, 1, 0, -1, None),
+    ])),
+])
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_source(source, path):
+    """One benchmark CSV as a frame with the COLUMNS. Juju's `model_name`
+    becomes `namespace`; columns that older CSVs lack are filled in."""
+    frame = pandas.read_csv(path, sep=";", comment="#")
+    frame = frame.rename(columns={"model_name": "namespace"})
+    frame.insert(0, "source", source)
+    if "censored" not in frame:
+        frame["censored"] = 0
+    frame["censored"] = frame["censored"].fillna(0).astype(int)
+    for field in OVERHEAD_FIELDS:
+        if field not in frame:
+            frame[field] = np.nan
+    return frame[COLUMNS]
+
+
+def load_source(source, path, cache_dir=None):
+    """`read_source`, cached in `cache_dir` under the hash of the file."""
+    if cache_dir is None:
+        return read_source(source, path)
+    prefix = "{}-{}-".format(source, os.path.basename(path))
+    cached = os.path.join(cache_dir, "{}{}.pkl".format(prefix, file_hash(path)))
+    if os.path.exists(cached):
+        return pandas.read_pickle(cached)
+    iprint("Parsing {}".format(path))
+    frame = read_source(source, path)
+    os.makedirs(cache_dir, exist_ok=True)
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and name.endswith(".pkl"):
+            os.remove(os.path.join(cache_dir, name))
+    tmp = "{}.{}.tmp".format(cached, os.getpid())
+    frame.to_pickle(tmp)
+    os.replace(tmp, cached)
+    return frame
+
+
+def load(root=ROOT, sources=SOURCES, cache_dir=None):
+    """All `sources` that exist under `root`, and their versioned siblings
+    with newer columns, as one tidy frame."""
+    frames = []
+    for source, relative in sources.items():
+        for path in versions(os.path.join(root, relative)):
+            frames.append(load_source(source, path, cache_dir))
+    if not frames:
+        return pandas.DataFrame(columns=COLUMNS)
+    return pandas.concat(frames, ignore_index=True)
+
+
+def bootstrap_ci(values, resamples=RESAMPLES, confidence=CONFIDENCE, rng=None):
+    """Percentile bootstrap confidence interval of the mean of `values`,
+    with all resamples drawn at once."""
+    values = np.asarray(values, dtype=float)
+    if len(values) < 2 or resamples < 1:
+        return (np.nan, np.nan)
+    rng = rng if rng is not None else np.random.default_rng(0)
+    means = values[rng.integers(0, len(values), (resamples, len(values)))].mean(axis=1)
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(means, [tail, 100 - tail])
+    return (low, high)
+
+
+def summarize(frame, by=GROUP_BY, resamples=RESAMPLES, confidence=CONFIDENCE, seed=0):
+    """Statistics of `elapsed` per group. Censored samples (waits that timed
+    out) are lower bounds; they are included, and counted in `censored`."""
+    grouped = frame.groupby(list(by), sort=True)
+    summary = grouped.agg(
+        samples=("elapsed", "size"),
+        censored=("censored", "sum"),
+        mean=("elapsed", "mean"),
+        median=("elapsed", "median"),
+        std=("elapsed", "std"),
+        min=("elapsed", "min"),
+        max=("elapsed", "max"),
+    )
+    rng = np.random.default_rng(seed)
+    intervals = [bootstrap_ci(values, resamples, confidence, rng) for _, values in grouped["elapsed"]]
+    summary["ci_low"] = [low for low, _ in intervals]
+    summary["ci_high"] = [high for _, high in intervals]
+    return summary.reset_index()
+
+
+def series_data(frame, series):
+    selected = frame[(frame["source"] == series.source)
+                     & (frame["action"] == "change")
+                     & (frame["event"] == series.event)]
+    if series.max_consumers is not None:
+        selected = selected[selected["num_consumers"] < series.max_consumers]
+    return selected
+
+
+def create_sane_figure():
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(10, 6))
+    ax = fig.add_subplot(1, 1, 1)
+    ax.set_axisbelow(True)
+    for spine in ax.spines.values():
+        spine.set_color('black')
+    for line in ax.get_xticklines() + ax.get_yticklines():
+        line.set_color('black')
+    ax.xaxis.label.set_fontsize(16)
+    ax.yaxis.label.set_fontsize(16)
+    ax.grid(False)
+    ax.spines["top"].set_visible(False)
+    ax.spines["right"].set_visible(False)
+    ax.tick_params(axis='both', which='both', labelsize=14, labelcolor='black', color='black')
+    return fig, ax
+
+
+def plot(frame, figure, summary=None, output_dir="."):
+    """Draw `figure` from `frame` and save it in `output_dir`. Returns the
+    path of the file."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.transforms import Bbox
+
+    if summary is None:
+        summary = summarize(frame, resamples=0)
+    summary = summary[summary["action"] == "change"].set_index(["source", "event", "num_consumers"])
+
+    fig, ax = create_sane_figure()
+    fig.set_size_inches(9, 5.6)
+    ax.set_title(figure.title, fontsize=22)
+    ax.set_xlabel("consumers")
+    ax.set_ylabel("seconds", rotation='horizontal', labelpad=45)
+    ax.set_yticks([0, figure.ymax])
+
+    plotted = []
+    for series in figure.series:
+        data = series_data(frame, series)
+        if data.empty:
+            iprint("No data for {} in {}".format(series.label, figure.path))
+            continue
+        line, = ax.plot(data["num_consumers"] + series.dx, data["elapsed"], series.marker, clip_on=False)
+        plotted.append((series, data, line.get_color()))
+    if not plotted:
+        plt.close(fig)
+        return None
+
+    xmin = int(min(data["num_consumers"].min() for _, data, _ in plotted))
+    xmax = int(max(data["num_consumers"].max() for _, data, _ in plotted))
+    for series, _, color in plotted:
+        key = (series.source, series.event, xmax)
+        if key not in summary.index:
+            continue
+        stats = summary.loc[key]
+        y = stats["mean"] - 1.20 + series.label_dy
+        ax.text(xmax + series.label_x, y, series.label, fontsize=14, color=color)
+        ax.annotate('{}s'.format(round(stats["max"])), (xmax + series.value_x, y),
+                    ha='right', va='center', fontsize=14)
+
+    ax.set_xticks([xmin, xmax])
+    ax.set_xlim(left=xmin, right=xmax)
+    ax.set_ylim(bottom=0, top=figure.ymax)
+    ax.spines['left'].set_position(('outward', 20))
+
+    path = os.path.join(output_dir, figure.path)
+    fig.savefig(path, bbox_inches=Bbox.from_bounds(figure.left, 0.1, 10.8, 5.2), dpi=300)
+    plt.close(fig)
+    return path
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Summarize the benchmark results and draw the figures.")
+    parser.add_argument("--root", default=ROOT, help="Repository with the benchmark CSVs.")
+    parser.add_argument("--cache", default=os.path.join(ROOT, ".analysis-cache"),
+                        help="Directory for parsed CSVs; empty to disable.")
+    parser.add_argument("--output-dir", default=".", help="Where to save the figures.")
+    parser.add_argument("--figures", nargs="*", choices=list(FIGURES), default=list(FIGURES),
+                        help="Figures to draw (all by default).")
+    parser.add_argument("--summary", help="Also write the statistics to this CSV file.")
+    parser.add_argument("--resamples", type=int, default=RESAMPLES,
+                        help="Bootstrap resamples for the confidence intervals.")
+    args = parser.parse_args(args)
+
+    frame = load(args.root, cache_dir=args.cache or None)
+    summary = summarize(frame, resamples=args.resamples)
+    if args.summary:
+        summary.to_csv(args.summary, sep=";", index=False)
+        iprint("Wrote {}".format(args.summary))
+    if args.figures:
+        os.makedirs(args.output_dir, exist_ok=True)
+    for name in args.figures:
+        path = plot(frame, FIGURES[name], summary, args.output_dir)
+        if path:
+            iprint("Wrote {}".format(path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Helm releases deployed by the harness instead of by `helm upgrade`.
+#
+# `helm upgrade` renders every template again, stores the whole manifest of
+# the new revision gzipped in a release secret, and sends every object to the
+# API server to diff. A Release does the same three steps itself, so they
+# can be timed apart: render with `helm template`, record the release in a
+# secret, and apply the manifest.
+#
+# A cached Release renders the chart once per set of the other values, with
+# a sentinel in place of the value that changes between revisions. Later
+# revisions substitute the value into that text, record only the values and
+# the digest of the cached render, and submit only the objects whose text
+# changed. Objects of the previous revision that are gone are deleted, like
+# helm does. Only the latest revision is recorded; there is no rollback.
+#
+import base64
+import gzip
+import hashlib
+import json
+import re
+import subprocess
+import time
+from collections import OrderedDict
+
+import yaml
+
+from harness import manifest
+
+
+# Plain scalar rendered in place of the changing value.
+SENTINEL = "sentinel-chart-value"
+DOCUMENT_SEPARATOR = re.compile(r"^---[ \t]*$", re.MULTILINE)
+
+
+def template(chart, release, namespace, values):
+    options = []
+    for key, value in values.items():
+        options.extend(["--set", "{}={}".format(key, value)])
+    return subprocess.check_output(
+        ["helm", "template", "-n", namespace] + options + [release, chart],
+        universal_newlines=True)
+
+
+def split(text):
+    """The documents of a rendered manifest, as `(kind, name)` to text."""
+    documents = OrderedDict()
+    for chunk in DOCUMENT_SEPARATOR.split(text):
+        document = yaml.load(chunk, Loader=manifest.Loader)
+        if document:
+            documents[(document["kind"], document["metadata"]["name"])] = chunk.strip("\n") + "\n"
+    return documents
+
+
+def join(texts):
+    return "---\n".join(texts)
+
+
+def step(start):
+    finish = time.time()
+    return {'started': start, 'finish': finish, 'elapsed': finish - start}
+
+
+class Release(object):
+    def __init__(self, chart, name, namespace, key, cached=False):
+        self.chart = chart
+        self.name = name
+        self.namespace = namespace
+        # The value that changes between revisions.
+        self.key = key
+        self.cached = cached
+        self.revision = 0
+        # Size in bytes of the latest release record.
+        self.record_size = 0
+        # `(kind, name)` to the text of every deployed object.
+        self.applied = OrderedDict()
+        self._renders = {}
+
+    @property
+    def record_name(self):
+        return "harness.release.v1.{}".format(self.name)
+
+    def render(self, values):
+        """The documents of `values` and the digest of the render they came
+        from."""
+        if not self.cached:
+            text = template(self.chart, self.name, self.namespace, values)
+            return split(text), None
+        fixed = dict(values, **{self.key: SENTINEL})
+        cache_key = tuple(sorted((key, str(value)) for key, value in fixed.items()))
+        if cache_key not in self._renders:
+            text = template(self.chart, self.name, self.namespace, fixed)
+            self._renders[cache_key] = (split(text), hashlib.sha256(text.encode()).hexdigest())
+        documents, digest = self._renders[cache_key]
+        value = manifest.scalar(values[self.key])
+        return OrderedDict((ref, text.replace(SENTINEL, value)) for ref, text in documents.items()), digest
+
+    def record(self, values, documents, digest):
+        if self.cached:
+            content = json.dumps({"values": values, "template": digest}, sort_keys=True).encode()
+        else:
+            # What helm stores: the whole manifest of the revision, gzipped.
+            content = gzip.compress(join(documents.values()).encode())
+        payload = base64.b64encode(content).decode()
+        secret = {
+            "apiVersion": "v1",
+            "kind": "Secret",
+            "metadata": {
+                "name": self.record_name,
+                "labels": {"owner": "harness", "name": self.name, "version": str(self.revision)},
+            },
+            "type": "harness/release.v1",
+            "data": {"release": payload},
+        }
+        manifest.apply(self.namespace, manifest.dump_all([secret]))
+        self.record_size = len(payload)
+
+    def upgrade(self, values):
+        """Deploy `values` as the next revision. Returns the timing of the
+        `render`, `release` and `apply` steps in the shape of a result."""
+        result = OrderedDict()
+        start = time.time()
+        documents, digest = self.render(values)
+        result['render'] = step(start)
+
+        start = time.time()
+        self.revision += 1
+        self.record(values, documents, digest)
+        result['release'] = step(start)
+
+        start = time.time()
+        if self.cached:
+            changed = [text for ref, text in documents.items() if self.applied.get(ref) != text]
+        else:
+            changed = list(documents.values())
+        removed = [text for ref, text in self.applied.items() if ref not in documents]
+        if changed:
+            manifest.apply(self.namespace, join(changed))
+        if removed:
+            manifest.delete(self.namespace, join(removed), ignore_not_found=True)
+        self.applied = documents
+        result['apply'] = step(start)
+        return result
+
+    def uninstall(self, values=None, ignore_not_found=False):
+        """Delete the deployed objects and the release record. A release
+        deployed by another process is found by rendering its `values`."""
+        documents = self.applied
+        if not documents and values is not None:
+            documents = self.render(values)[0]
+        record = {"apiVersion": "v1", "kind": "Secret", "metadata": {"name": self.record_name}}
+        texts = list(documents.values()) + [manifest.dump_all([record])]
+        manifest.delete(self.namespace, join(texts), ignore_not_found)
+        self.applied = OrderedDict()
+        self.revision = 0
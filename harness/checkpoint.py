@@ -0,0 +1,114 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Which (backend, num_consumers, iteration) cells of a run are done, so an
+# interrupted run can be resumed instead of started over.
+#
+# Iteration 0 is the deploy, 1 to 10 are the changes of the base URL. Every
+# benchmark appends to `checkpoint.jsonl` in its directory when it starts on
+# a consumer count, when the result store flushed the rows of an iteration
+# (see harness.store.ResultStore), and when it has cleaned up. Entries carry the run id of harness.store, so resuming
+# a run (`--resume [RUN_ID]`) adds to the same results.
+#
+# A consumer count that was started but not cleaned up left a namespace or
+# model behind; the benchmark cleans that up before it continues with the
+# iterations that are missing.
+#
+import json
+import os
+import time
+from collections import defaultdict
+
+from harness import results
+
+
+CHECKPOINT = "checkpoint.jsonl"
+ITERATIONS = range(0, 11)
+
+
+def read_entries(path):
+    if not os.path.exists(path):
+        return []
+    entries = []
+    with open(path) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A line cut short by a crash.
+                continue
+    return entries
+
+
+def latest_run(paths):
+    """The run id of the most recent entry in any of `paths`, or None."""
+    latest = None
+    for path in paths:
+        for entry in read_entries(path):
+            if latest is None or entry["time"] >= latest["time"]:
+                latest = entry
+    return latest["run_id"] if latest else None
+
+
+def resolve(resume, paths):
+    """The run id to resume: `resume` itself, or the latest run in `paths`
+    if it is "latest"."""
+    if resume != "latest":
+        return resume
+    run_id = latest_run(paths)
+    if run_id is None:
+        raise SystemExit("Nothing to resume in {}.".format(", ".join(paths)))
+    return run_id
+
+
+class Checkpoint(object):
+    def __init__(self, path, backend, run_id):
+        self.path = path
+        self.backend = backend
+        self.run_id = run_id
+        self.started = {}
+        self.finished = defaultdict(set)
+        self.cleaned = set()
+        for entry in read_entries(path):
+            if entry["backend"] != backend or entry["run_id"] != run_id:
+                continue
+            num_consumers = entry["num_consumers"]
+            if entry["event"] == "start":
+                self.started[num_consumers] = entry["namespace"]
+                self.cleaned.discard(num_consumers)
+            elif entry["event"] == "done":
+                self.finished[num_consumers].add(entry["iteration"])
+            elif entry["event"] == "clean":
+                self.cleaned.add(num_consumers)
+
+    def remaining(self, num_consumers, iterations=ITERATIONS):
+        return [i for i in iterations if i not in self.finished[num_consumers]]
+
+    def complete(self, num_consumers, iterations=ITERATIONS):
+        return not self.remaining(num_consumers, iterations) and num_consumers in self.cleaned
+
+    def unfinished(self, num_consumers):
+        """The namespace or model a previous attempt left behind, or None."""
+        if num_consumers in self.cleaned:
+            return None
+        return self.started.get(num_consumers)
+
+    def _append(self, event, num_consumers, **fields):
+        entry = dict(fields, event=event, backend=self.backend, run_id=self.run_id,
+                     num_consumers=num_consumers, time=time.time())
+        with results.locked_append(self.path) as f:
+            f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    def start(self, num_consumers, namespace):
+        self._append("start", num_consumers, namespace=namespace)
+        self.started[num_consumers] = namespace
+        self.cleaned.discard(num_consumers)
+
+    def done(self, num_consumers, iteration):
+        self._append("done", num_consumers, iteration=iteration)
+        self.finished[num_consumers].add(iteration)
+
+    def clean(self, num_consumers):
+        self._append("clean", num_consumers)
+        self.cleaned.add(num_consumers)
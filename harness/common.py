@@ -0,0 +1,14 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+import sys
+from datetime import datetime
+
+
+WAIT_TIME=1
+TIMEOUT=10*60
+
+
+def iprint(*args, **kwargs):
+    print("{}: ".format(datetime.now()), *args, file=sys.stderr, **kwargs)
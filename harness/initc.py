@@ -0,0 +1,123 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Where the propagation latency of an orcon consumer goes.
+#
+# Every new pod of a deploy or change is split in stages, from the
+# container statuses the API server reports:
+#
+# * rollout: from the start of the change until the pod is created.
+# * pending: until its first init container starts (scheduling, pulls).
+# * init: until the last init container finished.
+# * start: until the main container started.
+#
+# The stages of every iteration are appended to `benchmark-init.csv` as the
+# mean over its pods, with the init share: the time the pods spent in init
+# containers over their total latency. The API reports these times in whole
+# seconds, so the means only become meaningful over many pods.
+#
+# Usage: python3 -m harness.initc [orcon/benchmark-init.csv]
+#
+import argparse
+import csv
+import sys
+from collections import OrderedDict, defaultdict
+
+from harness.common import iprint
+from harness import query, results
+
+
+STAGES = ("rollout", "pending", "init", "start")
+HEADER = "namespace;num_consumers;action;iteration;pods;{};total;init_share".format(";".join(STAGES))
+
+
+def stages(start_time, pod):
+    """The STAGES of `pod` in seconds, or None if it has no init containers
+    or didn't start yet."""
+    if None in (pod.created, pod.init_started, pod.init_finished, pod.started):
+        return None
+    return OrderedDict([
+        ("rollout", pod.created - start_time),
+        ("pending", pod.init_started - pod.created),
+        ("init", pod.init_finished - pod.init_started),
+        ("start", pod.started - pod.init_finished),
+    ])
+
+
+def breakdown(start_time, pods):
+    """The mean of every stage over `pods`, their total, the init share and
+    the number of pods, or None if no pod could be split. `start_time` is
+    truncated like the server-side timestamps."""
+    start_time = query.server_time(start_time)
+    split = [s for s in (stages(start_time, pod) for pod in pods) if s is not None]
+    if not split:
+        return None
+    result = OrderedDict((stage, sum(s[stage] for s in split) / len(split)) for stage in STAGES)
+    result["total"] = sum(result[stage] for stage in STAGES)
+    result["init_share"] = result["init"] / result["total"] if result["total"] > 0 else None
+    result["pods"] = len(split)
+    return result
+
+
+def write_breakdown(path, namespace, num_consumers, action, iteration, result):
+    path = results.ensure_header(path, HEADER)
+    with results.locked_append(path) as f:
+        f.write("{};{};{};{};{};{};{};{}\n".format(
+            namespace,
+            num_consumers,
+            action,
+            iteration,
+            result["pods"],
+            ";".join(str(result[stage]) for stage in STAGES),
+            result["total"],
+            "" if result["init_share"] is None else result["init_share"],
+        ))
+
+
+def summarize(path, action="change"):
+    """Per consumer count, the mean of every stage over the `action` rows of
+    `path` and the init share of their total."""
+    sums = defaultdict(lambda: defaultdict(float))
+    with open(path) as f:
+        for row in csv.DictReader(f, delimiter=";"):
+            if row["action"] != action:
+                continue
+            pods = int(row["pods"])
+            totals = sums[int(row["num_consumers"])]
+            totals["pods"] += pods
+            for stage in STAGES:
+                totals[stage] += float(row[stage]) * pods
+    summary = OrderedDict()
+    for num_consumers in sorted(sums):
+        totals = sums[num_consumers]
+        means = OrderedDict((stage, totals[stage] / totals["pods"]) for stage in STAGES)
+        total = sum(means.values())
+        means["total"] = total
+        means["init_share"] = means["init"] / total if total > 0 else None
+        summary[num_consumers] = means
+    return summary
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Report the init container share of the propagation latency.")
+    parser.add_argument("path", nargs="?", default="orcon/benchmark-init.csv")
+    parser.add_argument("--action", default="change", choices=["deploy", "change"])
+    args = parser.parse_args(args)
+
+    summary = summarize(args.path, args.action)
+    if not summary:
+        iprint("No {} rows in {}.".format(args.action, args.path))
+        return 1
+    print("num_consumers;{};total;init_share".format(";".join(STAGES)))
+    for num_consumers, means in summary.items():
+        print("{};{};{:.3f};{}".format(
+            num_consumers,
+            ";".join("{:.3f}".format(means[stage]) for stage in STAGES),
+            means["total"],
+            "" if means["init_share"] is None else "{:.3f}".format(means["init_share"])))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Juju model state from the all-watcher delta stream.
+#
+# Instead of running `juju status --format json` for the whole model every
+# WAIT_TIME seconds, a model cache follows the all-watcher of the Juju API:
+# the first batch of deltas holds the whole model, later ones only what
+# changed. Unit workload and agent status are kept in memory in the shape of
+# `juju status`, so the checks written for it work unchanged, and a wait
+# returns the time of the delta that made its condition true.
+#
+# Deltas come from one of:
+#
+# * a file recorded earlier, if JUJU_DELTAS is set. `{}` in it is replaced by
+#   the model name. Batches are replayed with their original spacing, or
+#   JUJU_DELTAS_SPEED times faster. This works without a controller.
+# * the Juju API through python-libjuju (`pip3 install juju`), if installed.
+#
+# With JUJU_DELTAS_RECORD set, the batches received from the API are also
+# written to that file, again with `{}` replaced by the model name. Without
+# either source `model_cache` returns None and the scripts poll instead.
+#
+import asyncio
+import atexit
+import json
+import os
+import threading
+import time
+
+from harness.common import iprint
+from harness import overhead, wait
+
+
+class RecordedSource(object):
+    """Deltas replayed from a file with one batch per line:
+    `{"time": <received>, "deltas": [[entity, type, data], ...]}`."""
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self._stopped = threading.Event()
+
+    def batches(self):
+        with open(self.path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        start = time.time()
+        first = entries[0]["time"] if entries else 0
+        for entry in entries:
+            delay = start + (entry["time"] - first) / self.speed - time.time()
+            if delay > 0 and self._stopped.wait(delay):
+                return
+            yield entry["deltas"]
+        # A watch doesn't end, the model just stops changing.
+        self._stopped.wait()
+
+    def close(self):
+        self._stopped.set()
+
+
+class LibjujuSource(object):
+    """Deltas from the all-watcher of the model, through python-libjuju."""
+
+    def __init__(self, model):
+        from juju.model import Model  # pylint: disable=import-error
+        self.model = model
+        self._model_class = Model
+        self._closed = False
+
+    def batches(self):
+        from juju.client import client  # pylint: disable=import-error
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        model = self._model_class()
+        try:
+            loop.run_until_complete(model.connect(self.model))
+            connection = model.connection()
+            watcher = client.AllWatcherFacade.from_connection(connection)
+            watcher.Id = loop.run_until_complete(
+                client.ClientFacade.from_connection(connection).WatchAll()).watcher_id
+            while not self._closed:
+                with overhead.timed("call_time"):
+                    result = loop.run_until_complete(watcher.Next())
+                yield [[delta.entity, delta.type, delta.data] for delta in result.deltas]
+        finally:
+            loop.run_until_complete(model.disconnect())
+            loop.close()
+
+    def close(self):
+        # The next batch ends the stream; the watch thread is a daemon.
+        self._closed = True
+
+
+class Recorder(object):
+    """Passes the batches of `source` on and appends them to `path`."""
+
+    def __init__(self, source, path):
+        self.source = source
+        self.path = path
+
+    def batches(self):
+        with open(self.path, "a") as f:
+            for deltas in self.source.batches():
+                f.write(json.dumps({"time": time.time(), "deltas": deltas}) + "\n")
+                f.flush()
+                yield deltas
+
+    def close(self):
+        self.source.close()
+
+
+def make_source(model):
+    """The delta source for `model` picked by the environment, or None."""
+    replay = os.environ.get("JUJU_DELTAS")
+    if replay:
+        return RecordedSource(replay.format(model), float(os.environ.get("JUJU_DELTAS_SPEED", 1)))
+    try:
+        source = LibjujuSource(model)
+    except ImportError:
+        return None
+    record = os.environ.get("JUJU_DELTAS_RECORD")
+    if record:
+        source = Recorder(source, record.format(model))
+    return source
+
+
+class ModelCache(object):
+    def __init__(self, model, source):
+        self.model = model
+        self.source = source
+        # Application name to {"units": {unit name: unit status}}, like the
+        # `applications` of `juju status --format json`.
+        self.applications = {}
+        self.machines = set()
+        self._synced = False
+        self._last_event = time.time()
+        self._previous_event = self._last_event
+        # The pending `wait_for` calls, checked after every batch.
+        self._waiters = []
+        # What the watch thread spends on this model, see `wait_for`.
+        self.counters = overhead.Counters()
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="model-cache-{}".format(model), daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self.source.close()
+
+    def wait_for(self, predicate, timeout=None):
+        """Block until `predicate(cache)` holds and return the time the batch
+        of deltas that made it hold was received, or None on timeout. The
+        batches and parsing of this model while it waits count towards the
+        overhead of the caller."""
+        start = self.counters.snapshot()
+        try:
+            return self._wait_for(predicate, timeout)
+        finally:
+            overhead.merge(overhead.since(start, self.counters.snapshot()))
+
+    def _wait_for(self, predicate, timeout):
+        called = time.time()
+        deadline = None if timeout is None else called + timeout
+        with self._cond:
+            if self._synced and predicate(self):
+                overhead.observed(0)
+                return called
+            # Checked by the watch thread after every batch, as in
+            # harness.watch.PodCache.
+            waiter = {"predicate": predicate}
+            self._waiters.append(waiter)
+            try:
+                while "finish" not in waiter:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+            finally:
+                self._waiters.remove(waiter)
+        finish = waiter["finish"]
+        overhead.observed(finish - max(called, waiter["previous"]))
+        return finish
+
+    def _run(self):
+        overhead.bind(self.counters)
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                # Every (re)started watch begins with the whole model.
+                first = True
+                for deltas in self.source.batches():
+                    self._handle(deltas, time.time(), reset=first)
+                    first = False
+                    failures = 0
+                    if self._stopped.is_set():
+                        return
+            except Exception as e:  # pylint: disable=broad-except
+                if self._stopped.is_set():
+                    break
+                failures += 1
+                delay = wait.backoff(failures)
+                iprint('Delta watch of model {} failed, retrying in {:.1f}s: {}'.format(self.model, delay, e))
+                self._stopped.wait(delay)
+
+    def _handle(self, deltas, received, reset=False):
+        with self._cond:
+            if reset:
+                self.applications = {}
+                self.machines = set()
+            with overhead.timed("parse_time"):
+                for entity, kind, data in deltas:
+                    self._apply(entity, kind, data)
+            overhead.add("polls")
+            self._synced = True
+            self._previous_event = self._last_event
+            self._last_event = received
+            for waiter in self._waiters:
+                if "finish" not in waiter and waiter["predicate"](self):
+                    waiter["finish"] = received
+                    waiter["previous"] = self._previous_event
+            self._cond.notify_all()
+
+    def _apply(self, entity, kind, data):
+        removed = kind == "remove"
+        if entity == "application":
+            if removed:
+                self.applications.pop(data["name"], None)
+            else:
+                self.applications.setdefault(data["name"], {"units": {}})
+        elif entity == "unit":
+            units = self.applications.setdefault(data["application"], {"units": {}})["units"]
+            if removed:
+                units.pop(data["name"], None)
+            else:
+                units[data["name"]] = {
+                    "workload-status": unit_status(data.get("workload-status")),
+                    "juju-status": unit_status(data.get("agent-status")),
+                }
+        elif entity == "machine":
+            if removed:
+                self.machines.discard(data["id"])
+            else:
+                self.machines.add(data["id"])
+
+
+def unit_status(status):
+    """`status` with the keys `juju status` always reports, for units the
+    controller didn't report a status of yet."""
+    status = dict(status or {})
+    status.setdefault("current", "")
+    status.setdefault("message", "")
+    return status
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def model_cache(model):
+    """Return the running cache of `model`, starting it if needed, or None
+    if there is no delta source."""
+    with _caches_lock:
+        if model not in _caches:
+            source = make_source(model)
+            if source is None:
+                return None
+            _caches[model] = ModelCache(model, source).start()
+        return _caches[model]
+
+
+@atexit.register
+def _stop_caches():
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.stop()
@@ -0,0 +1,444 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Access to the Kubernetes API.
+#
+# `HttpTransport` talks to the API server directly over a pool of persistent
+# connections, so a poll costs one request instead of a `kubectl` process
+# that parses the kubeconfig and does a TLS handshake first. It is used when
+# the API server can be found: KUBE_API_SERVER (e.g. `kubectl proxy` or the
+# simulator's API server) or the current context of the kubeconfig.
+# Otherwise, or with KUBE_TRANSPORT=kubectl, every request goes through
+# `kubectl` so it uses the same credentials as the rest of the scripts.
+#
+# Both can also follow the log of a pod from an asyncio event loop, so many
+# logs can be followed at once without a thread each (see harness.logs).
+#
+import asyncio
+import base64
+import http.client
+import json
+import os
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urlsplit
+
+import yaml
+
+from harness import overhead
+from harness.common import iprint
+
+
+# Maximum number of pooled connections, and so of requests in flight.
+POOL_SIZE=16
+# Seconds before a (non-streaming) request is given up.
+REQUEST_TIMEOUT=30
+
+# Resources that can be read and patched by name, as API group and plural.
+RESOURCES = {
+    "configmap": ("api/v1", "configmaps"),
+    "service": ("api/v1", "services"),
+    "deployment": ("apis/apps/v1", "deployments"),
+    "statefulset": ("apis/apps/v1", "statefulsets"),
+    "daemonset": ("apis/apps/v1", "daemonsets"),
+}
+PATCH_TYPES = {
+    "strategic": "application/strategic-merge-patch+json",
+    "merge": "application/merge-patch+json",
+}
+
+
+def api_path(namespace, resource, **params):
+    path = "/api/v1/namespaces/{}/{}".format(namespace, resource)
+    params = {k: v for k, v in params.items() if v is not None}
+    if params:
+        path = path + "?" + urlencode(params)
+    return path
+
+
+def resource_path(namespace, resource, name):
+    group, plural = RESOURCES[resource]
+    return "/{}/namespaces/{}/{}/{}".format(group, namespace, plural, name)
+
+
+def rfc3339(timestamp):
+    return datetime.fromtimestamp(int(timestamp), timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class ApiError(subprocess.CalledProcessError):
+    """A failed API request. It subclasses CalledProcessError so the
+    handlers for failed `kubectl` calls in the scripts cover it too."""
+
+    def __init__(self, status, method, path, output):
+        super(ApiError, self).__init__(status, [method, path], output)
+
+    def __str__(self):
+        return "{} {} failed with status {}: {}".format(
+            self.cmd[0], self.cmd[1], self.returncode, self.output)
+
+
+def parse_json(method, path, text):
+    """The JSON response to a request. A response cut short fails like any
+    other request, so the callers retry it."""
+    try:
+        return json.loads(text)
+    except ValueError as e:
+        raise ApiError(-1, method, path, "invalid response: {}".format(e))
+
+
+class KubectlTransport(object):
+    def get(self, path):
+        with overhead.timed("call_time"):
+            output = subprocess.check_output(['kubectl', 'get', '--raw', path], universal_newlines=True)
+        with overhead.timed("parse_time"):
+            return parse_json("GET", path, output)
+
+    def stream(self, path):
+        """Return a `(lines, close)` pair for a streaming request such as a
+        watch. `lines` yields the response line by line as it arrives."""
+        proc = subprocess.Popen(
+            ['kubectl', 'get', '--raw', path],
+            stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+
+        def close():
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+
+        return iter(proc.stdout.readline, ''), close
+
+    def log(self, namespace, pod, since=None, tail=None):
+        command = ['kubectl', '-n', namespace, 'logs', pod]
+        if since is not None:
+            command.append('--since-time={}'.format(rfc3339(since)))
+        if tail is not None:
+            command.append('--tail={}'.format(tail))
+        with overhead.timed("call_time"):
+            return str(subprocess.check_output(command, universal_newlines=True))
+
+    async def follow_log(self, namespace, pod, since=None, timestamps=False):
+        """Yield the lines of the log of `pod` as they are written, until the
+        container stops, prefixed with the time they were written if
+        `timestamps` is set. Raises ApiError if the log can't be followed."""
+        command = ['kubectl', '-n', namespace, 'logs', '-f', pod]
+        if since is not None:
+            command.append('--since-time={}'.format(rfc3339(since)))
+        if timestamps:
+            command.append('--timestamps')
+        proc = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+                yield line.decode(errors="replace")
+            error = await proc.stderr.read()
+            if await proc.wait() != 0:
+                raise ApiError(proc.returncode, "GET", "pods/{}/log".format(pod), error.decode(errors="replace"))
+        finally:
+            if proc.returncode is None:
+                proc.terminate()
+            # Reading the pipes to the end lets the subprocess transport close
+            # while the event loop still runs.
+            await proc.communicate()
+
+    def patch(self, namespace, resource, name, body, patch_type="strategic"):
+        with overhead.timed("call_time"):
+            subprocess.check_call(['kubectl', '-n', namespace, 'patch', resource, name,
+                                   '--type', patch_type, '-p', json.dumps(body)])
+
+
+class HttpTransport(object):
+    """Requests to the API server over at most `pool_size` keep-alive
+    connections. Streams get a connection of their own."""
+
+    def __init__(self, server, ssl_context=None, headers=None, pool_size=POOL_SIZE):
+        url = urlsplit(server)
+        self.https = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port or (443 if self.https else 80)
+        self.prefix = url.path.rstrip("/")
+        self.ssl_context = ssl_context
+        self.headers = dict(headers or {})
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _connect(self, timeout):
+        if self.https:
+            conn = http.client.HTTPSConnection(
+                self.host, self.port, timeout=timeout, context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        conn.connect()
+        # Headers and body are separate writes; don't let Nagle's algorithm
+        # hold back the body until the headers are acknowledged.
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        try:
+            return self._connect(REQUEST_TIMEOUT), False
+        except OSError as e:
+            raise ApiError(-1, "CONNECT", "{}:{}".format(self.host, self.port), str(e))
+
+    def _release(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+
+    def request(self, method, path, body=None, content_type=None):
+        headers = dict(self.headers)
+        if content_type:
+            headers["Content-Type"] = content_type
+        with self._slots, overhead.timed("call_time"):
+            while True:
+                conn, reused = self._acquire()
+                try:
+                    conn.request(method, self.prefix + path, body=body, headers=headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (http.client.HTTPException, OSError) as e:
+                    conn.close()
+                    if reused:
+                        # The server closed an idle connection, try a new one.
+                        continue
+                    raise ApiError(-1, method, path, str(e))
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._release(conn)
+                if response.status >= 400:
+                    raise ApiError(response.status, method, path, data.decode(errors="replace"))
+                return data
+
+    def get(self, path):
+        data = self.request("GET", path)
+        with overhead.timed("parse_time"):
+            return parse_json("GET", path, data.decode(errors="replace"))
+
+    def stream(self, path):
+        conn = None
+        try:
+            conn = self._connect(None)
+            conn.request("GET", self.prefix + path, headers=self.headers)
+            sock = conn.sock
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError) as e:
+            if conn is not None:
+                conn.close()
+            raise ApiError(-1, "GET", path, str(e))
+        if response.status >= 400:
+            data = response.read()
+            conn.close()
+            raise ApiError(response.status, "GET", path, data.decode(errors="replace"))
+
+        def lines():
+            try:
+                for line in iter(response.readline, b''):
+                    yield line.decode()
+            except (http.client.HTTPException, OSError, ValueError):
+                # Closed, possibly from another thread.
+                return
+
+        def close():
+            # Shutting down the socket wakes up a reader blocked in readline.
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            response.close()
+            conn.close()
+
+        return lines(), close
+
+    def log(self, namespace, pod, since=None, tail=None):
+        path = api_path(namespace, "pods/{}/log".format(pod),
+                        sinceTime=rfc3339(since) if since is not None else None, tailLines=tail)
+        return self.request("GET", path).decode()
+
+    async def follow_log(self, namespace, pod, since=None, timestamps=False):
+        """Yield the lines of the log of `pod` as they are written, until the
+        container stops, over a connection of its own. Raises ApiError if the
+        log can't be followed."""
+        path = self.prefix + api_path(namespace, "pods/{}/log".format(pod), follow="true",
+                                      sinceTime=rfc3339(since) if since is not None else None,
+                                      timestamps="true" if timestamps else None)
+        try:
+            reader, writer = await asyncio.open_connection(
+                self.host, self.port, ssl=(self.ssl_context or True) if self.https else None)
+        except OSError as e:
+            raise ApiError(-1, "CONNECT", "{}:{}".format(self.host, self.port), str(e))
+        try:
+            headers = dict(self.headers, Host=self.host, Connection="close")
+            writer.write("GET {} HTTP/1.1\r\n{}\r\n".format(
+                path, "".join("{}: {}\r\n".format(k, v) for k, v in headers.items())).encode())
+            status = int((await reader.readline()).split()[1])
+            response_headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                key, _, value = line.partition(":")
+                response_headers[key.strip().lower()] = value.strip()
+            chunked = response_headers.get("transfer-encoding") == "chunked"
+            body = read_chunks(reader) if chunked else read_lines(reader)
+            if status >= 400:
+                data = "".join([line async for line in body])
+                raise ApiError(status, "GET", path, data)
+            async for line in body:
+                yield line
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError) as e:
+            raise ApiError(-1, "GET", path, str(e))
+        finally:
+            writer.close()
+
+    def patch(self, namespace, resource, name, body, patch_type="strategic"):
+        self.request("PATCH", resource_path(namespace, resource, name),
+                     json.dumps(body).encode(), PATCH_TYPES[patch_type])
+
+
+async def read_lines(reader):
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        yield line.decode(errors="replace")
+
+
+async def read_chunks(reader):
+    """The lines of a chunked response body."""
+    pending = b""
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if size == 0:
+            break
+        pending += await reader.readexactly(size)
+        await reader.readexactly(2)
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode(errors="replace") + "\n"
+    if pending:
+        yield pending.decode(errors="replace")
+
+
+def load_kubeconfig(path=None):
+    """Return the arguments of an HttpTransport for the current context of
+    the kubeconfig, or None if it needs something only kubectl supports,
+    such as exec or auth-provider credential plugins."""
+    path = path or os.environ.get("KUBECONFIG", "").split(os.pathsep)[0] or \
+        os.path.expanduser("~/.kube/config")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        config = yaml.safe_load(f)
+
+    def named(section, name):
+        for entry in config.get(section) or []:
+            if entry["name"] == name:
+                return entry[section[:-1]]
+        return None
+
+    context = named("contexts", config.get("current-context"))
+    if context is None:
+        return None
+    cluster = named("clusters", context["cluster"]) or {}
+    user = named("users", context.get("user")) or {}
+    # Like kubectl, file names are relative to the kubeconfig itself, which
+    # minikube and kind rely on.
+    base = os.path.dirname(os.path.abspath(path))
+    cluster = resolve_files(cluster, base, ("certificate-authority",))
+    user = resolve_files(user, base, ("client-certificate", "client-key", "tokenFile"))
+    if "exec" in user or "auth-provider" in user or "server" not in cluster:
+        return None
+
+    headers = {}
+    context_ssl = None
+    if cluster["server"].startswith("https"):
+        context_ssl = ssl.create_default_context(
+            cafile=cluster.get("certificate-authority"),
+            cadata=decode(cluster.get("certificate-authority-data")))
+        if cluster.get("insecure-skip-tls-verify"):
+            context_ssl.check_hostname = False
+            context_ssl.verify_mode = ssl.CERT_NONE
+        if "client-certificate" in user or "client-certificate-data" in user:
+            load_client_cert(context_ssl, user)
+    token = user.get("token")
+    if token is None and user.get("tokenFile"):
+        with open(user["tokenFile"]) as f:
+            token = f.read().strip()
+    if token:
+        headers["Authorization"] = "Bearer {}".format(token)
+    elif user.get("username"):
+        credentials = "{}:{}".format(user["username"], user.get("password", ""))
+        headers["Authorization"] = "Basic {}".format(base64.b64encode(credentials.encode()).decode())
+    return {"server": cluster["server"], "ssl_context": context_ssl, "headers": headers}
+
+
+def resolve_files(section, base, keys):
+    """`section` with the relative file names under `keys` joined to `base`."""
+    section = dict(section)
+    for key in keys:
+        if section.get(key) and not os.path.isabs(section[key]):
+            section[key] = os.path.join(base, section[key])
+    return section
+
+
+def decode(data):
+    return base64.b64decode(data).decode() if data else None
+
+
+def load_client_cert(context, user):
+    # load_cert_chain only reads files, so inline data goes through a
+    # temporary directory.
+    with tempfile.TemporaryDirectory() as tmp:
+        files = {}
+        for key in ("client-certificate", "client-key"):
+            if user.get(key + "-data"):
+                files[key] = os.path.join(tmp, key)
+                with open(files[key], "w") as f:
+                    f.write(decode(user[key + "-data"]))
+            else:
+                files[key] = user.get(key)
+        context.load_cert_chain(files["client-certificate"], files["client-key"])
+
+
+def make_transport(kind=None):
+    """`kind` is "http", "kubectl" or None to use HTTP when possible."""
+    if kind == "kubectl":
+        return KubectlTransport()
+    server = os.environ.get("KUBE_API_SERVER")
+    if server:
+        return HttpTransport(server)
+    try:
+        settings = load_kubeconfig()
+    except (OSError, ssl.SSLError, yaml.YAMLError, KeyError, ValueError) as e:
+        iprint('Failed to load the kubeconfig: {}'.format(e))
+        settings = None
+    if settings is not None:
+        return HttpTransport(**settings)
+    if kind == "http":
+        raise RuntimeError("No API server found for the HTTP transport.")
+    return KubectlTransport()
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_transport():
+    """The transport shared by everything in this process, picked with the
+    KUBE_TRANSPORT environment variable."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = make_transport(os.environ.get("KUBE_TRANSPORT"))
+        return _default
@@ -0,0 +1,223 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Finding a log line in the logs of many pods.
+#
+# A LogTracker polls: every update fetches the logs written since its last
+# query of each pod that didn't match yet. A LogFollower opens one follow
+# stream per pod instead, from an asyncio event loop with at most
+# FOLLOW_CONCURRENCY streams open, and closes it as soon as the pod printed
+# the line. The streams ask for the time every line was written, so a match
+# is timed when the pod printed it, even if the stream was opened later. Its
+# match times don't depend on how often it is updated, and every pod costs
+# one request, not one per poll.
+#
+import asyncio
+import calendar
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from harness import kube, overhead
+from harness.common import iprint
+
+
+# Maximum number of `kubectl logs` calls running at the same time.
+LOG_CONCURRENCY=16
+# Seconds subtracted from every `--since-time` so clock skew between the
+# harness and the nodes can't make us miss a line.
+LOG_OVERLAP=5
+# Maximum number of log streams a LogFollower keeps open at the same time.
+FOLLOW_CONCURRENCY=64
+# Seconds before a LogFollower opens a stream again that ended without the
+# line, typically because the container didn't start yet.
+FOLLOW_RETRY=0.1
+
+
+def split_timestamp(line):
+    """The time a line of a log with timestamps was written, and its text.
+    The time is None if the line has no RFC3339 prefix."""
+    stamp, _, text = line.partition(" ")
+    seconds, _, fraction = stamp.rstrip("Z").partition(".")
+    try:
+        timestamp = calendar.timegm(time.strptime(seconds, '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None, line
+    return timestamp + (float("0." + fraction) if fraction.isdigit() else 0), text
+
+
+def fetch_log(pod, namespace, since=None, tail=None):
+    try:
+        return kube.default_transport().log(namespace, pod, since, tail)
+    except subprocess.CalledProcessError:
+        iprint('Failed to get logs of pod {}.'.format(pod))
+        return None
+
+
+def fetch_logs(pods, namespace, concurrency=None, since=None, tail=None):
+    """Fetch the logs of `pods` concurrently. Returns a dict of pod name to
+    log output, or None for pods whose logs could not be retrieved. `since`
+    is an optional dict of pod name to the timestamp to fetch logs from."""
+    pods = list(pods)
+    if not pods:
+        return {}
+    since = since or {}
+    workers = min(concurrency or LOG_CONCURRENCY, len(pods))
+    # The calls count towards the overhead of the caller.
+    counters = overhead.current()
+
+    def fetch(pod):
+        with overhead.bound(counters):
+            return fetch_log(pod, namespace, since.get(pod), tail)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outputs = executor.map(fetch, pods)
+        return dict(zip(pods, outputs))
+
+
+class LogTracker(object):
+    """Tracks which pods printed `log_snippet` since `start`.
+
+    Pods that matched once are never queried again, and every query only asks
+    for output written after the previous query of that pod, so the work per
+    poll shrinks as the rollout finishes."""
+
+    def __init__(self, log_snippet, namespace, start=None, tail=None, concurrency=None):
+        self.log_snippet = log_snippet
+        self.namespace = namespace
+        self.start = time.time() if start is None else start
+        self.tail = tail
+        self.concurrency = concurrency
+        self.matched = {}
+        self._checked = {}
+
+    def update(self, pods):
+        """Query the pods that didn't match yet and return how many of `pods`
+        have printed the snippet."""
+        pods = list(pods)
+        pending = [p for p in pods if p not in self.matched]
+        since = {p: max(self.start, self._checked.get(p, 0)) - LOG_OVERLAP for p in pending}
+        queried = time.time()
+        outputs = fetch_logs(pending, self.namespace, self.concurrency, since, self.tail)
+        for pod, output in outputs.items():
+            if output is None:
+                continue
+            self._checked[pod] = queried
+            if self.log_snippet in output:
+                iprint('Pod {} has "{}" in output.'.format(pod, self.log_snippet))
+                self.matched[pod] = queried
+        return len([p for p in pods if p in self.matched])
+
+
+class LogFollower(object):
+    """Follows the logs of pods until each of them printed `log_snippet`
+    since `start`, with the same `update` and `matched` as a LogTracker.
+
+    `matched` holds the time every pod wrote its line, as the log reports it.
+    A stream that ends or fails before the line, for instance because the
+    container didn't start yet, is opened again after FOLLOW_RETRY seconds,
+    until the follower is closed. Use it as a context manager, or `close` it,
+    to stop the streams still open."""
+
+    def __init__(self, log_snippet, namespace, start=None, concurrency=None, transport=None):
+        self.log_snippet = log_snippet
+        self.namespace = namespace
+        self.start = time.time() if start is None else start
+        self.transport = transport or kube.default_transport()
+        self.matched = {}
+        # What the streams cost, added to the overhead of whoever closes it.
+        self.counters = overhead.Counters()
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run, name="log-follower-{}".format(namespace), daemon=True)
+        self._thread.start()
+        self._slots = self._call(self._semaphore(concurrency or FOLLOW_CONCURRENCY))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        overhead.bind(self.counters)
+        self._loop.run_forever()
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _semaphore(self, size):
+        return asyncio.Semaphore(size)
+
+    def update(self, pods):
+        """Follow the logs of `pods` that aren't followed yet, stop following
+        those no longer in `pods`, and return how many of `pods` have printed
+        the snippet."""
+        pods = list(pods)
+        self._call(self._update(pods))
+        with self._lock:
+            return len([p for p in pods if p in self.matched])
+
+    async def _update(self, pods):
+        for pod in pods:
+            if pod not in self._tasks and pod not in self.matched:
+                self._tasks[pod] = self._loop.create_task(self._follow(pod))
+        wanted = set(pods)
+        for pod in [p for p in self._tasks if p not in wanted]:
+            self._tasks.pop(pod).cancel()
+
+    async def _follow(self, pod):
+        try:
+            while True:
+                async with self._slots:
+                    overhead.add("polls")
+                    if await self._scan(pod):
+                        return
+                # Not a backoff: the container is about to start, and every
+                # second waited here is a second of latency.
+                await asyncio.sleep(FOLLOW_RETRY)
+        finally:
+            if self._tasks.get(pod) is asyncio.current_task():
+                del self._tasks[pod]
+
+    async def _scan(self, pod):
+        """Read the log of `pod` until the snippet; False if the stream ended
+        without it."""
+        lines = self.transport.follow_log(self.namespace, pod, self.start - LOG_OVERLAP, timestamps=True)
+        try:
+            async for line in lines:
+                written, text = split_timestamp(line)
+                if self.log_snippet in text:
+                    with self._lock:
+                        self.matched[pod] = time.time() if written is None else written
+                    iprint('Pod {} has "{}" in output.'.format(pod, self.log_snippet))
+                    return True
+        except subprocess.CalledProcessError:
+            pass
+        finally:
+            await lines.aclose()
+        return False
+
+    def last_match(self):
+        """When the last pod that matched printed the snippet, or None."""
+        with self._lock:
+            return max(self.matched.values()) if self.matched else None
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        self._call(self._cancel())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        overhead.merge(self.counters.snapshot())
+
+    async def _cancel(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,197 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Manifests of the consumer deployments. The template is parsed and dumped
+# once; rendering N consumers is string substitution into that text, so it
+# stays fast for thousands of consumers. Manifests are piped to `kubectl`
+# instead of going through a temp file. A base URL change can also be sent as
+# targeted patches, so the API server doesn't diff every consumer.
+#
+# The consumers are one Deployment each by default. The other topologies
+# deploy a single Deployment or StatefulSet with one replica per consumer, so
+# a change is one object for the controllers to roll out instead of N.
+#
+import copy
+import json
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from harness import kube
+
+
+# The C LibYAML bindings are an order of magnitude faster than the pure
+# Python ones. They are optional in PyYAML.
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# Maximum number of patch requests running at the same time.
+PATCH_CONCURRENCY=16
+
+# Plain scalars the dumper leaves unquoted, replaced by the actual values.
+NAME_SENTINEL = "sentinel-consumer-name"
+VALUE_SENTINEL = "sentinel-base-url"
+REPLICAS_SENTINEL = "sentinel-replicas"
+
+# Topology to the kind of the single consumer object, None for one
+# Deployment per consumer. A StatefulSet rolls out a change one pod at a time,
+# the next one only when the previous one is ready, so its change times grow
+# with the number of consumers and aren't comparable to those of the
+# Deployments, which replace many pods at once.
+TOPOLOGIES = {
+    "deployments": None,
+    "deployment": "Deployment",
+    "statefulset": "StatefulSet",
+}
+
+
+def load_all(path):
+    with open(path) as f:
+        return [doc for doc in yaml.load_all(f, Loader=Loader) if doc]
+
+
+def dump_all(documents):
+    return yaml.dump_all(documents, Dumper=Dumper, default_flow_style=False)
+
+
+def scalar(value):
+    # A JSON string is a valid double-quoted YAML scalar.
+    return json.dumps(str(value))
+
+
+def replace_strings(node, old, new):
+    if isinstance(node, dict):
+        return {k: replace_strings(v, old, new) for k, v in node.items()}
+    if isinstance(node, list):
+        return [replace_strings(v, old, new) for v in node]
+    return new if node == old else node
+
+
+def set_field(document, path, value):
+    for key in path[:-1]:
+        document = document[key]
+    document[path[-1]] = value
+
+
+def nested(path, value):
+    for key in reversed(path):
+        value = {key: value}
+    return value
+
+
+def merge(target, patch):
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+def field_patch(fields, value):
+    """A patch that sets every key path in `fields` to `value`."""
+    result = {}
+    for field in fields:
+        merge(result, nested(field, value))
+    return result
+
+
+class ConsumerManifest(object):
+    """A shared config document followed by one Deployment per consumer,
+    built from a two-document file like deployment.yaml.
+
+    With a `topology` other than "deployments", the consumer template becomes
+    one object with a replica per consumer, named like the template.
+
+    Every string in the consumer template equal to the template's name is
+    replaced by the consumer's name. `config_fields` and `consumer_fields`
+    are key paths in the config document and consumer template that hold
+    the base URL."""
+
+    def __init__(self, path, config_fields=(), consumer_fields=()):
+        config, consumer = load_all(path)[:2]
+        self.prefix = consumer["metadata"]["name"]
+        self.config_ref = (config["kind"].lower(), config["metadata"]["name"])
+        self.consumer_kind = consumer["kind"].lower()
+        self.config_fields = list(config_fields)
+        self.consumer_fields = list(consumer_fields)
+
+        consumer = replace_strings(consumer, self.prefix, NAME_SENTINEL)
+        for field in config_fields:
+            set_field(config, field, VALUE_SENTINEL)
+        for field in consumer_fields:
+            set_field(consumer, field, VALUE_SENTINEL)
+        self.config_text = dump_all([config])
+        self.consumer_text = dump_all([consumer])
+        self.replicated_texts = {}
+        for topology, kind in TOPOLOGIES.items():
+            if kind is None:
+                continue
+            replicated = copy.deepcopy(consumer)
+            replicated["kind"] = kind
+            replicated["spec"]["replicas"] = REPLICAS_SENTINEL
+            if kind == "StatefulSet":
+                replicated["spec"]["serviceName"] = NAME_SENTINEL
+                # Create the replicas at once instead of in order. This
+                # only affects scaling: a rolling update still replaces
+                # one pod at a time.
+                replicated["spec"]["podManagementPolicy"] = "Parallel"
+            self.replicated_texts[topology] = dump_all([replicated])
+
+    def render(self, num_consumers, base_url, topology="deployments"):
+        value = scalar(base_url)
+        if TOPOLOGIES[topology] is not None:
+            consumer = (self.replicated_texts[topology]
+                        .replace(VALUE_SENTINEL, value)
+                        .replace(NAME_SENTINEL, scalar(self.prefix))
+                        .replace(REPLICAS_SENTINEL, str(num_consumers)))
+            return "---\n".join([self.config_text.replace(VALUE_SENTINEL, value), consumer])
+        consumer = self.consumer_text.replace(VALUE_SENTINEL, value)
+        parts = [self.config_text.replace(VALUE_SENTINEL, value)]
+        parts.extend(
+            consumer.replace(NAME_SENTINEL, scalar("{}-{}".format(self.prefix, i)))
+            for i in range(num_consumers))
+        return "---\n".join(parts)
+
+    def patches(self, num_consumers, base_url, topology="deployments"):
+        """The patches that change the base URL of a deployed manifest, as
+        `(resource, name, body)`: one for the config document, then one per
+        consumer object if the template holds the base URL too."""
+        result = [self.config_ref + (field_patch(self.config_fields, base_url),)]
+        if not self.consumer_fields:
+            return result
+        consumer = field_patch(self.consumer_fields, base_url)
+        if TOPOLOGIES[topology] is not None:
+            result.append((TOPOLOGIES[topology].lower(), self.prefix, consumer))
+        else:
+            result.extend(
+                (self.consumer_kind, "{}-{}".format(self.prefix, i), consumer)
+                for i in range(num_consumers))
+        return result
+
+
+def kubectl_manifest(verb, namespace, text, *options):
+    subprocess.run(['kubectl', '-n', namespace, verb, '-f', '-', *options],
+                   input=text, universal_newlines=True, check=True)
+
+
+def apply(namespace, text):
+    kubectl_manifest('apply', namespace, text)
+
+
+def delete(namespace, text, ignore_not_found=False):
+    kubectl_manifest('delete', namespace, text, *(['--ignore-not-found'] if ignore_not_found else []))
+
+
+def patch(namespace, resource, name, body, patch_type="strategic"):
+    kube.default_transport().patch(namespace, resource, name, body, patch_type)
+
+
+def patch_all(namespace, patches, concurrency=None):
+    """Send `patches`, a list of `(resource, name, body)`, with at most
+    `concurrency` requests in flight. Raises the first failure."""
+    with ThreadPoolExecutor(max_workers=concurrency or PATCH_CONCURRENCY) as pool:
+        for future in [pool.submit(patch, namespace, *p) for p in patches]:
+            future.result()
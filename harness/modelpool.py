@@ -0,0 +1,116 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# A pool of empty Juju models, to keep `juju add-model` and the teardown of
+# a model out of the time a sweep spends per cell.
+#
+# The pool creates `size` models in the background. `acquire` hands out one
+# that is ready; `release` destroys it in the background and creates a fresh
+# one in its place, while the next cell is already running. Models get new
+# names, so a replacement never waits for the old model to be gone.
+#
+import itertools
+import os
+import queue
+import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from harness.common import iprint
+from harness import wait
+
+
+# Cloud the benchmark models are added to.
+CLOUD = "k8s-relations-k8s"
+# Attempts to create a model before the pool gives up on it.
+ATTEMPTS = 3
+
+
+def add_model(name, cloud=CLOUD):
+    subprocess.check_output(['juju', 'add-model', name, cloud], stderr=subprocess.STDOUT)
+
+
+def destroy_model(name):
+    subprocess.check_output(['juju', 'destroy-model', '-y', '--destroy-storage', name],
+                            stderr=subprocess.STDOUT)
+
+
+class ModelPool(object):
+    def __init__(self, prefix, size, cloud=CLOUD):
+        self.prefix = prefix
+        self.size = size
+        self.cloud = cloud
+        self._ready = queue.Queue()
+        self._names = itertools.count()
+        self._lock = threading.Lock()
+        self._closing = False
+        # Creating and destroying models is mostly waiting on the controller.
+        # Twice the size, so teardowns never hold up the creates.
+        self._workers = ThreadPool(2 * size)
+        for _ in range(size):
+            self._workers.apply_async(self._create)
+
+    def _name(self):
+        with self._lock:
+            return "{}-{}-{}".format(self.prefix, os.getpid(), next(self._names))
+
+    def _create(self):
+        name = self._name()
+        for attempt in range(1, ATTEMPTS + 1):
+            try:
+                add_model(name, self.cloud)
+                break
+            except subprocess.CalledProcessError as e:
+                if attempt == ATTEMPTS:
+                    iprint("Failed to create model {}: {}".format(name, e.output))
+                    # Wakes up whoever waits for this model.
+                    self._ready.put(e)
+                    return
+                delay = wait.backoff(attempt)
+                iprint("Failed to create model {}, retrying in {:.1f}s.".format(name, delay))
+                time.sleep(delay)
+        iprint("Model {} is ready.".format(name))
+        self._ready.put(name)
+
+    def _destroy(self, name):
+        try:
+            destroy_model(name)
+        except subprocess.CalledProcessError as e:
+            iprint("Failed to destroy model {}: {}".format(name, e.output))
+
+    def acquire(self):
+        """Return the name of an empty model, waiting for one if none is
+        ready yet."""
+        model = self._ready.get()
+        if isinstance(model, Exception):
+            raise model
+        return model
+
+    def release(self, name):
+        """Destroy `name` and replace it with a fresh model, both in the
+        background. The replacement is queued first, so it doesn't wait for
+        `name` to be torn down."""
+        if not self._closing:
+            self._workers.apply_async(self._create)
+        self._workers.apply_async(self._destroy, (name,))
+
+    def discard(self, name):
+        """Destroy `name`, a model the pool didn't hand out, in the
+        background."""
+        self._workers.apply_async(self._destroy, (name,))
+
+    def close(self):
+        """Wait for the background work and destroy the unused models."""
+        self._closing = True
+        self._workers.close()
+        self._workers.join()
+        unused = []
+        while not self._ready.empty():
+            model = self._ready.get_nowait()
+            if not isinstance(model, Exception):
+                unused.append(model)
+        if unused:
+            with ThreadPool(len(unused)) as workers:
+                workers.map(self._destroy, unused)
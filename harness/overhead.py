@@ -0,0 +1,149 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# How much of a measurement is the harness itself.
+#
+# The transports, the query layer and the waits add to counters:
+#
+# * polls: checks of the condition, or watch events for watch-based waits.
+# * call_time: seconds spent waiting on kubectl/juju processes and API
+#   requests, summed over threads.
+# * parse_time: seconds spent parsing their output, summed over threads.
+# * gap: seconds between the last observation where the condition didn't
+#   hold yet and the one where it did. The real finish lies in that window.
+#
+# Every thread adds to the Counters bound to it. A `phase` binds fresh ones
+# to the thread that runs it and reports what accrued there. Background
+# threads get Counters of their own: a watch cache per namespace or model, a
+# log follower per wait. The waits `merge` what those counted while they
+# waited into the phase, so a row never counts the events of another
+# namespace or wait. Work outside any phase goes to process-wide Counters.
+#
+# With HARNESS_PROFILE set to a directory, every phase is also profiled with
+# cProfile and its stats dumped there as `<phase>-<pid>-<n>.prof`. cProfile
+# only sees the thread that runs the phase, not the log or watch threads.
+#
+import cProfile
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+FIELDS = ("polls", "call_time", "parse_time", "gap")
+PROFILE_DIR = os.environ.get("HARNESS_PROFILE")
+
+_profiles = itertools.count()
+_local = threading.local()
+
+
+class Counters(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {"polls": 0, "call_time": 0.0, "parse_time": 0.0, "gap": None}
+
+    def add(self, field, value=1):
+        with self._lock:
+            self._values[field] += value
+
+    def observed(self, gap):
+        with self._lock:
+            self._values["gap"] = gap
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, counts):
+        """Add `counts`, a snapshot or a difference of two, except the gap."""
+        with self._lock:
+            for field in FIELDS:
+                if field != "gap":
+                    self._values[field] += counts[field]
+
+
+def since(start, end):
+    """What accrued between the snapshots `start` and `end`."""
+    return {field: end[field] - start[field] for field in FIELDS if field != "gap"}
+
+
+_process = Counters()
+
+
+def current():
+    """The Counters bound to this thread."""
+    return getattr(_local, "counters", None) or _process
+
+
+def bind(counters):
+    """Bind `counters` to this thread for the rest of its life."""
+    _local.counters = counters
+
+
+@contextmanager
+def bound(counters):
+    """Bind `counters` to this thread for the block."""
+    previous = getattr(_local, "counters", None)
+    _local.counters = counters
+    try:
+        yield counters
+    finally:
+        _local.counters = previous
+
+
+def add(field, value=1):
+    current().add(field, value)
+
+
+def observed(gap):
+    """Record the observation gap of the wait that just finished."""
+    current().observed(gap)
+
+
+def merge(counts):
+    current().merge(counts)
+
+
+@contextmanager
+def timed(field):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(field, time.perf_counter() - start)
+
+
+class Phase(object):
+    def __init__(self):
+        self.counters = Counters()
+        self.counts = OrderedDict()
+
+    def stop(self):
+        end = self.counters.snapshot()
+        for field in FIELDS:
+            self.counts[field] = end[field]
+        return self.counts
+
+
+@contextmanager
+def phase(name):
+    """Measure the harness overhead of the block; `counts` of the yielded
+    Phase holds the result once the block exits."""
+    measurement = Phase()
+    profiler = None
+    if PROFILE_DIR:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with bound(measurement.counters):
+            yield measurement
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(
+                PROFILE_DIR, "{}-{}-{}.prof".format(name, os.getpid(), next(_profiles))))
+        measurement.stop()
@@ -0,0 +1,129 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Server-side filtered, paginated pod listings.
+#
+# Label and field selectors are sent to the API server, pods are fetched in
+# pages of PAGE_SIZE and every pod is reduced to a PodSummary as soon as its
+# page is parsed, so memory use stays bounded by one page no matter how many
+# pods live in the namespace.
+#
+import calendar
+import math
+import time
+from collections import namedtuple
+
+from harness import kube, overhead
+
+
+PAGE_SIZE=250
+
+
+# Timestamps are the server-side transition times of the pod, in seconds
+# since the epoch, or None when the pod didn't reach that state (yet).
+# `deleted` is when the deletion was requested; deletionTimestamp itself is
+# the end of the grace period. `init_started` and `init_finished` span the
+# init containers: the first start and the last finish among them.
+PodSummary = namedtuple('PodSummary', [
+    'name', 'phase', 'labels',
+    'created', 'scheduled', 'initialized', 'ready', 'started', 'deleted',
+    'init_started', 'init_finished'])
+
+
+def server_time(timestamp):
+    """A harness `timestamp` at the resolution of the server-side ones, which
+    are truncated to whole seconds. Intervals between a server-side timestamp
+    and a harness one are only meaningful with both truncated alike: a pod
+    created 0.9s after `timestamp` in the same second would otherwise be
+    created before it."""
+    return math.floor(timestamp)
+
+
+def parse_time(value):
+    if not value:
+        return None
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def container_times(statuses, key):
+    times = []
+    for container in statuses:
+        for state in container.get("state", {}).values():
+            if state.get(key):
+                times.append(parse_time(state[key]))
+    return times
+
+
+def container_started(status):
+    started = container_times(status.get("containerStatuses", []), "startedAt")
+    return max(started) if started else None
+
+
+def init_span(status):
+    """When the first init container started and the last one finished, or
+    None for what didn't happen (yet)."""
+    statuses = status.get("initContainerStatuses", [])
+    started = container_times(statuses, "startedAt")
+    finished = container_times(statuses, "finishedAt")
+    return (min(started) if started else None,
+            max(finished) if statuses and len(finished) == len(statuses) else None)
+
+
+def summarize(pod):
+    metadata = pod["metadata"]
+    status = pod.get("status", {})
+    conditions = {c["type"]: c for c in status.get("conditions", [])}
+
+    def transition(condition):
+        condition = conditions.get(condition, {})
+        if condition.get("status") != "True":
+            return None
+        return parse_time(condition.get("lastTransitionTime"))
+
+    init_started, init_finished = init_span(status)
+    return PodSummary(
+        name=metadata["name"],
+        phase=status.get("phase"),
+        labels=metadata.get("labels", {}),
+        created=parse_time(metadata.get("creationTimestamp")),
+        scheduled=transition("PodScheduled"),
+        initialized=transition("Initialized"),
+        ready=transition("ContainersReady"),
+        started=container_started(status),
+        deleted=deletion_requested(metadata),
+        init_started=init_started,
+        init_finished=init_finished,
+    )
+
+
+def deletion_requested(metadata):
+    deleted = parse_time(metadata.get("deletionTimestamp"))
+    if deleted is None:
+        return None
+    return deleted - metadata.get("deletionGracePeriodSeconds", 0)
+
+
+def list_pods(namespace, label_selector=None, field_selector=None, limit=PAGE_SIZE, transport=None):
+    """Yield a PodSummary for every pod in `namespace` matching the selectors.
+    Pages are requested lazily, so stopping early skips the remaining pages."""
+    transport = transport or kube.default_transport()
+    token = None
+    while True:
+        page = transport.get(kube.api_path(
+            namespace, "pods",
+            labelSelector=label_selector,
+            fieldSelector=field_selector,
+            limit=limit,
+            **{"continue": token}))
+        with overhead.timed("parse_time"):
+            pods = [summarize(pod) for pod in page["items"]]
+        for pod in pods:
+            yield pod
+        token = page["metadata"].get("continue")
+        if not token:
+            return
+
+
+def running(namespace, label_selector=None):
+    return list_pods(namespace, label_selector, "status.phase=Running")
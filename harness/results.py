@@ -0,0 +1,119 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Appending to the result files. Several benchmarks can run at the same time
+# (see harness.sweep), so every write holds an exclusive lock on the file.
+#
+# Result files are never rewritten. When the columns of a file change, rows
+# with the new columns go to a versioned sibling, `benchmark-v2.csv`, and the
+# committed results keep the header they were written with.
+#
+import fcntl
+import os
+from contextlib import contextmanager
+
+
+# `censored` is 1 when the wait timed out: the latency is at least `elapsed`.
+# The remaining columns are the harness overhead of the wait, see
+# harness.overhead.
+HEADER = "namespace;num_consumers;action;event;start;end;elapsed;censored;polls;call_time;parse_time;gap"
+# The per-pod latency percentiles of an iteration, see harness.stats, in
+# seconds with three decimals. Those of pod transitions come from server-side
+# timestamps and have a resolution of one second; those of log lines have
+# the resolution of the log timestamps.
+LATENCY_HEADER = "namespace;num_consumers;action;event;start;end;elapsed"
+OVERHEAD_FIELDS = ('polls', 'call_time', 'parse_time', 'gap')
+POD_FIELDS = ('created', 'scheduled', 'initialized', 'ready', 'started', 'deleted', 'init_started', 'init_finished')
+
+
+@contextmanager
+def locked_append(path):
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield f
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def versioned(path, version):
+    """`benchmark.csv` as `benchmark-v2.csv` for version 2."""
+    root, ext = os.path.splitext(path)
+    return "{}-v{}{}".format(root, version, ext)
+
+
+def versions(path):
+    """`path` and its versioned siblings that exist, oldest schema first."""
+    found = [path] if os.path.exists(path) else []
+    version = 2
+    while os.path.exists(versioned(path, version)):
+        found.append(versioned(path, version))
+        version += 1
+    return found
+
+
+def ensure_header(path, header=HEADER):
+    """The file to append rows with `header` to: `path`, started with
+    `header` if it's new. A file with another header is never rewritten;
+    the rows go to the first versioned sibling (see `versioned`) that is new
+    or has `header`."""
+    candidate, version = path, 1
+    while True:
+        with locked_append(candidate) as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                f.write(header + "\n")
+                return candidate
+        with open(candidate) as f:
+            if f.readline().rstrip("\n") == header:
+                return candidate
+        version += 1
+        candidate = versioned(path, version)
+
+
+def format_rows(name, num_consumers, action, result):
+    for event, values in result.items():
+        yield "{};{};{};{};{};{};{};{};{}\n".format(
+            name,
+            num_consumers,
+            action,
+            event,
+            values['started'],
+            values['finish'],
+            values['elapsed'],
+            int(bool(values.get('censored'))),
+            ";".join("" if values.get(field) is None else str(values[field])
+                     for field in OVERHEAD_FIELDS),
+        )
+
+
+def write_latencies(path, name, num_consumers, action, latencies):
+    """Append the `latency_events` of one iteration, one row per statistic."""
+    path = ensure_header(path, LATENCY_HEADER)
+    with locked_append(path) as f:
+        for event, values in latencies.items():
+            f.write("{};{};{};{};{:.3f};{:.3f};{:.3f}\n".format(
+                name,
+                num_consumers,
+                action,
+                event,
+                values['started'],
+                values['finish'],
+                values['elapsed'],
+            ))
+
+
+def write_pod_timestamps(path, name, num_consumers, action, pods):
+    """Append one row per pod with its server-side transition timestamps."""
+    path = ensure_header(path, "namespace;num_consumers;action;pod;{}".format(";".join(POD_FIELDS)))
+    with locked_append(path) as f:
+        for pod in pods:
+            f.write("{};{};{};{};{}\n".format(
+                name,
+                num_consumers,
+                action,
+                pod.name,
+                ";".join("" if getattr(pod, field) is None else str(getattr(pod, field))
+                         for field in POD_FIELDS),
+            ))
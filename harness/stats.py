@@ -0,0 +1,48 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+import math
+from collections import OrderedDict
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, q):
+    """Linearly interpolated percentile `q` (0-100) of `values`."""
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * q / 100.0
+    lower = values[int(math.floor(k))]
+    upper = values[int(math.ceil(k))]
+    return lower + (upper - lower) * (k - math.floor(k))
+
+
+def distribution(values):
+    values = list(values)
+    result = OrderedDict()
+    if not values:
+        return result
+    for q in PERCENTILES:
+        result["p{}".format(q)] = float(percentile(values, q))
+    result["max"] = float(max(values))
+    return result
+
+
+def latency_events(event, start_time, timestamps):
+    """Turn the per-pod `timestamps` of `event` into result entries such as
+    `pods-p50` and `pods-max`, with the same fields as the `pods` entry.
+    For server-side `timestamps`, `start_time` must be truncated the same way
+    (see harness.query.server_time), and the latencies have a resolution of
+    one second."""
+    latencies = [t - start_time for t in timestamps if t is not None]
+    result = OrderedDict()
+    for name, elapsed in distribution(latencies).items():
+        result["{}-{}".format(event, name)] = {
+            'started': start_time,
+            'finish': start_time + elapsed,
+            'elapsed': elapsed,
+        }
+    return result
@@ -0,0 +1,389 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Typed, columnar store of benchmark results.
+#
+# Rows are buffered in memory and written by `flush()` as one part file per
+# flush, atomically (temp file + rename), so a crash never leaves half a
+# part. The benchmarks flush once per consumer count, and at exit. A run is a
+# directory:
+#
+#     results/<run id>/run.json          metadata: run id, git revision,
+#                                        cluster spec, host, command line
+#     results/<run id>/part-*.parquet    rows, if pyarrow is installed
+#     results/<run id>/part-*.bin        rows, otherwise (see `write_binary`)
+#
+# Every row carries its run id and iteration, so campaigns can be queried by
+# run instead of by filtering on consumer counts. The benchmark.csv files
+# are still appended to on every flush, for the notebook and older tools;
+# the rows go to `benchmark-v2.csv` next to a CSV with the older columns.
+#
+# Usage: python3 -m harness.store runs k8s/results
+#        python3 -m harness.store export k8s/results --output all.csv [--run ID]
+#
+import argparse
+import array
+import atexit
+import json
+import math
+import os
+import platform
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from harness import kube, results
+from harness.common import iprint
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# Column name and type: "str" (dictionary encoded), "i64" or "f64". Missing
+# floats are NaN.
+COLUMNS = OrderedDict([
+    ("run_id", "str"),
+    ("backend", "str"),
+    ("iteration", "i64"),
+    ("namespace", "str"),
+    ("num_consumers", "i64"),
+    ("action", "str"),
+    ("event", "str"),
+    ("start", "f64"),
+    ("end", "f64"),
+    ("elapsed", "f64"),
+    ("censored", "i64"),
+    ("polls", "f64"),
+    ("call_time", "f64"),
+    ("parse_time", "f64"),
+    ("gap", "f64"),
+])
+
+MAGIC = b"KRRCOL1\n"
+TYPECODES = {"i64": "q", "f64": "d", "str": "i"}
+
+
+def new_run_id():
+    return "{}-{}".format(time.strftime("%Y%m%dT%H%M%S"), uuid.uuid4().hex[:6])
+
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, universal_newlines=True,
+            stderr=subprocess.DEVNULL).strip()
+        dirty = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+            universal_newlines=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ("-dirty" if dirty else "")
+
+
+def cluster_spec():
+    """The nodes of the cluster with their capacity and versions, or None if
+    the API server can't be reached."""
+    try:
+        nodes = kube.default_transport().get("/api/v1/nodes")
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        iprint('Failed to get the nodes of the cluster: {}'.format(e))
+        return None
+    spec = []
+    for node in nodes.get("items", []):
+        status = node.get("status", {})
+        info = status.get("nodeInfo", {})
+        spec.append({
+            "name": node["metadata"]["name"],
+            "cpu": status.get("capacity", {}).get("cpu"),
+            "memory": status.get("capacity", {}).get("memory"),
+            "kubelet": info.get("kubeletVersion"),
+            "runtime": info.get("containerRuntimeVersion"),
+            "os": info.get("osImage"),
+        })
+    return spec
+
+
+def run_metadata(run_id):
+    return {
+        "run_id": run_id,
+        "started": time.time(),
+        "git_revision": git_revision(),
+        "cluster": cluster_spec(),
+        "host": socket.gethostname(),
+        "python": platform.python_version(),
+        "argv": sys.argv,
+    }
+
+
+def write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def write_binary(columns, metadata):
+    """The compact layout: MAGIC, the length of a JSON header, the header,
+    then every column as a packed little-endian array. String columns are
+    stored as int32 codes into a dictionary kept in the header."""
+    header = {"rows": len(columns["run_id"]), "metadata": metadata, "columns": []}
+    blobs = []
+    for name, kind in COLUMNS.items():
+        values = columns[name]
+        entry = {"name": name, "type": kind}
+        if kind == "str":
+            dictionary = sorted(set(values))
+            codes = {v: i for i, v in enumerate(dictionary)}
+            entry["dictionary"] = dictionary
+            values = [codes[v] for v in values]
+        data = array.array(TYPECODES[kind], values)
+        if sys.byteorder != "little":
+            data.byteswap()
+        blob = data.tobytes()
+        entry["length"] = len(blob)
+        header["columns"].append(entry)
+        blobs.append(blob)
+    header_bytes = json.dumps(header).encode()
+    return b"".join([MAGIC, struct.pack("<I", len(header_bytes)), header_bytes] + blobs)
+
+
+def read_binary(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("{} is not a result part".format(path))
+    offset = len(MAGIC)
+    (length,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    header = json.loads(data[offset:offset + length].decode())
+    offset += length
+    columns = OrderedDict()
+    for entry in header["columns"]:
+        values = array.array(TYPECODES[entry["type"]])
+        values.frombytes(data[offset:offset + entry["length"]])
+        if sys.byteorder != "little":
+            values.byteswap()
+        offset += entry["length"]
+        if entry["type"] == "str":
+            dictionary = entry["dictionary"]
+            columns[entry["name"]] = [dictionary[code] for code in values]
+        else:
+            columns[entry["name"]] = values.tolist()
+    return columns, header["metadata"]
+
+
+def write_parquet(path, columns, metadata):
+    types = {"str": pyarrow.string(), "i64": pyarrow.int64(), "f64": pyarrow.float64()}
+    schema = pyarrow.schema(
+        [(name, types[kind]) for name, kind in COLUMNS.items()],
+        metadata={"harness": json.dumps(metadata)})
+    table = pyarrow.table(columns, schema=schema)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    os.close(fd)
+    try:
+        pyarrow.parquet.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_parquet(path):
+    table = pyarrow.parquet.read_table(path)
+    metadata = json.loads((table.schema.metadata or {}).get(b"harness", b"{}"))
+    return OrderedDict((name, table.column(name).to_pylist()) for name in COLUMNS), metadata
+
+
+def number(value):
+    return float("nan") if value is None else float(value)
+
+
+class ResultStore(object):
+    """Buffers the rows of a benchmark run and writes them to
+    `directory/<run id>/` on `flush()`. If `csv_path` is set, flushed rows
+    are also appended to that CSV file, with `csv_header`. If `checkpoint`
+    is set, the iterations of the flushed rows are marked done in it once
+    they are written, so a resumed run never skips rows that were lost."""
+
+    def __init__(self, directory, backend, run_id=None, csv_path=None, csv_header=results.HEADER):
+        self.backend = backend
+        self.run_id = run_id or os.environ.get("HARNESS_RUN_ID") or new_run_id()
+        self.directory = os.path.join(directory, self.run_id)
+        self.csv_path = csv_path
+        self.csv_header = csv_header
+        self.checkpoint = None
+        self._pending = []
+        self._parts = 0
+        self._lock = threading.Lock()
+
+    def add(self, namespace, num_consumers, action, iteration, result):
+        """Buffer the rows of one `time_until_ready` result."""
+        with self._lock:
+            self._pending.append((namespace, num_consumers, action, iteration, result))
+
+    def columns(self, entries):
+        columns = OrderedDict((name, []) for name in COLUMNS)
+        for namespace, num_consumers, action, iteration, result in entries:
+            for event, values in result.items():
+                row = {
+                    "run_id": self.run_id,
+                    "backend": self.backend,
+                    "iteration": iteration,
+                    "namespace": namespace,
+                    "num_consumers": num_consumers,
+                    "action": action,
+                    "event": event,
+                    "start": values['started'],
+                    "end": values['finish'],
+                    "elapsed": values['elapsed'],
+                    "censored": int(bool(values.get('censored'))),
+                }
+                for name in results.OVERHEAD_FIELDS:
+                    row[name] = number(values.get(name))
+                for name, column in columns.items():
+                    column.append(row[name])
+        return columns
+
+    def write_metadata(self):
+        path = os.path.join(self.directory, "run.json")
+        if os.path.exists(path):
+            return
+        data = json.dumps(run_metadata(self.run_id), indent=2).encode()
+        try:
+            # Concurrent cells of a sweep share the run; the first one wins.
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+    def flush(self):
+        with self._lock:
+            entries, self._pending = self._pending, []
+            part = self._parts
+            self._parts += 1
+        if not entries:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.write_metadata()
+
+        columns = self.columns(entries)
+        metadata = {"backend": self.backend, "pid": os.getpid(), "written": time.time()}
+        name = "part-{}-{}-{:05d}".format(int(time.time()), os.getpid(), part)
+        if pyarrow is not None and os.environ.get("HARNESS_STORE_FORMAT", "parquet") == "parquet":
+            write_parquet(os.path.join(self.directory, name + ".parquet"), columns, metadata)
+        else:
+            write_atomic(os.path.join(self.directory, name + ".bin"), write_binary(columns, metadata))
+
+        if self.csv_path:
+            csv_path = results.ensure_header(self.csv_path, self.csv_header)
+            with results.locked_append(csv_path) as f:
+                f.write("".join(
+                    line for namespace, num_consumers, action, _, result in entries
+                    for line in results.format_rows(namespace, num_consumers, action, result)))
+
+        if self.checkpoint is not None:
+            for _, num_consumers, _, iteration, _ in entries:
+                self.checkpoint.done(num_consumers, iteration)
+
+
+def read_part(path):
+    if path.endswith(".parquet"):
+        if pyarrow is None:
+            raise RuntimeError("pyarrow is needed to read {}".format(path))
+        return read_parquet(path)
+    return read_binary(path)
+
+
+def runs(directory):
+    """The metadata of every run in `directory`, oldest first."""
+    found = []
+    for run_id in sorted(os.listdir(directory)):
+        path = os.path.join(directory, run_id, "run.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                found.append(json.load(f))
+    return found
+
+
+def load(directory, run_ids=None):
+    """All rows of the runs in `directory` (or only `run_ids`) as a dict of
+    column name to list of values."""
+    columns = OrderedDict((name, []) for name in COLUMNS)
+    for run_id in sorted(os.listdir(directory)):
+        run_dir = os.path.join(directory, run_id)
+        if (run_ids and run_id not in run_ids) or not os.path.isdir(run_dir):
+            continue
+        for name in sorted(os.listdir(run_dir)):
+            if not name.startswith("part-"):
+                continue
+            part, _ = read_part(os.path.join(run_dir, name))
+            for column, values in part.items():
+                columns[column].extend(values)
+    return columns
+
+
+def export_csv(columns, out):
+    out.write(";".join(COLUMNS) + "\n")
+    for row in zip(*columns.values()):
+        out.write(";".join(
+            "" if isinstance(v, float) and math.isnan(v) else str(v) for v in row) + "\n")
+
+
+_stores = {}
+
+
+def run_store(backend, csv_path=None, csv_header=results.HEADER, directory="results"):
+    """The store of this process, so all consumer counts of a benchmark
+    script end up in the same run."""
+    if backend not in _stores:
+        _stores[backend] = ResultStore(directory, backend, csv_path=csv_path, csv_header=csv_header)
+        # Keep what was measured if the script dies halfway.
+        atexit.register(_stores[backend].flush)
+    return _stores[backend]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and export stored benchmark results.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    list_runs = commands.add_parser("runs", help="list the runs and their metadata")
+    list_runs.add_argument("directory")
+    export = commands.add_parser("export", help="export rows as CSV")
+    export.add_argument("directory")
+    export.add_argument("--run", nargs="+", help="only these run ids")
+    export.add_argument("--output", help="CSV file to write, stdout by default")
+    args = parser.parse_args()
+
+    if args.command == "runs":
+        for run in runs(args.directory):
+            print("{}  git {}  {} nodes  {}".format(
+                run["run_id"], run.get("git_revision"), len(run.get("cluster") or []),
+                " ".join(run.get("argv", []))))
+        return
+    columns = load(args.directory, args.run)
+    if args.output:
+        with open(args.output, "w") as f:
+            export_csv(columns, f)
+    else:
+        export_csv(columns, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
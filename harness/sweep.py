@@ -0,0 +1,247 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Run the (backend, consumer count) cells of a benchmark sweep concurrently.
+#
+# Every cell is a separate run of `<backend>/benchmark.py` for one consumer
+# count, in its own namespace (or Juju model). Cells are started as long as
+# the total number of consumers of the running cells stays below
+# `--max-pods`. When the sweep is done, sweep.csv lists for every cell which
+# other cells ran at the same time, so interference can be accounted for.
+# All cells store their results under the same run id (see harness.store).
+#
+# Cells resume from the checkpoints of the run (see harness.checkpoint), so
+# a failed cell can be retried with `--retries`, and an interrupted sweep
+# continued with `--resume [RUN_ID]`: finished cells are skipped.
+#
+# With `--juju-pool SIZE`, Juju cells get a model from a harness.modelpool
+# pool, which is destroyed and replaced in the background once the cell is
+# done.
+#
+# With `--warmup`, the Kubernetes cells pull their images and do an untimed
+# deploy and change first (see harness.warmup).
+#
+# With `--topologies`, the k8s and helm cells run once per consumer topology
+# (see harness.manifest.TOPOLOGIES), side by side, so the cost per object
+# can be told apart from the cost per pod.
+#
+# Usage: python3 -m harness.sweep --backends k8s helm --consumers 5 10 15
+#
+import argparse
+import os
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+from harness.common import iprint, WAIT_TIME
+from harness import checkpoint, manifest, modelpool, results, store
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# Directory of the backend, the option of its benchmark.py that selects the
+# namespace or model, and the name of the namespace or model of a cell.
+Backend = namedtuple('Backend', ['directory', 'option', 'namespace', 'needs_namespace'])
+
+BACKENDS = {
+    "k8s": Backend("k8s", "--namespace", "k8s-native-test-{}", True),
+    "k8s-volume": Backend("k8s-volume", "--namespace", "k8s-volume-test-{}", True),
+    "orcon": Backend("orcon", "--namespace", "k8s-orcon-test-{}", True),
+    "helm": Backend("helm", "--namespace", "helm-test-{}", True),
+    "juju": Backend("juju", "--model", "k8s-test-{}", False),
+}
+# Backends that can deploy the consumers in every topology.
+TOPOLOGY_BACKENDS = ("k8s", "helm")
+DEFAULT_TOPOLOGY = "deployments"
+
+
+class Cell(object):
+    def __init__(self, backend, num_consumers, attempt=0, topology=DEFAULT_TOPOLOGY):
+        self.backend = backend
+        self.num_consumers = num_consumers
+        self.attempt = attempt
+        self.topology = topology
+        self.pooled = False
+        self.warmup = False
+        if topology == DEFAULT_TOPOLOGY:
+            self.namespace = BACKENDS[backend].namespace.format(num_consumers)
+        else:
+            self.namespace = BACKENDS[backend].namespace.format("{}-{}".format(topology, num_consumers))
+        self.process = None
+        self.log = None
+        self.start = None
+        self.end = None
+        self.returncode = None
+        self.pods_in_flight = None
+
+    @property
+    def label(self):
+        """The backend the results of the cell are stored under."""
+        if self.topology == DEFAULT_TOPOLOGY:
+            return self.backend
+        return "{}-{}".format(self.backend, self.topology)
+
+    @property
+    def name(self):
+        return "{}/{}".format(self.label, self.num_consumers)
+
+    def retry(self):
+        cell = Cell(self.backend, self.num_consumers, self.attempt + 1, self.topology)
+        cell.warmup = self.warmup
+        return cell
+
+    def command(self):
+        backend = BACKENDS[self.backend]
+        namespace = self.namespace
+        if self.backend == "juju" and not self.pooled:
+            # The juju benchmark formats the model name itself.
+            namespace = backend.namespace
+        return [
+            sys.executable, "benchmark.py",
+            backend.option, namespace,
+            "--consumers", str(self.num_consumers),
+            "--resume", os.environ["HARNESS_RUN_ID"],
+        ] + (["--keep-model"] if self.pooled else []) + (["--warmup"] if self.warmup else []) + (
+            ["--topology", self.topology] if self.topology != DEFAULT_TOPOLOGY else [])
+
+    def complete(self):
+        progress = checkpoint.Checkpoint(
+            os.path.join(ROOT, BACKENDS[self.backend].directory, checkpoint.CHECKPOINT),
+            self.label, os.environ["HARNESS_RUN_ID"])
+        return progress.complete(self.num_consumers)
+
+    def overlaps(self, other):
+        return self is not other and self.start < other.end and other.start < self.end
+
+
+def create_namespace(namespace):
+    try:
+        subprocess.check_output(['kubectl', 'create', 'namespace', namespace], stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        if b"AlreadyExists" not in e.output:
+            raise
+
+
+def start_cell(cell, log_dir, in_flight, pool=None):
+    backend = BACKENDS[cell.backend]
+    if backend.needs_namespace:
+        create_namespace(cell.namespace)
+    if cell.backend == "juju" and pool is not None:
+        cell.namespace = pool.acquire()
+        cell.pooled = True
+    suffix = "-{}".format(cell.attempt) if cell.attempt else ""
+    cell.log = open(os.path.join(log_dir, "{}-{}{}.log".format(cell.label, cell.num_consumers, suffix)), "w")
+    cell.start = time.time()
+    cell.pods_in_flight = in_flight
+    cell.process = subprocess.Popen(
+        cell.command(), cwd=os.path.join(ROOT, backend.directory),
+        stdout=cell.log, stderr=subprocess.STDOUT)
+    iprint("Started {} in {} ({} pods in flight).".format(cell.name, cell.namespace, in_flight))
+
+
+def run(cells, max_pods, max_cells=None, log_dir=".", retries=0, pool=None):
+    pending = list(cells)
+    running = []
+    done = []
+    while pending or running:
+        for cell in list(running):
+            if cell.process.poll() is not None:
+                cell.end = time.time()
+                cell.returncode = cell.process.returncode
+                cell.log.close()
+                running.remove(cell)
+                done.append(cell)
+                iprint("Finished {} with exit code {} in {:.1f}s.".format(
+                    cell.name, cell.returncode, cell.end - cell.start))
+                if cell.pooled:
+                    pool.release(cell.namespace)
+                if cell.returncode != 0 and cell.attempt < retries:
+                    iprint("Retrying {}.".format(cell.name))
+                    pending.append(cell.retry())
+
+        for cell in list(pending):
+            in_flight = sum(c.num_consumers for c in running)
+            if max_cells and len(running) >= max_cells:
+                break
+            # A cell that is larger than the cap on its own still runs, alone.
+            if running and in_flight + cell.num_consumers > max_pods:
+                continue
+            pending.remove(cell)
+            start_cell(cell, log_dir, in_flight, pool)
+            running.append(cell)
+
+        time.sleep(WAIT_TIME)
+    return done
+
+
+def write_sweep(path, cells):
+    path = results.ensure_header(path, "backend;num_consumers;namespace;start;end;returncode;pods_in_flight;overlapping;run_id")
+    with results.locked_append(path) as f:
+        for cell in cells:
+            f.write("{};{};{};{};{};{};{};{};{}\n".format(
+                cell.label,
+                cell.num_consumers,
+                cell.namespace,
+                cell.start,
+                cell.end,
+                cell.returncode,
+                cell.pods_in_flight,
+                ",".join(other.name for other in cells if cell.overlaps(other)),
+                os.environ["HARNESS_RUN_ID"],
+            ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run benchmark cells of several backends concurrently.")
+    parser.add_argument("--backends", nargs="+", choices=sorted(BACKENDS), default=sorted(BACKENDS))
+    parser.add_argument("--consumers", type=int, nargs="+", default=list(range(5, 56, 5)))
+    parser.add_argument("--max-pods", type=int, default=100,
+                        help="maximum number of consumers of all running cells together")
+    parser.add_argument("--max-cells", type=int, default=None,
+                        help="maximum number of cells running at the same time")
+    parser.add_argument("--log-dir", default=".")
+    parser.add_argument("--output", default="sweep.csv")
+    parser.add_argument("--retries", type=int, default=0,
+                        help="times a failed cell is started again, continuing where it stopped")
+    parser.add_argument("--resume", nargs="?", const="latest", metavar="RUN_ID",
+                        help="continue an interrupted sweep (the latest run by default)")
+    parser.add_argument("--warmup", action="store_true",
+                        help="let the Kubernetes cells warm up before they start timing")
+    parser.add_argument("--topologies", nargs="+", choices=sorted(manifest.TOPOLOGIES), default=[DEFAULT_TOPOLOGY],
+                        help="consumer topologies to run the k8s and helm cells with")
+    parser.add_argument("--juju-pool", type=int, default=0, metavar="SIZE",
+                        help="number of Juju models to keep ready for juju cells")
+    args = parser.parse_args()
+
+    if args.resume:
+        os.environ["HARNESS_RUN_ID"] = checkpoint.resolve(args.resume, [
+            os.path.join(ROOT, BACKENDS[b].directory, checkpoint.CHECKPOINT) for b in args.backends])
+    os.environ.setdefault("HARNESS_RUN_ID", store.new_run_id())
+    iprint("Run {}.".format(os.environ["HARNESS_RUN_ID"]))
+    cells = [Cell(b, n, topology=t) for n in args.consumers for b in args.backends
+             for t in (args.topologies if b in TOPOLOGY_BACKENDS else [DEFAULT_TOPOLOGY])]
+    for cell in cells:
+        cell.warmup = args.warmup and cell.backend != "juju"
+    finished = [c for c in cells if c.complete()]
+    if finished:
+        iprint("Skipping finished cells: {}".format(", ".join(c.name for c in finished)))
+    cells = [c for c in cells if c not in finished]
+    pool = None
+    if args.juju_pool and any(c.backend == "juju" for c in cells):
+        pool = modelpool.ModelPool("k8s-test-pool", args.juju_pool)
+    try:
+        done = run(cells, args.max_pods, args.max_cells, args.log_dir, args.retries, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+    write_sweep(args.output, done)
+    failed = [c.name for c in done if c.returncode != 0 and c.attempt >= args.retries]
+    if failed:
+        iprint("Failed cells: {}".format(", ".join(failed)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
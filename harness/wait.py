@@ -0,0 +1,70 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Waiting for a condition by polling.
+#
+# Every wait has a deadline. A failing check (API server unreachable, kubectl
+# or juju erroring out) backs off exponentially with jitter instead of
+# retrying in a tight loop, and polling speeds up as the number of things
+# still missing gets close to zero, so the finish time is observed sooner.
+#
+import random
+import subprocess
+import time
+
+from harness import overhead
+from harness.common import iprint, TIMEOUT, WAIT_TIME
+
+
+# Shortest pause between two checks, reached when almost nothing is missing.
+MIN_WAIT_TIME=0.2
+# Longest pause after repeated failures.
+MAX_BACKOFF=30
+
+
+def backoff(failures, interval=WAIT_TIME):
+    """Seconds to wait after `failures` consecutive failures: exponential,
+    capped at MAX_BACKOFF, with jitter so parallel benchmarks don't retry in
+    lockstep."""
+    delay = min(MAX_BACKOFF, interval * 2 ** failures)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def poll(check, timeout=TIMEOUT, interval=WAIT_TIME, errors=(subprocess.CalledProcessError,)):
+    """Call `check()` until it returns 0 or less: the number of things still
+    missing. Returns the time of the check that succeeded, or None if
+    `timeout` seconds passed first.
+
+    The pause between checks shrinks from `interval` to MIN_WAIT_TIME in
+    proportion to what is still missing. Exceptions in `errors` count as
+    failed checks."""
+    deadline = time.time() + timeout
+    previous = time.time()
+    failures = 0
+    most = 0
+    while True:
+        error = None
+        overhead.add("polls")
+        try:
+            remaining = check()
+        except errors as e:
+            error = e
+            failures += 1
+            delay = backoff(failures, interval)
+        else:
+            checked = time.time()
+            if remaining <= 0:
+                overhead.observed(checked - previous)
+                return checked
+            previous = checked
+            failures = 0
+            most = max(most, remaining)
+            delay = max(MIN_WAIT_TIME, interval * remaining / float(most))
+        left = deadline - time.time()
+        if left <= 0:
+            return None
+        delay = min(delay, left)
+        if error is not None:
+            iprint("Check failed ({} in a row), retrying in {:.1f}s: {}".format(failures, delay, error))
+        time.sleep(delay)
@@ -0,0 +1,83 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Warming up a cluster before the first timed deploy.
+#
+# The consumers use `imagePullPolicy: IfNotPresent`, so the first deploy on a
+# fresh node includes pulling the image. `prepull` runs a temporary DaemonSet
+# with every image as an init container, which puts the images on every node,
+# and removes it again. The scripts then do an untimed deploy and change of a
+# few consumers, see `warm_up` in them.
+#
+
+import yaml
+
+from harness.common import iprint, TIMEOUT, WAIT_TIME
+from harness import kube, manifest, wait
+
+
+PREPULL_NAME = "warmup-prepull"
+# Keeps the DaemonSet pods running once the init containers are done.
+PAUSE_IMAGE = "registry.k8s.io/pause:3.9"
+# Consumers of the untimed deploy and change.
+CONSUMERS = 2
+
+
+def images(text):
+    """The images of the containers in the manifests of `text`."""
+    found = set()
+    for document in yaml.load_all(text, Loader=manifest.Loader):
+        spec = ((document or {}).get("spec") or {}).get("template", {}).get("spec", {})
+        for container in spec.get("initContainers", []) + spec.get("containers", []):
+            found.add(container["image"])
+    return sorted(found)
+
+
+def prepull_manifest(images):
+    labels = {"app": PREPULL_NAME}
+    return manifest.dump_all([{
+        "apiVersion": "apps/v1",
+        "kind": "DaemonSet",
+        "metadata": {"name": PREPULL_NAME, "labels": labels},
+        "spec": {
+            "selector": {"matchLabels": labels},
+            "template": {
+                "metadata": {"labels": labels},
+                "spec": {
+                    # Only pulling matters; the images need a shell.
+                    "initContainers": [
+                        {"name": "pull-{}".format(i), "image": image,
+                         "imagePullPolicy": "IfNotPresent", "command": ["sh", "-c", "true"]}
+                        for i, image in enumerate(images)],
+                    "containers": [{"name": "pause", "image": PAUSE_IMAGE}],
+                    "terminationGracePeriodSeconds": 0,
+                },
+            },
+        },
+    }])
+
+
+def prepull(namespace, images, timeout=TIMEOUT):
+    """Pull `images` on every node. Returns the time they were, or None if
+    that took longer than `timeout` seconds."""
+    text = prepull_manifest(images)
+    iprint("Pulling {} on every node.".format(", ".join(images)))
+    manifest.apply(namespace, text)
+    transport = kube.default_transport()
+
+    def check():
+        status = transport.get(kube.resource_path(namespace, "daemonset", PREPULL_NAME)).get("status", {})
+        desired = status.get("desiredNumberScheduled", 0)
+        if not desired:
+            # Not picked up by the controller yet.
+            return 1
+        return desired - min(status.get("numberReady", 0), status.get("updatedNumberScheduled", desired))
+
+    try:
+        finish_time = wait.poll(check, timeout, WAIT_TIME)
+    finally:
+        manifest.delete(namespace, text, ignore_not_found=True)
+    if finish_time is None:
+        iprint("Timed out pulling the images.")
+    return finish_time
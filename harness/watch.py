@@ -0,0 +1,229 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# List-then-watch pod cache.
+#
+# Instead of listing all pods of a namespace every WAIT_TIME seconds, the
+# cache lists them once and then follows a single watch stream, starting from
+# the resourceVersion of the list. Waiting for a condition blocks until the
+# event that makes it true arrives, and returns the time that event was read.
+#
+import atexit
+import json
+import threading
+import time
+
+from harness.common import iprint
+from harness import kube, overhead, query, wait
+
+
+class PodCache(object):
+    def __init__(self, namespace, transport=None):
+        self.namespace = namespace
+        self.transport = transport or kube.default_transport()
+        self.resource_version = None
+        self._pods = {}
+        self._synced = False
+        self._last_event = time.time()
+        self._previous_event = self._last_event
+        # The pending `wait_for` calls, checked after every event.
+        self._waiters = []
+        # What the watch thread spends on this namespace, see `wait_for`.
+        self.counters = overhead.Counters()
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._close = None
+        self._thread = threading.Thread(
+            target=self._run, name="pod-cache-{}".format(namespace), daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._close:
+            self._close()
+        self._thread.join()
+
+    def pods(self):
+        with self._cond:
+            return list(self._pods.values())
+
+    def wait_for(self, predicate, timeout=None):
+        """Block until `predicate(pods)` holds for the cached pods and return
+        the time the event that made it hold was received. `pods` is a dict
+        of pod name to PodSummary. Returns None on timeout.
+
+        The events and parsing of this namespace while it waits count
+        towards the overhead of the caller."""
+        start = self.counters.snapshot()
+        try:
+            return self._wait_for(predicate, timeout)
+        finally:
+            overhead.merge(overhead.since(start, self.counters.snapshot()))
+
+    def _wait_for(self, predicate, timeout):
+        called = time.time()
+        deadline = None if timeout is None else called + timeout
+        with self._cond:
+            if self._synced and predicate(self._pods):
+                overhead.observed(0)
+                return called
+            # The watch thread checks the predicate after every event it
+            # applies, so the waiter learns which event made it hold even
+            # if more events arrive before it wakes up.
+            waiter = {"predicate": predicate}
+            self._waiters.append(waiter)
+            try:
+                while "finish" not in waiter:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+            finally:
+                self._waiters.remove(waiter)
+        # Every event is an observation; the condition didn't hold after the
+        # one before it.
+        finish = waiter["finish"]
+        overhead.observed(finish - max(called, waiter["previous"]))
+        return finish
+
+    def _run(self):
+        overhead.bind(self.counters)
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                if self.resource_version is None:
+                    self._list()
+                self._watch()
+                failures = 0
+            except Exception as e:  # pylint: disable=broad-except
+                if self._stopped.is_set():
+                    break
+                failures += 1
+                delay = wait.backoff(failures)
+                iprint('Pod watch of namespace {} failed, retrying in {:.1f}s: {}'.format(self.namespace, delay, e))
+                self._stopped.wait(delay)
+
+    def _list(self):
+        # All pages of a paginated list are served from the snapshot of the
+        # first one, so its resourceVersion is where the watch starts.
+        pods = {}
+        resource_version = None
+        token = None
+        while True:
+            page = self.transport.get(kube.api_path(
+                self.namespace, "pods", limit=query.PAGE_SIZE, **{"continue": token}))
+            resource_version = resource_version or page["metadata"]["resourceVersion"]
+            with overhead.timed("parse_time"):
+                pods.update((p.name, p) for p in map(query.summarize, page["items"]))
+            token = page["metadata"].get("continue")
+            if not token:
+                break
+        received = time.time()
+        with self._cond:
+            self._pods = pods
+            self.resource_version = resource_version
+            self._synced = True
+            self._applied(received)
+
+    def _watch(self):
+        path = kube.api_path(
+            self.namespace, "pods",
+            watch=1,
+            resourceVersion=self.resource_version,
+            allowWatchBookmarks="true")
+        lines, self._close = self.transport.stream(path)
+        try:
+            for line in lines:
+                if self._stopped.is_set():
+                    break
+                if not line.strip():
+                    continue
+                received = time.time()
+                with overhead.timed("parse_time"):
+                    event = json.loads(line)
+                self._handle(event, received)
+                if self.resource_version is None:
+                    # Our resourceVersion is too old, relist.
+                    break
+        finally:
+            self._close()
+
+    def _handle(self, event, received):
+        kind = event["type"]
+        obj = event["object"]
+        if kind == "ERROR":
+            iprint('Pod watch of namespace {} returned error: {}'.format(
+                self.namespace, obj.get("message")))
+            if obj.get("code") == 410:
+                self.resource_version = None
+            return
+        with self._cond:
+            self.resource_version = obj["metadata"]["resourceVersion"]
+            if kind == "BOOKMARK":
+                return
+            name = obj["metadata"]["name"]
+            if kind == "DELETED":
+                self._pods.pop(name, None)
+            else:
+                with overhead.timed("parse_time"):
+                    self._pods[name] = query.summarize(obj)
+            overhead.add("polls")
+            self._applied(received)
+
+    def _applied(self, received):
+        """Note that the event received at `received` is applied, and finish
+        the waiters it made the predicate of hold. Called with the lock."""
+        self._previous_event = self._last_event
+        self._last_event = received
+        for waiter in self._waiters:
+            if "finish" not in waiter and waiter["predicate"](self._pods):
+                waiter["finish"] = received
+                waiter["previous"] = self._previous_event
+        self._cond.notify_all()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def pod_cache(namespace):
+    """Return the running pod cache of `namespace`, starting it if needed."""
+    with _caches_lock:
+        if namespace not in _caches:
+            _caches[namespace] = PodCache(namespace).start()
+        return _caches[namespace]
+
+
+@atexit.register
+def _stop_caches():
+    with _caches_lock:
+        for cache in _caches.values():
+            cache._stopped.set()
+            if cache._close:
+                cache._close()
+
+
+#
+# Conditions to wait for.
+def running_with_label(count, key, value):
+    def predicate(pods):
+        running = [p for p in pods.values()
+                   if p.labels.get(key) == value and p.phase == "Running"]
+        return len(running) >= count
+    return predicate
+
+
+def no_terminating():
+    def predicate(pods):
+        return not any(p.deleted for p in pods.values())
+    return predicate
+
+
+def no_pods_with_prefix(prefix):
+    def predicate(pods):
+        return not any(name.startswith(prefix) for name in pods)
+    return predicate
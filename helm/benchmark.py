@@ -3,19 +3,35 @@
 # Copyright © 2019 Ghent University and imec.
 # License is described in `LICENSE` file.
 #
+import argparse
 import os
 import time
-import json
 import sys
-import copy
 import subprocess
 from datetime import datetime
 
-import yaml
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from harness import chart, checkpoint, logs, overhead, query, results, stats, store, wait, warmup, watch
 
 
 WAIT_TIME=1
 TIMEOUT=10*60
+# Follow pod events with a list-then-watch cache instead of polling every
+# WAIT_TIME seconds.
+USE_WATCH=True
+# How the consumers are deployed and changed: "upgrade" with helm itself,
+# "phased" renders, records and applies the release in separately timed
+# steps, "cached" does the same from a cached render and only submits the
+# objects that changed (see harness.chart).
+UPDATE_MODE="upgrade"
+# The `topology` value of the chart: "deployments", one Deployment per
+# consumer, or a single "deployment" or "statefulset" with a replica each. A
+# statefulset updates its pods one at a time (see harness.manifest.TOPOLOGIES).
+TOPOLOGY="deployments"
+CHART="sse-relations"
+RELEASE="sse-relations-benchmark"
+# Releases deployed by the harness, by namespace.
+RELEASES={}
 
 
 def iprint(*args, **kwargs):
@@ -28,79 +44,61 @@ def oprint(*args, **kwargs):
 
 def get_application_pods(prefix, namespace):
     try:
-        output = json.loads(subprocess.check_output(['kubectl', '-n', namespace, 'get', 'pods', '-o', 'json'], universal_newlines=True))
+        # Only get application pods
+        pods = [p.name for p in query.running(namespace) if p.name.startswith(prefix)]
     except subprocess.CalledProcessError:
         iprint('Failed to get pods of namespace {}.'.format(namespace))
         return []
-    # Only get application pods
-    pods = [p for p in output["items"] if p["metadata"]["name"].startswith(prefix)]
-    pods = [p for p in pods if p["status"]["phase"] == "Running"]
-    pods = [p["metadata"]['name'] for p in pods]
     return pods
 
 
-def get_num_pods_log(pods, log_snippet, namespace):
-    num_pods_ok = 0
-    for pod in pods:
-        try:
-            output = str(subprocess.check_output(['kubectl', '-n', namespace, 'logs', pod], universal_newlines=True))
-        except subprocess.CalledProcessError:
-            iprint('Failed to get logs of pod {}.'.format(pod))
-            continue
-
-        if log_snippet in output:
-            iprint('Pod {} has "{}" in output.'.format(pod, log_snippet))
-            num_pods_ok = num_pods_ok + 1
-        else:
-            iprint('Pod {} doesn\'t have "{}" in output. Output is "{}".'.format(pod, log_snippet, output.rstrip()))
-    return num_pods_ok
-
-
 def wait_until_pods_log(count, prefix, base_url, namespace):
-    while(True):
-        try:
-            iprint("getting output")
-            output = str(subprocess.check_output(
-                ['kubectl', '-n', namespace, "logs", "-l", "base-url={}".format(base_url)],
-                universal_newlines=True))
-        except subprocess.CalledProcessError:
-            iprint('Failed to get logs')
-            time.sleep(WAIT_TIME)
-            continue
-
-        num_pods_ok = output.count(base_url)
+    tracker = logs.LogTracker(base_url, namespace)
 
+    def check():
+        iprint("getting pods")
+        pods = [p.name for p in query.running(namespace, "base-url={}".format(base_url))]
+        num_pods_ok = tracker.update(pods)
         if num_pods_ok >= count:
             iprint("Found {}/{} running pods with prefix {} and log message {}.".format(num_pods_ok, count, prefix, base_url))
-            break
         else:
             iprint("Found only {}/{} running pods with prefix {} and log message {}.".format(num_pods_ok, count, prefix, base_url))
-            time.sleep(WAIT_TIME)
-            continue
+        return count - num_pods_ok
+
+    return wait.poll(check, TIMEOUT, WAIT_TIME)
 
 
 def wait_until_running(count, base_url, namespace):
-    while(True):
-        try:
-            iprint("getting output")
-            output = json.loads(subprocess.check_output(
-                ['kubectl', '-n', namespace, "get", "pods", "-l", "base-url={}".format(base_url), "-o", "json"],
-                universal_newlines=True))
-        except subprocess.CalledProcessError:
-            iprint('Failed to get pods')
-            time.sleep(WAIT_TIME)
-            continue
-
-        pods = [p["metadata"]['name'] for p in output["items"] if (p["status"]["phase"] == "Running")]
-        num_pods_ok = len(pods)
+    if USE_WATCH:
+        finish_time = watch.pod_cache(namespace).wait_for(
+            watch.running_with_label(count, "base-url", base_url), TIMEOUT)
+        if finish_time is None:
+            iprint("Timed out waiting for {} running pods with `base-url` {}.".format(count, base_url))
+        else:
+            iprint("Found {} running pods with `base-url` {}.".format(count, base_url))
+        return finish_time
 
+    def check():
+        iprint("getting output")
+        num_pods_ok = sum(1 for _ in query.running(namespace, "base-url={}".format(base_url)))
         if num_pods_ok >= count:
             iprint("Found {}/{} running pods with `base-url` {}.".format(num_pods_ok, count, base_url))
-            break
         else:
             iprint("Found only {}/{} running pods with `base-url` {}.".format(num_pods_ok, count, base_url))
-            time.sleep(WAIT_TIME)
-            continue
+        return count - num_pods_ok
+
+    finish_time = wait.poll(check, TIMEOUT, WAIT_TIME)
+    if finish_time is None:
+        iprint("Timed out waiting for {} running pods with `base-url` {}.".format(count, base_url))
+    return finish_time
+
+
+def get_pod_timestamps(namespace):
+    try:
+        return list(query.list_pods(namespace))
+    except subprocess.CalledProcessError:
+        iprint('Failed to get pods of namespace {}.'.format(namespace))
+        return []
 
 
 def time_until_ready(num_consumers, prefix, url, message, namespace):
@@ -110,8 +108,12 @@ def time_until_ready(num_consumers, prefix, url, message, namespace):
     }
 
     start_time = time.time()
-    wait_until_running(num_consumers, url, namespace)
-    finish_time = time.time()
+    with overhead.phase("pods") as phase:
+        finish_time = wait_until_running(num_consumers, url, namespace)
+    pods_censored = finish_time is None
+    if pods_censored:
+        # Timed out: all we know is that it takes at least this long.
+        finish_time = time.time()
     elapsed_time = finish_time - start_time
     iprint( '########################################'
             '\n PODS: {}'
@@ -126,9 +128,28 @@ def time_until_ready(num_consumers, prefix, url, message, namespace):
     result['pods']['started'] = start_time
     result['pods']['finish'] = finish_time
     result['pods']['elapsed'] = elapsed_time
-
-    wait_until_settled(namespace)
-    finish_time = time.time()
+    result['pods']['censored'] = pods_censored
+    result['pods'].update(phase.counts)
+
+    # Server-side timestamps of the new pods, and of the old pods that are
+    # being replaced, as seen when the last new pod is running. These are in
+    # whole seconds, so the latencies count from the second the wait started.
+    # For the old pods, this is when their deletion was requested, not when
+    # they were gone.
+    pods = get_pod_timestamps(namespace)
+    result['pods']['timestamps'] = pods
+    new_pods = [p for p in pods if p.labels.get("base-url") == url]
+    old_pods = [p for p in pods if p.deleted]
+    server_start = query.server_time(start_time)
+    latencies = stats.latency_events('pods', server_start, [p.ready or p.started for p in new_pods])
+    latencies.update(stats.latency_events('deleting', server_start, [p.deleted for p in old_pods]))
+    result['pods']['latencies'] = latencies
+
+    with overhead.phase("settled") as phase:
+        finish_time = wait_until_settled(namespace)
+    settled_censored = finish_time is None
+    if settled_censored:
+        finish_time = time.time()
     elapsed_time = finish_time - start_time
     iprint( '########################################'
             '\n SETTLED: {}'
@@ -143,139 +164,217 @@ def time_until_ready(num_consumers, prefix, url, message, namespace):
     result['settled']['started'] = start_time
     result['settled']['finish'] = finish_time
     result['settled']['elapsed'] = elapsed_time
+    result['settled']['censored'] = settled_censored
+    result['settled'].update(phase.counts)
 
     return result
 
 
 def wait_until_settled(namespace):
-    start_time = time.time()
+    if USE_WATCH:
+        finish_time = watch.pod_cache(namespace).wait_for(watch.no_terminating(), TIMEOUT)
+        if finish_time is None:
+            iprint("Timed out waiting for terminating pods.")
+        else:
+            iprint("No terminating pods left!")
+        return finish_time
 
-    while True and (time.time()<start_time+TIMEOUT):
-        try:
-            output = json.loads(subprocess.check_output(['kubectl', '-n', namespace, 'get', 'pods', '-o', 'json'], universal_newlines=True))
-        except subprocess.CalledProcessError:
-            iprint('Failed to get pods of namespace {}.'.format(namespace))
-            continue
-        pods = [p for p in output["items"] if p["metadata"].get("deletionTimestamp")]
-        if (len(pods) > 0):
+    def check():
+        pods = [p.name for p in query.list_pods(namespace) if p.deleted]
+        if pods:
             iprint("Still found {} terminating pods. Waiting..".format(len(pods)))
-            time.sleep(WAIT_TIME)
         else:
             iprint("No terminating pods left!")
-            break
+        return len(pods)
 
+    finish_time = wait.poll(check, TIMEOUT, WAIT_TIME)
+    if finish_time is None:
+        iprint("Timed out waiting for terminating pods.")
+    return finish_time
 
-def remove_deployment(namespace):
-    subprocess.check_call(["helm", "uninstall", "sse-relations-benchmark"])
+
+def chart_release(namespace):
+    if namespace not in RELEASES:
+        RELEASES[namespace] = chart.Release(CHART, RELEASE, namespace, "sseServerBaseUrl",
+                                            cached=UPDATE_MODE == "cached")
+    return RELEASES[namespace]
+
+
+def chart_values(num_consumers, base_url):
+    return {"sseServerBaseUrl": base_url, "numConsumers": num_consumers, "topology": TOPOLOGY}
+
+
+def remove_deployment(num_consumers, namespace, ignore_not_found=False):
+    if UPDATE_MODE != "upgrade":
+        chart_release(namespace).uninstall(chart_values(num_consumers, ""), ignore_not_found)
+        return
+    command = ["helm", "uninstall", "-n", namespace, RELEASE]
+    proc = subprocess.run(command, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode == 0:
+        return
+    # Older helm releases lack --ignore-not-found, so only a missing release
+    # is ignored here; any other failure is real.
+    if ignore_not_found and "release: not found" in proc.stderr:
+        return
+    sys.stderr.write(proc.stderr)
+    raise subprocess.CalledProcessError(proc.returncode, command, stderr=proc.stderr)
 
 
 def wait_until_empty(prefix, namespace):
-    start_time = time.time()
+    if USE_WATCH:
+        finish_time = watch.pod_cache(namespace).wait_for(watch.no_pods_with_prefix(prefix), TIMEOUT)
+    else:
+        def check():
+            pods = [p.name for p in query.list_pods(namespace) if p.name.startswith(prefix)]
+            if pods:
+                iprint("Still found {} running pods with prefix {}. Waiting..".format(len(pods), prefix))
+            return len(pods)
 
-    while True and (time.time()<start_time+TIMEOUT):
-        try:
-            output = json.loads(subprocess.check_output(['kubectl', '-n', namespace, 'get', 'pods', '-o', 'json'], universal_newlines=True))
-        except subprocess.CalledProcessError:
-            iprint('Failed to get pods of namespace {}.'.format(namespace))
-            continue
-        pods = [p for p in output["items"] if p["metadata"]["name"].startswith(prefix)]
-        pods = [p["metadata"]['name'] for p in pods]
-        if (len(pods) > 0):
-            iprint("Still found {} running pods with prefix {}. Waiting..".format(len(pods), prefix))
-            time.sleep(WAIT_TIME)
-        else:
-            break
+        finish_time = wait.poll(check, TIMEOUT, WAIT_TIME)
+    if finish_time is None:
+        iprint("Timed out waiting for pods with prefix {} to disappear.".format(prefix))
+
+
+def upgrade(num_consumers, namespace, base_url):
+    """Deploy the next revision with the harness. Returns the timing of its
+    steps as result entries."""
+    release = chart_release(namespace)
+    steps = release.upgrade(chart_values(num_consumers, base_url))
+    iprint("Revision {} of {}: release record of {} bytes.".format(release.revision, RELEASE, release.record_size))
+    return steps
 
 
 def deploy(num_consumers, prefix, namespace):
-    subprocess.check_call(["helm", "install", "-n", namespace , "--set", "sseServerBaseUrl=endpoint.example.com", "--set", "numConsumers={}".format(num_consumers), "sse-relations-benchmark", "sse-relations"])
+    if UPDATE_MODE != "upgrade":
+        return upgrade(num_consumers, namespace, "endpoint.example.com")
+    subprocess.check_call(["helm", "install", "-n", namespace , "--set", "sseServerBaseUrl=endpoint.example.com", "--set", "numConsumers={}".format(num_consumers), "--set", "topology={}".format(TOPOLOGY), "sse-relations-benchmark", "sse-relations"])
+    return {}
 
 
 def update_base_url(num_consumers, prefix, namespace, base_url):
-    subprocess.check_call(["helm", "upgrade", "-n", namespace , "--set", "sseServerBaseUrl={}".format(base_url), "--set", "numConsumers={}".format(num_consumers), "sse-relations-benchmark", "sse-relations"])
+    if UPDATE_MODE != "upgrade":
+        return upgrade(num_consumers, namespace, base_url)
+    subprocess.check_call(["helm", "upgrade", "-n", namespace , "--set", "sseServerBaseUrl={}".format(base_url), "--set", "numConsumers={}".format(num_consumers), "--set", "topology={}".format(TOPOLOGY), "sse-relations-benchmark", "sse-relations"])
+    return {}
 
 
-def benchmark(num_consumers, namespace):
-    if not os.path.isfile('benchmark.csv'):
-        with open('benchmark.csv', 'a') as f:
-            f.write("namespace;num_consumers;action;event;start;end;elapsed\n")
-        
-    base_url = "endpoint.example.com"
-
+def warm_up(namespace):
+    """Pull the images and deploy, change and remove a few consumers without
+    timing them, so the first timed deploy doesn't pay for a cold start."""
     deployment_name = "sse-consumer"
-
-    #
-    # Time the deployment of the cluster with X units.
-    deploy(num_consumers, deployment_name, namespace)
-
-    result = time_until_ready(num_consumers, deployment_name, base_url, "Deploy {} consumers".format(num_consumers), namespace)
-
-    with open("benchmark.csv", "a") as f:
-#       f.write("model_name;num_consumers;action;event;start;end;elapsed\n")
-        f.write("{};{};{};{};{};{};{}\n".format(
-            namespace,
-            num_consumers,
-            "deploy",
-            "pods",
-            result['pods']['started'],
-            result['pods']['finish'],
-            result['pods']['elapsed'],
-        ))
-        f.write("{};{};{};{};{};{};{}\n".format(
-            namespace,
-            num_consumers,
-            "deploy",
-            "settled",
-            result['settled']['started'],
-            result['settled']['finish'],
-            result['settled']['elapsed'],
-        ))
-    #
-    # Time that it takes to change the url.
-    for i in range(1, 11):
-        new_url = str(i) + base_url
-        update_base_url(num_consumers, deployment_name, namespace, new_url)
-
-        result = time_until_ready(num_consumers, deployment_name, new_url, "Change {} consumers".format(num_consumers), namespace)
-        with open("benchmark.csv", "a") as f:
-            f.write("{};{};{};{};{};{};{}\n".format(
-                namespace,
-                num_consumers,
-                "change",
-                "pods",
-                result['pods']['started'],
-                result['pods']['finish'],
-                result['pods']['elapsed'],
-            ))
-            f.write("{};{};{};{};{};{};{}\n".format(
-                namespace,
-                num_consumers,
-                "change",
-                "settled",
-                result['settled']['started'],
-                result['settled']['finish'],
-                result['settled']['elapsed'],
-            ))
-
-    #
-    # Delete model as best as we can
-    remove_deployment(namespace)
+    rendered = subprocess.check_output(
+        ["helm", "template", "-n", namespace, "--set", "numConsumers=1", "sse-relations-benchmark", "sse-relations"],
+        universal_newlines=True)
+    warmup.prepull(namespace, warmup.images(rendered))
+    deploy(warmup.CONSUMERS, deployment_name, namespace)
+    time_until_ready(warmup.CONSUMERS, deployment_name, "endpoint.example.com", "Warm-up deploy", namespace)
+    update_base_url(warmup.CONSUMERS, deployment_name, namespace, "warmup.example.com")
+    time_until_ready(warmup.CONSUMERS, deployment_name, "warmup.example.com", "Warm-up change", namespace)
+    remove_deployment(warmup.CONSUMERS, namespace)
     wait_until_empty(deployment_name, namespace)
+    wait_until_settled(namespace)
 
 
+def backend_name():
+    """The backend of the results, and the CSV they go to: other topologies
+    than the default are kept apart."""
+    if TOPOLOGY == "deployments":
+        return "helm", "benchmark.csv"
+    return "helm-{}".format(TOPOLOGY), "benchmark-{}.csv".format(TOPOLOGY)
 
 
+def benchmark(num_consumers, namespace):
+    backend, csv_path = backend_name()
+    results_store = store.run_store(backend, csv_path)
+    progress = checkpoint.Checkpoint(checkpoint.CHECKPOINT, backend, results_store.run_id)
+    # Iterations are done once their rows are flushed.
+    results_store.checkpoint = progress
 
-namespace = "default"
+    base_url = "endpoint.example.com"
 
-# wait_until_settled("k8s-native-test")
+    deployment_name = "sse-consumer"
 
-for i in range(5, 56, 5):
-    benchmark(i, namespace)
+    if progress.complete(num_consumers):
+        iprint("Skipping {} consumers, finished before.".format(num_consumers))
+        return
+    left_behind = progress.unfinished(num_consumers)
+    if left_behind:
+        iprint("Cleaning up the unfinished run of {} consumers in {}.".format(num_consumers, left_behind))
+        remove_deployment(num_consumers, left_behind, ignore_not_found=True)
+        wait_until_empty(deployment_name, left_behind)
+    todo = progress.remaining(num_consumers)
+
+    if todo:
+        progress.start(num_consumers, namespace)
+        #
+        # Time the deployment of the cluster with X units.
+        steps = deploy(num_consumers, deployment_name, namespace)
+
+        result = time_until_ready(num_consumers, deployment_name, base_url, "Deploy {} consumers".format(num_consumers), namespace)
+        result.update(steps)
+
+        if 0 in todo:
+            results_store.add(namespace, num_consumers, "deploy", 0, result)
+            results.write_pod_timestamps("benchmark-pods.csv", namespace, num_consumers, "deploy", result['pods']['timestamps'])
+            results.write_latencies("benchmark-latency.csv", namespace, num_consumers, "deploy", result['pods']['latencies'])
+        #
+        # Time that it takes to change the url.
+        for i in range(1, 11):
+            if i not in todo:
+                continue
+            new_url = str(i) + base_url
+            steps = update_base_url(num_consumers, deployment_name, namespace, new_url)
+
+            result = time_until_ready(num_consumers, deployment_name, new_url, "Change {} consumers".format(num_consumers), namespace)
+            result.update(steps)
+            results_store.add(namespace, num_consumers, "change", i, result)
+            results.write_pod_timestamps("benchmark-pods.csv", namespace, num_consumers, "change", result['pods']['timestamps'])
+            results.write_latencies("benchmark-latency.csv", namespace, num_consumers, "change", result['pods']['latencies'])
+
+        #
+        # Delete model as best as we can
+        remove_deployment(num_consumers, namespace)
+        wait_until_empty(deployment_name, namespace)
+    results_store.flush()
+    progress.clean(num_consumers)
+
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time base-url propagation to consumers deployed with Helm.")
+    parser.add_argument("--namespace", default="default")
+    parser.add_argument("--consumers", type=int, nargs="+", default=list(range(5, 56, 5)))
+    parser.add_argument("--update", choices=["upgrade", "phased", "cached"], default=UPDATE_MODE,
+                        help="How to deploy and change the consumers: with helm, or rendered, recorded "
+                             "and applied by the harness, optionally from a cached render.")
+    parser.add_argument("--topology", choices=["deployments", "deployment", "statefulset"], default=TOPOLOGY,
+                        help="One Deployment per consumer, or one object with a replica per consumer.")
+    parser.add_argument("--warmup", action="store_true",
+                        help="Pull the images and do an untimed deploy and change before timing.")
+    parser.add_argument("--resume", nargs="?", const="latest", metavar="RUN_ID",
+                        help="Continue an interrupted run (the latest one by default), "
+                             "skipping the iterations it finished.")
+    args = parser.parse_args()
+    if args.resume:
+        os.environ["HARNESS_RUN_ID"] = checkpoint.resolve(args.resume, [checkpoint.CHECKPOINT])
+    UPDATE_MODE = args.update
+    TOPOLOGY = args.topology
+
+    namespace = args.namespace
+
+    # wait_until_settled("k8s-native-test")
+
+    if args.warmup:
+        warm_up(namespace)
+
+    for i in args.consumers:
+        benchmark(i, namespace)
 
 # deploy(2, "sse-consumer", "k8s-native-test")
 # wait_until_running(2, "endpoint.example.com", "k8s-native-test")
-# remove_deployment("k8s-native-test")
+# remove_deployment(2, "k8s-native-test")
 
 
 # wait_until_pods_log(60, "sse-consumer", "4endpoint.example.com", namespace)
@@ -3,38 +3,92 @@
 # Copyright © 2019 Ghent University and imec.
 # License is described in `LICENSE` file.
 #
+import argparse
+import copy
 import os
 import time
 import json
 import sys
 import subprocess
+import tempfile
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 import yaml
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from harness import checkpoint, jujuwatch, logs, modelpool, overhead, query, results, stats, store, wait
+
 
 WAIT_TIME=1
 TIMEOUT=10*60
-
-def check_all_ready(applications):
-    for _, app_state in applications.items():
-        for un_name, un_state in app_state.get('units', {}).items():
-            if ("active" in un_state['workload-status']['current']
-                    and "idle" in un_state['juju-status']['current']
-                    and "waiting" not in un_state['workload-status'].get('message')):
-                # unit is ready
-                pass
-            elif ("endpoint" in un_name):
-                # endpoint is always ready
-                pass
-            else:
-                # unit is NOT ready
-                iprint("{} is not ready: {}".format(
-                    un_name,
+# Maximum number of pod logs that are fetched at the same time.
+LOG_CONCURRENCY=16
+# Follow the log of every pod and note when it prints the new URL, instead
+# of fetching the logs every WAIT_TIME seconds (see harness.logs).
+FOLLOW_LOGS=True
+# Failed `juju status` calls: juju erroring out or returning garbage.
+JUJU_ERRORS=(subprocess.CalledProcessError, ValueError)
+# Follow the all-watcher delta stream of the model instead of polling
+# `juju status`, when a delta source is available (see harness.jujuwatch).
+USE_WATCH=True
+# Print the whole status tree once all units are ready.
+DEBUG_STATUS=False
+# Consumers per bundle when deploying; 0 deploys them all as one bundle.
+DEPLOY_SHARD_SIZE=0
+# Maximum number of shards being deployed at the same time.
+DEPLOY_CONCURRENCY=4
+# harness.modelpool.ModelPool to take models from instead of adding and
+# clearing one per benchmark.
+MODEL_POOL=None
+# Leave the model as it is afterwards, for models that harness.sweep manages.
+KEEP_MODEL=False
+
+def unit_ready(name, status):
+    if "endpoint" in name:
+        # endpoint is always ready
+        return True
+    return ("active" in status['workload-status']['current']
+            and "idle" in status['juju-status']['current']
+            and "waiting" not in (status['workload-status'].get('message') or ""))
+
+
+class ReadinessTracker(object):
+    """Which units of a model are ready. A unit that was ready once isn't
+    checked again, so every update only looks at the units still pending."""
+
+    def __init__(self, modelname):
+        self.modelname = modelname
+        self.ready = set()
+        self._progress = None
+
+    def update(self, applications):
+        """Returns the number of units that are not ready yet."""
+        pending = []
+        total = 0
+        for app_state in applications.values():
+            units = app_state.get('units') or {}
+            total += len(units)
+            for un_name, un_state in units.items():
+                if un_name in self.ready:
+                    continue
+                if unit_ready(un_name, un_state):
+                    self.ready.add(un_name)
+                else:
+                    pending.append((un_name, un_state))
+        ready = total - len(pending)
+        if (ready, total) != self._progress:
+            self._progress = (ready, total)
+            if pending:
+                un_name, un_state = pending[0]
+                iprint("{}/{} units of model {} ready, {} is not ready: {}".format(
+                    ready, total, self.modelname, un_name,
                     un_state['workload-status'].get('message', "")))
-                return False
-    iprint(yaml.dump(applications))
-    return True
+            else:
+                iprint("{}/{} units of model {} ready.".format(ready, total, self.modelname))
+        if not pending and DEBUG_STATUS:
+            iprint(yaml.dump(applications))
+        return len(pending)
 
 
 def iprint(*args, **kwargs):
@@ -45,86 +99,137 @@ def oprint(*args, **kwargs):
     print("{}, ".format(datetime.now()), *args, file=sys.stdout, **kwargs)
 
 
-def deploy(num_consumers, prefix, modelname):
-    with open('bundle.yaml') as f:
-        bundle = yaml.load(f)
-    
-    for i in range(0,num_consumers):
+def consumer_bundle(base, prefix, consumers):
+    """`base` with a consumer application related to the endpoint for every
+    number in `consumers`."""
+    bundle = copy.deepcopy(base)
+    relations = bundle["relations"] = list(bundle.get("relations") or [])
+    for i in consumers:
         bundle["applications"]["{}{}".format(prefix, i)] = {
             # sse-consumer-1 is with storage
             # sse-consumer-2 is without storage
             "charm": "cs:~tengu-team/sse-consumer-2",
             "scale": 1,
         }
-        if not bundle.get("relations"):
-            bundle["relations"] = []
-        bundle["relations"].append([
+        relations.append([
             "endpoint:sse-endpoint",
             "{}{}:sse-endpoint".format(prefix, i),
         ])
+    return bundle
 
-    with open("temp-bundle.yaml", "w") as f:
+
+def deploy_bundle(bundle, name, modelname):
+    # One bundle file per model (and shard), so benchmarks of different
+    # models can run at the same time. It's in the working directory, as the
+    # juju snap can't read the host's /tmp, and removed once deployed.
+    with tempfile.NamedTemporaryFile("w", dir=".", prefix="temp-bundle-{}-".format(name), suffix=".yaml") as f:
         yaml.dump(bundle, f, default_flow_style=False)
-    subprocess.check_call(['juju', 'deploy', './temp-bundle.yaml', '-m', modelname])
+        f.flush()
+        subprocess.check_call(['juju', 'deploy', f.name, '-m', modelname])
+
+
+def deploy(num_consumers, prefix, modelname):
+    """Deploy the endpoint and `num_consumers` consumers, as one bundle or
+    in shards of DEPLOY_SHARD_SIZE consumers. Returns the time the last
+    bundle was submitted."""
+    with open('bundle.yaml') as f:
+        base = yaml.safe_load(f)
+
+    if not DEPLOY_SHARD_SIZE or num_consumers <= DEPLOY_SHARD_SIZE:
+        deploy_bundle(consumer_bundle(base, prefix, range(num_consumers)), modelname, modelname)
+        return time.time()
+
+    # The endpoint goes first, so the shards only add consumers and their
+    # relations to it. Every shard still holds the endpoint: Juju keeps an
+    # application that a bundle defines the same way.
+    deploy_bundle(base, modelname, modelname)
+    shards = [range(start, min(start + DEPLOY_SHARD_SIZE, num_consumers))
+              for start in range(0, num_consumers, DEPLOY_SHARD_SIZE)]
+
+    def submit(index):
+        deploy_bundle(consumer_bundle(base, prefix, shards[index]),
+                      "{}-{}".format(modelname, index), modelname)
+        iprint("Submitted shard {}/{} of model {}.".format(index + 1, len(shards), modelname))
+
+    with ThreadPool(min(DEPLOY_CONCURRENCY, len(shards))) as pool:
+        pool.map(submit, range(len(shards)))
+    return time.time()
 
 
 def get_application_pods(prefix, modelname):
     try:
-        output = json.loads(subprocess.check_output(['kubectl', '-n', modelname, 'get', 'pods', '-o', 'json'], universal_newlines=True))
+        # Only get application pods
+        pods = [p.name for p in query.running(modelname, "juju-application")
+                if p.labels["juju-application"].startswith(prefix)]
     except subprocess.CalledProcessError:
         iprint('Failed to get pods of namespace {}.'.format(modelname))
         return []
-    # Only get application pods
-    pods = [p for p in output["items"] if p["metadata"]["labels"].get("juju-application", "").startswith(prefix)]
-    pods = [p for p in pods if p["status"]["phase"] == "Running"]
-    pods = [p["metadata"]['name'] for p in pods]
     return pods
 
 
-def get_num_pods_log(pods, log_snippet, modelname):
-    num_pods_ok = 0
-    for pod in pods:
-        try:
-            output = str(subprocess.check_output(['kubectl', '-n', modelname, 'logs', pod], universal_newlines=True))
-        except subprocess.CalledProcessError:
-            iprint('Failed to get logs of pod {}.'.format(pod))
-            continue
-
-        if log_snippet in output:
-            iprint('Pod {} has "{}" in output.'.format(pod, log_snippet))
-            num_pods_ok = num_pods_ok + 1
-        else:
-            iprint('Pod {} doesn\'t have "{}" in output. Output is "{}".'.format(pod, log_snippet, output.rstrip()))
-    return num_pods_ok
-
-
 def wait_until_pods_log(count, prefix, log_snippet, modelname):
-    while(True):
+    """Returns the LogTracker and the time every pod printed `log_snippet`,
+    or None if that didn't happen within TIMEOUT."""
+    if FOLLOW_LOGS:
+        tracker = logs.LogFollower(log_snippet, modelname)
+    else:
+        tracker = logs.LogTracker(log_snippet, modelname, concurrency=LOG_CONCURRENCY)
+
+    def check():
         pods = get_application_pods(prefix, modelname)
         iprint("Found {}/{} running pods with prefix {}.".format(len(pods), count, prefix))
         if (len(pods) < count):
-            time.sleep(WAIT_TIME)
-            continue
+            # Logs are only checked once every pod runs.
+            return count
 
-        num_pods_ok = get_num_pods_log(pods, log_snippet, modelname)
+        num_pods_ok = tracker.update(pods)
         if num_pods_ok == count:
             iprint("Found {}/{} running pods with prefix {} and log message {}.".format(num_pods_ok, count, prefix, log_snippet))
-            break
         elif num_pods_ok > count:
             iprint("Error: found {}/{} pods with prefix {} and log message {}.".format(num_pods_ok, count, prefix, log_snippet))
             exit(1)
-        else:
-            time.sleep(WAIT_TIME)
-            continue
+        return count - num_pods_ok
+
+    try:
+        finish_time = wait.poll(check, TIMEOUT, WAIT_TIME)
+    finally:
+        if FOLLOW_LOGS:
+            tracker.close()
+    if finish_time is None:
+        iprint("Timed out waiting for {} pods with prefix {} and log message {}.".format(count, prefix, log_snippet))
+    elif FOLLOW_LOGS:
+        # When the last pod printed it, not when that was polled.
+        finish_time = tracker.last_match()
+        overhead.observed(0)
+    return tracker, finish_time
 
 
 def wait_until_ready(modelname):
-    ready = False
-    while not ready:
+    tracker = ReadinessTracker(modelname)
+
+    def check():
+        status = get_status(modelname)
+        return tracker.update(status['applications'])
+
+    cache = jujuwatch.model_cache(modelname) if USE_WATCH else None
+    if cache is not None:
+        # The watch sees every change as it happens, so there is no reason
+        # to wait before the first check.
+        finish_time = cache.wait_for(lambda model: tracker.update(model.applications) <= 0, TIMEOUT)
+    else:
         time.sleep(WAIT_TIME)
-        status = json.loads(subprocess.check_output(
-            ['juju', 'status', '--format', 'json', '-m', modelname], universal_newlines=True))
-        ready = check_all_ready(status['applications'])
+        finish_time = wait.poll(check, TIMEOUT, WAIT_TIME, JUJU_ERRORS)
+    if finish_time is None:
+        iprint("Timed out waiting for the units of model {} to be ready.".format(modelname))
+    return finish_time
+
+
+def get_status(modelname):
+    with overhead.timed("call_time"):
+        output = subprocess.check_output(
+            ['juju', 'status', '--format', 'json', '-m', modelname], universal_newlines=True)
+    with overhead.timed("parse_time"):
+        return json.loads(output)
 
 
 def time_until_ready(num_consumers, prefix, url, message, modelname):
@@ -134,8 +239,12 @@ def time_until_ready(num_consumers, prefix, url, message, modelname):
     }
 
     start_time = time.time()
-    wait_until_pods_log(num_consumers, prefix, url, modelname)
-    finish_time = time.time()
+    with overhead.phase("pods") as phase:
+        tracker, finish_time = wait_until_pods_log(num_consumers, prefix, url, modelname)
+    pods_censored = finish_time is None
+    if pods_censored:
+        # Timed out: all we know is that it takes at least this long.
+        finish_time = time.time()
     elapsed_time = finish_time - start_time
     iprint( '########################################'
             '\n PODS: {}'
@@ -150,9 +259,17 @@ def time_until_ready(num_consumers, prefix, url, message, modelname):
     result['pods']['started'] = start_time
     result['pods']['finish'] = finish_time
     result['pods']['elapsed'] = elapsed_time
-
-    wait_until_ready(modelname)
-    finish_time = time.time()
+    result['pods']['censored'] = pods_censored
+    result['pods'].update(phase.counts)
+    # Juju doesn't replace the pods, so use the time the new url was first
+    # seen in the log of every pod.
+    result['pods']['latencies'] = stats.latency_events('pods', start_time, tracker.matched.values())
+
+    with overhead.phase("juju") as phase:
+        finish_time = wait_until_ready(modelname)
+    juju_censored = finish_time is None
+    if juju_censored:
+        finish_time = time.time()
     elapsed_time = finish_time - start_time
     iprint( '########################################'
             '\n UNITS: {}'
@@ -167,13 +284,14 @@ def time_until_ready(num_consumers, prefix, url, message, modelname):
     result['juju']['started'] = start_time
     result['juju']['finish'] = finish_time
     result['juju']['elapsed'] = elapsed_time
+    result['juju']['censored'] = juju_censored
+    result['juju'].update(phase.counts)
     return result
 
 
 def clear_model(modelname):
     iprint("Clearing model {}".format(modelname))
-    status = json.loads(subprocess.check_output(
-        ['juju', 'status', '--format', 'json', '-m', modelname], universal_newlines=True))
+    status = get_status(modelname)
     applications = status['applications'].keys()
     if applications:
         subprocess.check_call(['juju', 'remove-application', *applications, '-m', modelname])
@@ -183,109 +301,158 @@ def clear_model(modelname):
 
 
 def wait_until_empty(prefix, modelname):
-    start_time = time.time()
+    deadline = time.time() + TIMEOUT
 
-    while True and (time.time()<start_time+TIMEOUT):
-        time.sleep(WAIT_TIME)
-        status = json.loads(subprocess.check_output(
-            ['juju', 'status', '--format', 'json', '-m', modelname], universal_newlines=True))
-        if (not status['applications']) and (not status['machines']):
-            break
-    while True and (time.time()<start_time+TIMEOUT):
-        try:
-            output = json.loads(subprocess.check_output(['kubectl', '-n', modelname, 'get', 'pods', '-o', 'json'], universal_newlines=True))
-        except subprocess.CalledProcessError:
-            iprint('Failed to get pods of namespace {}.'.format(modelname))
-            continue
-        pods = [p for p in output["items"] if p["metadata"]["labels"].get("juju-application", "").startswith(prefix)]
-        pods = [p["metadata"]['name'] for p in pods]
+    def check_model():
+        status = get_status(modelname)
+        return len(status['applications']) + len(status['machines'])
+
+    def check_pods():
+        pods = [p.name for p in query.list_pods(modelname, "juju-application")
+                if p.labels["juju-application"].startswith(prefix)]
         if (len(pods) > 0):
             iprint("Still found {} running pods with prefix {}. Waiting..".format(len(pods), prefix))
-            time.sleep(WAIT_TIME)
-        else:
-            break
+        return len(pods)
+
+    cache = jujuwatch.model_cache(modelname) if USE_WATCH else None
+    if cache is not None:
+        model_empty = cache.wait_for(lambda model: not model.applications and not model.machines, TIMEOUT)
+    else:
+        model_empty = wait.poll(check_model, TIMEOUT, WAIT_TIME, JUJU_ERRORS)
+    if (model_empty is None
+            or wait.poll(check_pods, deadline - time.time(), WAIT_TIME) is None):
+        iprint("Timed out waiting for model {} to be empty.".format(modelname))
+
+
+def add_model(modelname):
+    try:
+        modelpool.add_model(modelname)
+    except subprocess.CalledProcessError as e:
+        # Models are cleared, not destroyed, after a benchmark.
+        if b"already exists" not in e.output:
+            raise
 
 
 def benchmark(num_consumers, modelname):
-    if not os.path.isfile('benchmark.csv'):
-        with open('benchmark.csv', 'a') as f:
-            f.write("model_name;num_consumers;action;event;start;end;elapsed\n")
-        
+    results_store = store.run_store("juju", "benchmark.csv",
+                                    "model_name;num_consumers;action;event;start;end;elapsed;censored;polls;call_time;parse_time;gap")
+
+    progress = checkpoint.Checkpoint(checkpoint.CHECKPOINT, "juju", results_store.run_id)
+    # Iterations are done once their rows are flushed.
+    results_store.checkpoint = progress
 
     prefix = "consumer"
     base_url = "endpoint.example.com"
 
-    subprocess.check_call(['juju', 'add-model', modelname, 'k8s-relations-k8s'])
-    # clear_model()
-    # wait_until_empty(prefix)
-
-    #
-    # Time the deployment of the cluster with X units.
-    deploy(num_consumers, prefix, modelname)
-    result = time_until_ready(num_consumers, prefix, base_url, "Deploy {} consumers".format(num_consumers), modelname)
-
-    with open("benchmark.csv", "a") as f:
-#       f.write("model_name;num_consumers;action;event;start;end;elapsed\n")
-        f.write("{};{};{};{};{};{};{}\n".format(
-            modelname,
-            num_consumers,
-            "deploy",
-            "pods",
-            result['pods']['started'],
-            result['pods']['finish'],
-            result['pods']['elapsed'],
-        ))
-        f.write("{};{};{};{};{};{};{}\n".format(
-            modelname,
-            num_consumers,
-            "deploy",
-            "juju",
-            result['juju']['started'],
-            result['juju']['finish'],
-            result['juju']['elapsed'],
-        ))
-    #
-    # Time that it takes to change the url.
-    for i in range(1, 11):
-        new_url = str(i) + base_url
-        subprocess.check_call([
-            'juju',
-            'config',
-            '-m',
-            modelname,
-            'endpoint',
-            'base-url={}'.format(new_url)])
-        result = time_until_ready(num_consumers, prefix, new_url, "Change {} consumers".format(num_consumers), modelname)
-        with open("benchmark.csv", "a") as f:
-    #       f.write("model_name;num_consumers;action;event;start;end;elapsed\n")
-            f.write("{};{};{};{};{};{};{}\n".format(
-                modelname,
-                num_consumers,
-                "change",
-                "pods",
-                result['pods']['started'],
-                result['pods']['finish'],
-                result['pods']['elapsed'],
-            ))
-            f.write("{};{};{};{};{};{};{}\n".format(
-                modelname,
-                num_consumers,
-                "change",
-                "juju",
-                result['juju']['started'],
-                result['juju']['finish'],
-                result['juju']['elapsed'],
-            ))
-
-    #
-    # Delete model as best as we can
-    clear_model(modelname)
-    wait_until_empty(prefix, modelname)
-
+    if progress.complete(num_consumers):
+        iprint("Skipping {} consumers, finished before.".format(num_consumers))
+        return
+    left_behind = None if KEEP_MODEL else progress.unfinished(num_consumers)
+    if left_behind and MODEL_POOL is not None:
+        iprint("Destroying the model {} of an unfinished run of {} consumers.".format(left_behind, num_consumers))
+        MODEL_POOL.discard(left_behind)
+    elif left_behind:
+        iprint("Cleaning up the unfinished run of {} consumers in {}.".format(num_consumers, left_behind))
+        try:
+            clear_model(left_behind)
+        except JUJU_ERRORS as e:
+            iprint("Failed to clear model {}: {}".format(left_behind, e))
+        else:
+            wait_until_empty(prefix, left_behind)
+    todo = progress.remaining(num_consumers)
 
+    if todo:
+        if MODEL_POOL is not None:
+            modelname = MODEL_POOL.acquire()
+        else:
+            add_model(modelname)
+        progress.start(num_consumers, modelname)
+        # clear_model()
+        # wait_until_empty(prefix)
+
+        #
+        # Time the deployment of the cluster with X units.
+        deploy_start = time.time()
+        submitted = deploy(num_consumers, prefix, modelname)
+        result = time_until_ready(num_consumers, prefix, base_url, "Deploy {} consumers".format(num_consumers), modelname)
+        # Until every bundle was accepted by the controller. The other
+        # events start counting after that.
+        result['submitted'] = {
+            'started': deploy_start,
+            'finish': submitted,
+            'elapsed': submitted - deploy_start,
+        }
 
-for i in range(45, 51, 5):
-    benchmark(i, "k8s-test4-"+ str(i))
+        if 0 in todo:
+            results_store.add(modelname, num_consumers, "deploy", 0, result)
+            results.write_latencies("benchmark-latency.csv", modelname, num_consumers, "deploy", result['pods']['latencies'])
+        #
+        # Time that it takes to change the url.
+        for i in range(1, 11):
+            if i not in todo:
+                continue
+            new_url = str(i) + base_url
+            subprocess.check_call([
+                'juju',
+                'config',
+                '-m',
+                modelname,
+                'endpoint',
+                'base-url={}'.format(new_url)])
+            result = time_until_ready(num_consumers, prefix, new_url, "Change {} consumers".format(num_consumers), modelname)
+            results_store.add(modelname, num_consumers, "change", i, result)
+            results.write_latencies("benchmark-latency.csv", modelname, num_consumers, "change", result['pods']['latencies'])
+
+        #
+        # Delete model as best as we can
+        if MODEL_POOL is not None:
+            MODEL_POOL.release(modelname)
+        elif not KEEP_MODEL:
+            clear_model(modelname)
+            wait_until_empty(prefix, modelname)
+    results_store.flush()
+    progress.clean(num_consumers)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time base-url propagation to consumers related with Juju.")
+    parser.add_argument("--model", default="k8s-test4-{}",
+                        help="name of the model to create, `{}` is replaced by the number of consumers")
+    parser.add_argument("--consumers", type=int, nargs="+", default=list(range(45, 51, 5)))
+    parser.add_argument("--resume", nargs="?", const="latest", metavar="RUN_ID",
+                        help="Continue an interrupted run (the latest one by default), "
+                             "skipping the iterations it finished.")
+    parser.add_argument("--shard-size", type=int, default=DEPLOY_SHARD_SIZE,
+                        help="Consumers per bundle when deploying, 0 for a single bundle.")
+    parser.add_argument("--deploy-concurrency", type=int, default=DEPLOY_CONCURRENCY,
+                        help="Maximum number of bundles deployed at the same time.")
+    parser.add_argument("--model-pool", type=int, default=0, metavar="SIZE",
+                        help="Take models from a pool of SIZE models that are created and destroyed "
+                             "in the background; `{}` in --model is replaced by `pool`.")
+    parser.add_argument("--keep-model", action="store_true",
+                        help="Don't clear the model afterwards.")
+    parser.add_argument("--debug-status", action="store_true",
+                        help="Print the whole status tree once all units are ready.")
+    parser.add_argument("--poll-logs", action="store_true",
+                        help="Fetch the logs every {}s instead of following them.".format(WAIT_TIME))
+    args = parser.parse_args()
+    DEBUG_STATUS = args.debug_status
+    FOLLOW_LOGS = not args.poll_logs
+    DEPLOY_SHARD_SIZE = args.shard_size
+    DEPLOY_CONCURRENCY = args.deploy_concurrency
+    KEEP_MODEL = args.keep_model
+    if args.resume:
+        os.environ["HARNESS_RUN_ID"] = checkpoint.resolve(args.resume, [checkpoint.CHECKPOINT])
+
+    if args.model_pool:
+        MODEL_POOL = modelpool.ModelPool(args.model.format("pool"), args.model_pool)
+    try:
+        for i in args.consumers:
+            benchmark(i, args.model.format(i))
+    finally:
+        if MODEL_POOL is not None:
+            MODEL_POOL.close()
 
 
 #wait_until_empty("consumer", "k8s-test")
@@ -1,6 +1,7 @@
 #!/usr/bin/env bash
-START=2
-END=200
-for ((i=START;i<=END;i++)); do
-    juju deploy ~/juju-build/sse-endpoint-mock enp$i
-done
\ No newline at end of file
+# Deploy the mock endpoints enp$START to enp$END, CONCURRENCY at a time.
+# CONCURRENCY=1 deploys them one after the other.
+START=${START:-2}
+END=${END:-200}
+CONCURRENCY=${CONCURRENCY:-8}
+seq "$START" "$END" | xargs -P "$CONCURRENCY" -I{} juju deploy ~/juju-build/sse-endpoint-mock enp{}
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Base-url propagation without restarts: the consumers mount
+# `sse-consumer-config` as a volume and print the base URL whenever the
+# kubelet updates the file. A change only touches the ConfigMap, so no pod is
+# replaced, and propagation is detected in the logs of the consumers. The
+# consumers check the file every 0.1s, so a change is seen at most 0.1s late
+# on top of the kubelet's sync period.
+#
+import argparse
+import os
+import time
+import sys
+import subprocess
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from harness import checkpoint, logs, manifest, overhead, query, results, stats, store, wait, warmup, watch
+
+
+WAIT_TIME=1
+TIMEOUT=10*60
+# Follow pod events with a list-then-watch cache instead of polling every
+# WAIT_TIME seconds.
+USE_WATCH=True
+# Follow the log of every consumer and note when it prints the new URL,
+# instead of fetching the logs every WAIT_TIME seconds (see harness.logs).
+FOLLOW_LOGS=True
+# How update_base_url changes a deployed benchmark: "apply" the whole
+# manifest again, or "patch" only the ConfigMap.
+UPDATE_MODE="apply"
+# Label every consumer pod has.
+CONSUMER_SELECTOR="tier=consumers"
+# Config and consumer template every benchmark deploys. The base URL is only
+# in the ConfigMap, so the consumers are never restarted.
+MANIFEST = manifest.ConsumerManifest(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deployment.yaml'),
+    config_fields=[("data", "BASE_URL")])
+
+
+def iprint(*args, **kwargs):
+    print("{}: ".format(datetime.now()), *args, file=sys.stderr, **kwargs)
+
+
+def oprint(*args, **kwargs):
+    print("{}, ".format(datetime.now()), *args, file=sys.stdout, **kwargs)
+
+
+def running_consumers(namespace):
+    if USE_WATCH:
+        key, value = CONSUMER_SELECTOR.split("=")
+        return [p.name for p in watch.pod_cache(namespace).pods()
+                if p.phase == "Running" and not p.deleted and p.labels.get(key) == value]
+    return [p.name for p in query.running(namespace, CONSUMER_SELECTOR)]
+
+
+def wait_until_pods_log(count, base_url, namespace, start_time):
+    """Wait until `count` consumers printed `base_url`. Returns the finish
+    time and the time every consumer was seen to print it."""
+    snippet = "BASE_URL: {}".format(base_url)
+    if FOLLOW_LOGS:
+        tracker = logs.LogFollower(snippet, namespace, start=start_time)
+    else:
+        tracker = logs.LogTracker(snippet, namespace, start=start_time)
+
+    def check():
+        num_pods_ok = tracker.update(running_consumers(namespace))
+        if num_pods_ok >= count:
+            iprint("Found {}/{} consumers with log message {}.".format(num_pods_ok, count, snippet))
+        else:
+            iprint("Found only {}/{} consumers with log message {}.".format(num_pods_ok, count, snippet))
+        return count - num_pods_ok
+
+    try:
+        finish_time = wait.poll(check, TIMEOUT, WAIT_TIME)
+    finally:
+        if FOLLOW_LOGS:
+            tracker.close()
+    if finish_time is None:
+        iprint("Timed out waiting for {} consumers with log message {}.".format(count, snippet))
+    elif FOLLOW_LOGS:
+        # When the last consumer printed it, not when that was polled.
+        finish_time = tracker.last_match()
+        overhead.observed(0)
+    return finish_time, tracker.matched
+
+
+def get_pod_timestamps(namespace):
+    try:
+        return list(query.list_pods(namespace, CONSUMER_SELECTOR))
+    except subprocess.CalledProcessError:
+        iprint('Failed to get pods of namespace {}.'.format(namespace))
+        return []
+
+
+def time_until_ready(num_consumers, url, message, namespace, start_time=None):
+    result = {
+        "pods": {},
+        "settled": {},
+    }
+
+    # The change of a running consumer starts when the ConfigMap is changed,
+    # a deploy when the script returns.
+    start_time = time.time() if start_time is None else start_time
+    with overhead.phase("pods") as phase:
+        finish_time, matched = wait_until_pods_log(num_consumers, url, namespace, start_time)
+    pods_censored = finish_time is None
+    if pods_censored:
+        # Timed out: all we know is that it takes at least this long.
+        finish_time = time.time()
+    elapsed_time = finish_time - start_time
+    iprint( '########################################'
+            '\n PODS: {}'
+            '\nStarted at: {}'
+            '\nFinished at: {}'
+            '\nElapsed time: {}'
+            ''.format(
+                message,
+                start_time,
+                finish_time,
+                elapsed_time))
+    result['pods']['started'] = start_time
+    result['pods']['finish'] = finish_time
+    result['pods']['elapsed'] = elapsed_time
+    result['pods']['censored'] = pods_censored
+    result['pods'].update(phase.counts)
+
+    pods = get_pod_timestamps(namespace)
+    result['pods']['timestamps'] = pods
+    replaced = [p for p in pods if p.deleted]
+    if replaced:
+        iprint("{} consumers are being replaced.".format(len(replaced)))
+    # When each consumer was seen to print the new URL: with polled logs,
+    # these are upper bounds.
+    result['pods']['latencies'] = stats.latency_events('pods', start_time, matched.values())
+
+    with overhead.phase("settled") as phase:
+        finish_time = wait_until_settled(namespace)
+    settled_censored = finish_time is None
+    if settled_censored:
+        finish_time = time.time()
+    elapsed_time = finish_time - start_time
+    iprint( '########################################'
+            '\n SETTLED: {}'
+            '\nStarted at: {}'
+            '\nFinished at: {}'
+            '\nElapsed time: {}'
+            ''.format(
+                message,
+                start_time,
+                finish_time,
+                elapsed_time))
+    result['settled']['started'] = start_time
+    result['settled']['finish'] = finish_time
+    result['settled']['elapsed'] = elapsed_time
+    result['settled']['censored'] = settled_censored
+    result['settled'].update(phase.counts)
+
+    return result
+
+
+def wait_until_settled(namespace):
+    if USE_WATCH:
+        finish_time = watch.pod_cache(namespace).wait_for(watch.no_terminating(), TIMEOUT)
+        if finish_time is None:
+            iprint("Timed out waiting for terminating pods.")
+        else:
+            iprint("No terminating pods left!")
+        return finish_time
+
+    def check():
+        pods = [p.name for p in query.list_pods(namespace) if p.deleted]
+        if pods:
+            iprint("Still found {} terminating pods. Waiting..".format(len(pods)))
+        else:
+            iprint("No terminating pods left!")
+        return len(pods)
+
+    finish_time = wait.poll(check, TIMEOUT, WAIT_TIME)
+    if finish_time is None:
+        iprint("Timed out waiting for terminating pods.")
+    return finish_time
+
+
+def remove_deployment(num_consumers, namespace, ignore_not_found=False):
+    manifest.delete(namespace, MANIFEST.render(num_consumers, ""), ignore_not_found)
+
+
+def wait_until_empty(prefix, namespace):
+    if USE_WATCH:
+        finish_time = watch.pod_cache(namespace).wait_for(watch.no_pods_with_prefix(prefix), TIMEOUT)
+    else:
+        def check():
+            pods = [p.name for p in query.list_pods(namespace) if p.name.startswith(prefix)]
+            if pods:
+                iprint("Still found {} running pods with prefix {}. Waiting..".format(len(pods), prefix))
+            return len(pods)
+
+        finish_time = wait.poll(check, TIMEOUT, WAIT_TIME)
+    if finish_time is None:
+        iprint("Timed out waiting for pods with prefix {} to disappear.".format(prefix))
+
+
+def deploy(num_consumers, prefix, namespace, base_url):
+    manifest.apply(namespace, MANIFEST.render(num_consumers, base_url))
+
+
+def update_base_url(num_consumers, prefix, namespace, base_url):
+    if UPDATE_MODE == "patch":
+        manifest.patch(namespace, *MANIFEST.patches(num_consumers, base_url)[0])
+        return
+    manifest.apply(namespace, MANIFEST.render(num_consumers, base_url))
+
+
+def warm_up(namespace):
+    """Pull the images and deploy, change and remove a few consumers without
+    timing them, so the first timed deploy doesn't pay for a cold start."""
+    deployment_name = "sse-consumer"
+    base_url = "warmup.example.com"
+    warmup.prepull(namespace, warmup.images(MANIFEST.render(1, base_url)))
+    deploy(warmup.CONSUMERS, deployment_name, namespace, base_url)
+    time_until_ready(warmup.CONSUMERS, base_url, "Warm-up deploy", namespace)
+    start_time = time.time()
+    update_base_url(warmup.CONSUMERS, deployment_name, namespace, "1" + base_url)
+    time_until_ready(warmup.CONSUMERS, "1" + base_url, "Warm-up change", namespace, start_time)
+    remove_deployment(warmup.CONSUMERS, namespace)
+    wait_until_empty(deployment_name, namespace)
+    wait_until_settled(namespace)
+
+
+def benchmark(num_consumers, namespace):
+    results_store = store.run_store("k8s-volume", "benchmark.csv")
+    progress = checkpoint.Checkpoint(checkpoint.CHECKPOINT, "k8s-volume", results_store.run_id)
+    # Iterations are done once their rows are flushed.
+    results_store.checkpoint = progress
+
+    base_url = "endpoint.example.com"
+
+    deployment_name = "sse-consumer"
+
+    if progress.complete(num_consumers):
+        iprint("Skipping {} consumers, finished before.".format(num_consumers))
+        return
+    left_behind = progress.unfinished(num_consumers)
+    if left_behind:
+        iprint("Cleaning up the unfinished run of {} consumers in {}.".format(num_consumers, left_behind))
+        remove_deployment(num_consumers, left_behind, ignore_not_found=True)
+        wait_until_empty(deployment_name, left_behind)
+    todo = progress.remaining(num_consumers)
+
+    if todo:
+        progress.start(num_consumers, namespace)
+        #
+        # Time the deployment of the cluster with X units.
+        deploy(num_consumers, deployment_name, namespace, base_url)
+
+        result = time_until_ready(num_consumers, base_url, "Deploy {} consumers".format(num_consumers), namespace)
+
+        if 0 in todo:
+            results_store.add(namespace, num_consumers, "deploy", 0, result)
+            results.write_pod_timestamps("benchmark-pods.csv", namespace, num_consumers, "deploy", result['pods']['timestamps'])
+            results.write_latencies("benchmark-latency.csv", namespace, num_consumers, "deploy", result['pods']['latencies'])
+        #
+        # Time that it takes to change the url. The consumers keep running,
+        # so the time includes the change itself.
+        for i in range(1, 11):
+            if i not in todo:
+                continue
+            new_url = str(i) + base_url
+            start_time = time.time()
+            update_base_url(num_consumers, deployment_name, namespace, new_url)
+
+            result = time_until_ready(num_consumers, new_url, "Change {} consumers".format(num_consumers), namespace, start_time)
+            results_store.add(namespace, num_consumers, "change", i, result)
+            results.write_pod_timestamps("benchmark-pods.csv", namespace, num_consumers, "change", result['pods']['timestamps'])
+            results.write_latencies("benchmark-latency.csv", namespace, num_consumers, "change", result['pods']['latencies'])
+
+        #
+        # Delete model as best as we can
+        remove_deployment(num_consumers, namespace)
+        wait_until_empty(deployment_name, namespace)
+    results_store.flush()
+    progress.clean(num_consumers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time base-url propagation to consumers through a ConfigMap volume.")
+    parser.add_argument("--namespace", default="k8s-volume-test")
+    parser.add_argument("--consumers", type=int, nargs="+", default=list(range(5, 56, 5)))
+    parser.add_argument("--update", choices=["apply", "patch"], default=UPDATE_MODE,
+                        help="How to change the base URL of the deployed consumers.")
+    parser.add_argument("--poll-logs", action="store_true",
+                        help="Fetch the logs every {}s instead of following them.".format(WAIT_TIME))
+    parser.add_argument("--warmup", action="store_true",
+                        help="Pull the images and do an untimed deploy and change before timing.")
+    parser.add_argument("--resume", nargs="?", const="latest", metavar="RUN_ID",
+                        help="Continue an interrupted run (the latest one by default), "
+                             "skipping the iterations it finished.")
+    args = parser.parse_args()
+    if args.resume:
+        os.environ["HARNESS_RUN_ID"] = checkpoint.resolve(args.resume, [checkpoint.CHECKPOINT])
+    UPDATE_MODE = args.update
+    FOLLOW_LOGS = not args.poll_logs
+
+    namespace = args.namespace
+
+    if args.warmup:
+        warm_up(namespace)
+
+    for i in args.consumers:
+        benchmark(i, namespace)
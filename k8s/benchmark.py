@@ -3,19 +3,37 @@
 # Copyright © 2019 Ghent University and imec.
 # License is described in `LICENSE` file.
 #
+import argparse
 import os
 import time
-import json
 import sys
-import copy
 import subprocess
 from datetime import datetime
 
-import yaml
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from harness import checkpoint, logs, manifest, overhead, query, results, stats, store, wait, warmup, watch
 
 
 WAIT_TIME=1
 TIMEOUT=10*60
+# Follow pod events with a list-then-watch cache instead of polling every
+# WAIT_TIME seconds.
+USE_WATCH=True
+# Follow the log of every pod in wait_until_pods_log instead of fetching the
+# logs every WAIT_TIME seconds (see harness.logs).
+FOLLOW_LOGS=True
+# How update_base_url changes a deployed benchmark: "apply" the whole
+# manifest again, or "patch" only the fields holding the base URL.
+UPDATE_MODE="apply"
+# How the consumers are deployed: "deployments", one Deployment each, or a
+# single "deployment" or "statefulset" with a replica per consumer. A
+# statefulset updates its pods one at a time (see harness.manifest.TOPOLOGIES).
+TOPOLOGY="deployments"
+# Config and consumer template every benchmark deploys.
+MANIFEST = manifest.ConsumerManifest(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deployment.yaml'),
+    config_fields=[("data", "BASE_URL")],
+    consumer_fields=[("spec", "template", "metadata", "labels", "base-url")])
 
 
 def iprint(*args, **kwargs):
@@ -28,14 +46,11 @@ def oprint(*args, **kwargs):
 
 def get_application_pods(prefix, namespace):
     try:
-        output = json.loads(subprocess.check_output(['kubectl', '-n', namespace, 'get', 'pods', '-o', 'json'], universal_newlines=True))
+        # Only get application pods
+        pods = [p.name for p in query.running(namespace) if p.name.startswith(prefix)]
     except subprocess.CalledProcessError:
         iprint('Failed to get pods of namespace {}.'.format(namespace))
         return []
-    # Only get application pods
-    pods = [p for p in output["items"] if p["metadata"]["name"].startswith(prefix)]
-    pods = [p for p in pods if p["status"]["phase"] == "Running"]
-    pods = [p["metadata"]['name'] for p in pods]
     return pods
 
 
@@ -57,50 +72,63 @@ def get_num_pods_log(pods, log_snippet, namespace):
 
 
 def wait_until_pods_log(count, prefix, base_url, namespace):
-    while(True):
-        try:
-            iprint("getting output")
-            output = str(subprocess.check_output(
-                ['kubectl', '-n', namespace, "logs", "-l", "base-url={}".format(base_url)],
-                universal_newlines=True))
-        except subprocess.CalledProcessError:
-            iprint('Failed to get logs')
-            time.sleep(WAIT_TIME)
-            continue
-
-        num_pods_ok = output.count(base_url)
-
+    if FOLLOW_LOGS:
+        tracker = logs.LogFollower(base_url, namespace)
+    else:
+        tracker = logs.LogTracker(base_url, namespace)
+
+    def check():
+        iprint("getting pods")
+        pods = [p.name for p in query.running(namespace, "base-url={}".format(base_url))]
+        num_pods_ok = tracker.update(pods)
         if num_pods_ok >= count:
             iprint("Found {}/{} running pods with prefix {} and log message {}.".format(num_pods_ok, count, prefix, base_url))
-            break
         else:
             iprint("Found only {}/{} running pods with prefix {} and log message {}.".format(num_pods_ok, count, prefix, base_url))
-            time.sleep(WAIT_TIME)
-            continue
+        return count - num_pods_ok
 
+    try:
+        finish_time = wait.poll(check, TIMEOUT, WAIT_TIME)
+    finally:
+        if FOLLOW_LOGS:
+            tracker.close()
+    if finish_time is not None and FOLLOW_LOGS:
+        # When the last pod printed it, not when that was polled.
+        finish_time = tracker.last_match()
+    return finish_time
 
-def wait_until_running(count, base_url, namespace):
-    while(True):
-        try:
-            iprint("getting output")
-            output = json.loads(subprocess.check_output(
-                ['kubectl', '-n', namespace, "get", "pods", "-l", "base-url={}".format(base_url), "-o", "json"],
-                universal_newlines=True))
-        except subprocess.CalledProcessError:
-            iprint('Failed to get pods')
-            time.sleep(WAIT_TIME)
-            continue
 
-        pods = [p["metadata"]['name'] for p in output["items"] if (p["status"]["phase"] == "Running")]
-        num_pods_ok = len(pods)
+def wait_until_running(count, base_url, namespace):
+    if USE_WATCH:
+        finish_time = watch.pod_cache(namespace).wait_for(
+            watch.running_with_label(count, "base-url", base_url), TIMEOUT)
+        if finish_time is None:
+            iprint("Timed out waiting for {} running pods with `base-url` {}.".format(count, base_url))
+        else:
+            iprint("Found {} running pods with `base-url` {}.".format(count, base_url))
+        return finish_time
 
+    def check():
+        iprint("getting output")
+        num_pods_ok = sum(1 for _ in query.running(namespace, "base-url={}".format(base_url)))
         if num_pods_ok >= count:
             iprint("Found {}/{} running pods with `base-url` {}.".format(num_pods_ok, count, base_url))
-            break
         else:
             iprint("Found only {}/{} running pods with `base-url` {}.".format(num_pods_ok, count, base_url))
-            time.sleep(WAIT_TIME)
-            continue
+        return count - num_pods_ok
+
+    finish_time = wait.poll(check, TIMEOUT, WAIT_TIME)
+    if finish_time is None:
+        iprint("Timed out waiting for {} running pods with `base-url` {}.".format(count, base_url))
+    return finish_time
+
+
+def get_pod_timestamps(namespace):
+    try:
+        return list(query.list_pods(namespace))
+    except subprocess.CalledProcessError:
+        iprint('Failed to get pods of namespace {}.'.format(namespace))
+        return []
 
 
 def time_until_ready(num_consumers, prefix, url, message, namespace):
@@ -110,8 +138,12 @@ def time_until_ready(num_consumers, prefix, url, message, namespace):
     }
 
     start_time = time.time()
-    wait_until_running(num_consumers, url, namespace)
-    finish_time = time.time()
+    with overhead.phase("pods") as phase:
+        finish_time = wait_until_running(num_consumers, url, namespace)
+    pods_censored = finish_time is None
+    if pods_censored:
+        # Timed out: all we know is that it takes at least this long.
+        finish_time = time.time()
     elapsed_time = finish_time - start_time
     iprint( '########################################'
             '\n PODS: {}'
@@ -126,9 +158,28 @@ def time_until_ready(num_consumers, prefix, url, message, namespace):
     result['pods']['started'] = start_time
     result['pods']['finish'] = finish_time
     result['pods']['elapsed'] = elapsed_time
-
-    wait_until_settled(namespace)
-    finish_time = time.time()
+    result['pods']['censored'] = pods_censored
+    result['pods'].update(phase.counts)
+
+    # Server-side timestamps of the new pods, and of the old pods that are
+    # being replaced, as seen when the last new pod is running. These are in
+    # whole seconds, so the latencies count from the second the wait started.
+    # For the old pods, this is when their deletion was requested, not when
+    # they were gone.
+    pods = get_pod_timestamps(namespace)
+    result['pods']['timestamps'] = pods
+    new_pods = [p for p in pods if p.labels.get("base-url") == url]
+    old_pods = [p for p in pods if p.deleted]
+    server_start = query.server_time(start_time)
+    latencies = stats.latency_events('pods', server_start, [p.ready or p.started for p in new_pods])
+    latencies.update(stats.latency_events('deleting', server_start, [p.deleted for p in old_pods]))
+    result['pods']['latencies'] = latencies
+
+    with overhead.phase("settled") as phase:
+        finish_time = wait_until_settled(namespace)
+    settled_censored = finish_time is None
+    if settled_censored:
+        finish_time = time.time()
     elapsed_time = finish_time - start_time
     iprint( '########################################'
             '\n SETTLED: {}'
@@ -143,171 +194,181 @@ def time_until_ready(num_consumers, prefix, url, message, namespace):
     result['settled']['started'] = start_time
     result['settled']['finish'] = finish_time
     result['settled']['elapsed'] = elapsed_time
+    result['settled']['censored'] = settled_censored
+    result['settled'].update(phase.counts)
 
     return result
 
 
 def wait_until_settled(namespace):
-    start_time = time.time()
-
-    while True and (time.time()<start_time+TIMEOUT):
-        try:
-            output = json.loads(subprocess.check_output(['kubectl', '-n', namespace, 'get', 'pods', '-o', 'json'], universal_newlines=True))
-        except subprocess.CalledProcessError:
-            iprint('Failed to get pods of namespace {}.'.format(namespace))
-            continue
-        pods = [p for p in output["items"] if p["metadata"].get("deletionTimestamp")]
-        if (len(pods) > 0):
-            iprint("Still found {} terminating pods. Waiting..".format(len(pods)))
-            time.sleep(WAIT_TIME)
+    if USE_WATCH:
+        finish_time = watch.pod_cache(namespace).wait_for(watch.no_terminating(), TIMEOUT)
+        if finish_time is None:
+            iprint("Timed out waiting for terminating pods.")
         else:
             iprint("No terminating pods left!")
-            break
+        return finish_time
 
-
-def remove_deployment(namespace):
-    subprocess.check_call(['kubectl', '-n', namespace, 'delete', "-f", "temp-deployment.yaml"])
-
-
-def wait_until_empty(prefix, namespace):
-    start_time = time.time()
-
-    while True and (time.time()<start_time+TIMEOUT):
-        try:
-            output = json.loads(subprocess.check_output(['kubectl', '-n', namespace, 'get', 'pods', '-o', 'json'], universal_newlines=True))
-        except subprocess.CalledProcessError:
-            iprint('Failed to get pods of namespace {}.'.format(namespace))
-            continue
-        pods = [p for p in output["items"] if p["metadata"]["name"].startswith(prefix)]
-        pods = [p["metadata"]['name'] for p in pods]
-        if (len(pods) > 0):
-            iprint("Still found {} running pods with prefix {}. Waiting..".format(len(pods), prefix))
-            time.sleep(WAIT_TIME)
+    def check():
+        pods = [p.name for p in query.list_pods(namespace) if p.deleted]
+        if pods:
+            iprint("Still found {} terminating pods. Waiting..".format(len(pods)))
         else:
-            break
-
-
-def deploy(num_consumers, prefix, namespace):
-    with open('deployment.yaml') as f:
-        deployment = yaml.load_all(f)
-        conf = next(deployment)
-        cons_template = next(deployment)
-
-    documents = [conf]
-
-    for i in range(0,num_consumers):
-        cons_name = "sse-consumer-{}".format(i)
-        cons_template["metadata"]["labels"]["app"] = cons_name
-        cons_template["metadata"]["name"] = cons_name
-        cons_template["spec"]["selector"]["matchLabels"]["app"] = cons_name
-        cons_template["spec"]["template"]["metadata"]["labels"]["app"] = cons_name
-        cons_template["spec"]["template"]["spec"]["containers"][0]["name"] = cons_name
-        documents.append(copy.deepcopy(cons_template))
-
-    with open("temp-deployment.yaml", "w") as f:
-        yaml.dump_all(documents, f, default_flow_style=False)
-
-    subprocess.check_call(['kubectl', '-n', namespace, 'apply', "-f", "temp-deployment.yaml"])
-
-
-def update_base_url(prefix, namespace, base_url):
-    documents = []
-    with open('temp-deployment.yaml') as f:
-        deployment = yaml.load_all(f)
-        conf = next(deployment)
-        conf["data"]["BASE_URL"] = base_url
-        documents.append(conf)
+            iprint("No terminating pods left!")
+        return len(pods)
 
-        for doc in deployment:
-            doc['spec']["template"]["metadata"]["labels"]["base-url"] = base_url
-            documents.append(doc)
+    finish_time = wait.poll(check, TIMEOUT, WAIT_TIME)
+    if finish_time is None:
+        iprint("Timed out waiting for terminating pods.")
+    return finish_time
 
-    with open("temp-deployment.yaml", "w") as f:
-        yaml.dump_all(documents, f, default_flow_style=False)
-    subprocess.check_call(['kubectl', '-n', namespace, 'apply', "-f", "temp-deployment.yaml"])    
 
+def remove_deployment(num_consumers, namespace, ignore_not_found=False):
+    manifest.delete(namespace, MANIFEST.render(num_consumers, "", TOPOLOGY), ignore_not_found)
 
-def benchmark(num_consumers, namespace):
-    if not os.path.isfile('benchmark.csv'):
-        with open('benchmark.csv', 'a') as f:
-            f.write("namespace;num_consumers;action;event;start;end;elapsed\n")
-        
-    base_url = "endpoint.example.com"
 
+def wait_until_empty(prefix, namespace):
+    if USE_WATCH:
+        finish_time = watch.pod_cache(namespace).wait_for(watch.no_pods_with_prefix(prefix), TIMEOUT)
+    else:
+        def check():
+            pods = [p.name for p in query.list_pods(namespace) if p.name.startswith(prefix)]
+            if pods:
+                iprint("Still found {} running pods with prefix {}. Waiting..".format(len(pods), prefix))
+            return len(pods)
+
+        finish_time = wait.poll(check, TIMEOUT, WAIT_TIME)
+    if finish_time is None:
+        iprint("Timed out waiting for pods with prefix {} to disappear.".format(prefix))
+
+
+def deploy(num_consumers, prefix, namespace, base_url):
+    manifest.apply(namespace, MANIFEST.render(num_consumers, base_url, TOPOLOGY))
+
+
+def update_base_url(num_consumers, prefix, namespace, base_url):
+    if UPDATE_MODE == "patch":
+        # The config goes first, so consumers restarted by their own patch
+        # read the new value.
+        patches = MANIFEST.patches(num_consumers, base_url, TOPOLOGY)
+        manifest.patch(namespace, *patches[0])
+        manifest.patch_all(namespace, patches[1:])
+        return
+    manifest.apply(namespace, MANIFEST.render(num_consumers, base_url, TOPOLOGY))
+
+
+def warm_up(namespace):
+    """Pull the images and deploy, change and remove a few consumers without
+    timing them, so the first timed deploy doesn't pay for a cold start."""
     deployment_name = "sse-consumer"
-
-    #
-    # Time the deployment of the cluster with X units.
-    deploy(num_consumers, deployment_name, namespace)
-
-    result = time_until_ready(num_consumers, deployment_name, base_url, "Deploy {} consumers".format(num_consumers), namespace)
-
-    with open("benchmark.csv", "a") as f:
-#       f.write("model_name;num_consumers;action;event;start;end;elapsed\n")
-        f.write("{};{};{};{};{};{};{}\n".format(
-            namespace,
-            num_consumers,
-            "deploy",
-            "pods",
-            result['pods']['started'],
-            result['pods']['finish'],
-            result['pods']['elapsed'],
-        ))
-        f.write("{};{};{};{};{};{};{}\n".format(
-            namespace,
-            num_consumers,
-            "deploy",
-            "settled",
-            result['settled']['started'],
-            result['settled']['finish'],
-            result['settled']['elapsed'],
-        ))
-    #
-    # Time that it takes to change the url.
-    for i in range(1, 11):
-        new_url = str(i) + base_url
-        update_base_url(deployment_name, namespace, new_url)
-
-        result = time_until_ready(num_consumers, deployment_name, new_url, "Change {} consumers".format(num_consumers), namespace)
-        with open("benchmark.csv", "a") as f:
-            f.write("{};{};{};{};{};{};{}\n".format(
-                namespace,
-                num_consumers,
-                "change",
-                "pods",
-                result['pods']['started'],
-                result['pods']['finish'],
-                result['pods']['elapsed'],
-            ))
-            f.write("{};{};{};{};{};{};{}\n".format(
-                namespace,
-                num_consumers,
-                "change",
-                "settled",
-                result['settled']['started'],
-                result['settled']['finish'],
-                result['settled']['elapsed'],
-            ))
-
-    #
-    # Delete model as best as we can
-    remove_deployment(namespace)
+    base_url = "warmup.example.com"
+    warmup.prepull(namespace, warmup.images(MANIFEST.render(1, base_url)))
+    deploy(warmup.CONSUMERS, deployment_name, namespace, base_url)
+    time_until_ready(warmup.CONSUMERS, deployment_name, base_url, "Warm-up deploy", namespace)
+    update_base_url(warmup.CONSUMERS, deployment_name, namespace, "1" + base_url)
+    time_until_ready(warmup.CONSUMERS, deployment_name, "1" + base_url, "Warm-up change", namespace)
+    remove_deployment(warmup.CONSUMERS, namespace)
     wait_until_empty(deployment_name, namespace)
+    wait_until_settled(namespace)
 
 
+def backend_name():
+    """The backend of the results, and the CSV they go to: other topologies
+    than the default are kept apart."""
+    if TOPOLOGY == "deployments":
+        return "k8s", "benchmark.csv"
+    return "k8s-{}".format(TOPOLOGY), "benchmark-{}.csv".format(TOPOLOGY)
 
 
+def benchmark(num_consumers, namespace):
+    backend, csv_path = backend_name()
+    results_store = store.run_store(backend, csv_path)
+    progress = checkpoint.Checkpoint(checkpoint.CHECKPOINT, backend, results_store.run_id)
+    # Iterations are done once their rows are flushed.
+    results_store.checkpoint = progress
 
-namespace = "k8s-native-test"
-
-# wait_until_settled("k8s-native-test")
+    base_url = "endpoint.example.com"
 
-for i in range(5, 56, 5):
-    benchmark(i, namespace)
+    deployment_name = "sse-consumer"
 
-# deploy(2, "sse-consumer", "k8s-native-test")
+    if progress.complete(num_consumers):
+        iprint("Skipping {} consumers, finished before.".format(num_consumers))
+        return
+    left_behind = progress.unfinished(num_consumers)
+    if left_behind:
+        iprint("Cleaning up the unfinished run of {} consumers in {}.".format(num_consumers, left_behind))
+        remove_deployment(num_consumers, left_behind, ignore_not_found=True)
+        wait_until_empty(deployment_name, left_behind)
+    todo = progress.remaining(num_consumers)
+
+    if todo:
+        progress.start(num_consumers, namespace)
+        #
+        # Time the deployment of the cluster with X units.
+        deploy(num_consumers, deployment_name, namespace, base_url)
+
+        result = time_until_ready(num_consumers, deployment_name, base_url, "Deploy {} consumers".format(num_consumers), namespace)
+
+        if 0 in todo:
+            results_store.add(namespace, num_consumers, "deploy", 0, result)
+            results.write_pod_timestamps("benchmark-pods.csv", namespace, num_consumers, "deploy", result['pods']['timestamps'])
+            results.write_latencies("benchmark-latency.csv", namespace, num_consumers, "deploy", result['pods']['latencies'])
+        #
+        # Time that it takes to change the url.
+        for i in range(1, 11):
+            if i not in todo:
+                continue
+            new_url = str(i) + base_url
+            update_base_url(num_consumers, deployment_name, namespace, new_url)
+
+            result = time_until_ready(num_consumers, deployment_name, new_url, "Change {} consumers".format(num_consumers), namespace)
+            results_store.add(namespace, num_consumers, "change", i, result)
+            results.write_pod_timestamps("benchmark-pods.csv", namespace, num_consumers, "change", result['pods']['timestamps'])
+            results.write_latencies("benchmark-latency.csv", namespace, num_consumers, "change", result['pods']['latencies'])
+
+        #
+        # Delete model as best as we can
+        remove_deployment(num_consumers, namespace)
+        wait_until_empty(deployment_name, namespace)
+    results_store.flush()
+    progress.clean(num_consumers)
+
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time base-url propagation to consumers in plain Kubernetes.")
+    parser.add_argument("--namespace", default="k8s-native-test")
+    parser.add_argument("--consumers", type=int, nargs="+", default=list(range(5, 56, 5)))
+    parser.add_argument("--update", choices=["apply", "patch"], default=UPDATE_MODE,
+                        help="How to change the base URL of the deployed consumers.")
+    parser.add_argument("--topology", choices=sorted(manifest.TOPOLOGIES), default=TOPOLOGY,
+                        help="One Deployment per consumer, or one object with a replica per consumer.")
+    parser.add_argument("--warmup", action="store_true",
+                        help="Pull the images and do an untimed deploy and change before timing.")
+    parser.add_argument("--resume", nargs="?", const="latest", metavar="RUN_ID",
+                        help="Continue an interrupted run (the latest one by default), "
+                             "skipping the iterations it finished.")
+    args = parser.parse_args()
+    if args.resume:
+        os.environ["HARNESS_RUN_ID"] = checkpoint.resolve(args.resume, [checkpoint.CHECKPOINT])
+    UPDATE_MODE = args.update
+    TOPOLOGY = args.topology
+
+    namespace = args.namespace
+
+    # wait_until_settled("k8s-native-test")
+
+    if args.warmup:
+        warm_up(namespace)
+
+    for i in args.consumers:
+        benchmark(i, namespace)
+
+# deploy(2, "sse-consumer", "k8s-native-test", "endpoint.example.com")
 # wait_until_running(2, "endpoint.example.com", "k8s-native-test")
-# remove_deployment("k8s-native-test")
+# remove_deployment(2, "k8s-native-test")
 
 
 # wait_until_pods_log(60, "sse-consumer", "4endpoint.example.com", namespace)
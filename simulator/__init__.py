@@ -0,0 +1,6 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# A local stand-in for kubectl, helm and juju, see README.md.
+#
@@ -0,0 +1,135 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# The simulated cluster served over HTTP, like `kubectl proxy` serves a real
+# one, for the harness's HTTP transport:
+#
+#     python3 -m simulator.apiserver --port 8001 &
+#     export KUBE_API_SERVER=http://127.0.0.1:8001
+#
+# Connections are kept alive, and the number of connections and requests is
+# printed on exit so pooling can be checked.
+#
+import argparse
+import json
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from simulator import cluster
+from simulator.state import State, load_config
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "simulator"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super(Handler, self).setup()
+        self.server.count("connections")
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(Handler, self).log_message(format, *args)
+
+    def send_body(self, status, body, content_type):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_status(self, error):
+        self.send_body(error.code, json.dumps(error.status()), "application/json")
+
+    def send_stream(self, lines):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for line in lines:
+                data = (line if line.endswith("\n") else line + "\n").encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+    def do_GET(self):
+        self.server.count("requests")
+        try:
+            result = cluster.handle_get(State.read, self.path, time.time(), self.server.interval)
+        except cluster.ApiError as e:
+            self.send_error_status(e)
+            return
+        if isinstance(result, dict):
+            self.send_body(200, json.dumps(result), "application/json")
+        elif isinstance(result, str):
+            self.send_body(200, result, "text/plain")
+        else:
+            self.send_stream(result)
+
+    def do_PATCH(self):
+        self.server.count("requests")
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        parts = [p for p in self.path.split("?")[0].split("/") if p]
+        try:
+            # /api/v1/namespaces/{ns}/{plural}/{name} or
+            # /apis/{group}/{version}/namespaces/{ns}/{plural}/{name}
+            if len(parts) not in (6, 7) or parts[-4] != "namespaces":
+                raise cluster.ApiError(404, "NotFound", "the server could not find the requested resource")
+            ns_name, plural, name = parts[-3:]
+            kind = cluster.kind_of(plural)
+            now = time.time()
+            with State.locked() as state:
+                cluster.collect_garbage(state, now)
+                cluster.patch(state, ns_name, kind, name, body, now)
+                obj = cluster.get_object(state, ns_name, kind, name)
+        except cluster.ApiError as e:
+            self.send_error_status(e)
+            return
+        self.send_body(200, json.dumps(obj), "application/json")
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, verbose=False):
+        super(Server, self).__init__(address, Handler)
+        self.interval = load_config()["watch_interval"]
+        self.verbose = verbose
+        self.counts = {"connections": 0, "requests": 0}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Serve the simulated cluster over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--verbose", action="store_true", help="Log every request.")
+    args = parser.parse_args(args)
+
+    server = Server((args.host, args.port), args.verbose)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print("Serving the simulated cluster on http://{}:{}".format(args.host, server.server_port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("{connections} connections, {requests} requests".format(**server.counts), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,694 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# The simulated Kubernetes API: namespaced objects, the controllers that turn
+# Deployments into pods and the read side (pod lists, watches and logs).
+#
+# A pod is stored as a record with the time of each of its transitions, so
+# `materialize(record, t)` gives the pod as the API server would return it at
+# time `t`. Resource versions are those times in microseconds, which makes a
+# watch from any resourceVersion a replay of the same records.
+#
+import base64
+import copy
+import hashlib
+import json
+import math
+import re
+import time
+from urllib.parse import urlparse, parse_qs
+
+from simulator.state import rfc3339, rfc3339_nano, parse_rfc3339
+
+
+# Removed pods are forgotten after this many seconds.
+RETENTION=15*60
+
+
+class ApiError(Exception):
+    def __init__(self, code, reason, message):
+        super(ApiError, self).__init__(message)
+        self.code = code
+        self.reason = reason
+        self.message = message
+
+    def status(self):
+        return {
+            "kind": "Status",
+            "apiVersion": "v1",
+            "status": "Failure",
+            "message": self.message,
+            "reason": self.reason,
+            "code": self.code,
+        }
+
+
+def not_found(kind, name):
+    return ApiError(404, "NotFound", '{} "{}" not found'.format(kind, name))
+
+
+#
+# Namespaces and objects.
+def namespace(state, name, create=False):
+    namespaces = state.data["namespaces"]
+    if name not in namespaces:
+        if not create:
+            raise not_found("namespaces", name)
+        namespaces[name] = {"objects": {}, "pods": {}}
+    return namespaces[name]
+
+
+def create_namespace(state, name):
+    if name in state.data["namespaces"]:
+        raise ApiError(409, "AlreadyExists", 'namespaces "{}" already exists'.format(name))
+    namespace(state, name, create=True)
+
+
+def delete_namespace(state, name, now):
+    ns = namespace(state, name)
+    for kind in list(ns["objects"]):
+        for obj_name in list(ns["objects"][kind]):
+            delete(state, name, kind, obj_name, now)
+    for record in ns["pods"].values():
+        delete_pod(state, record, now)
+    ns["deleted"] = now
+
+
+def get_object(state, ns_name, kind, name):
+    return namespace(state, ns_name)["objects"].get(kind, {}).get(name)
+
+
+def apply(state, ns_name, obj, now):
+    """Create or update `obj`. Returns "created", "configured" or "unchanged"."""
+    ns = namespace(state, ns_name, create=True)
+    kind = obj["kind"]
+    name = obj["metadata"]["name"]
+    objects = ns["objects"].setdefault(kind, {})
+    old = objects.get(name)
+    if old == obj:
+        return "unchanged"
+    objects[name] = obj
+    if kind in CONTROLLERS:
+        reconcile(state, ns_name, kind, name, now)
+    if kind == "Service":
+        service_changed(state, ns_name, old, obj, now)
+    if kind == "ConfigMap":
+        configmap_changed(state, ns_name, old, obj, now)
+    return "created" if old is None else "configured"
+
+
+def delete(state, ns_name, kind, name, now):
+    ns = namespace(state, ns_name)
+    objects = ns["objects"].get(kind, {})
+    if name not in objects:
+        raise not_found(resource_name(kind), name)
+    del objects[name]
+    for record in ns["pods"].values():
+        if record["owner"] == [kind, name]:
+            delete_pod(state, record, now)
+
+
+def patch(state, ns_name, kind, name, body, now):
+    """Apply a merge patch to an existing object. For the maps the benchmarks
+    patch, strategic merge and JSON merge patches are the same."""
+    obj = get_object(state, ns_name, kind, name)
+    if obj is None:
+        raise not_found(resource_name(kind), name)
+    return apply(state, ns_name, merge_patch(copy.deepcopy(obj), body), now)
+
+
+def merge_patch(target, body):
+    for key, value in body.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+def kind_of(resource):
+    resource = resource.split(".")[0].lower()
+    for kind in KINDS:
+        if resource in (kind.lower(), kind.lower() + "s", resource_name(kind).split(".")[0]):
+            return kind
+    raise ApiError(404, "NotFound", 'the server doesn\'t have a resource type "{}"'.format(resource))
+
+
+KINDS = ("ConfigMap", "Service", "Deployment", "StatefulSet", "DaemonSet", "Secret")
+
+
+def resource_name(kind):
+    return {
+        "ConfigMap": "configmaps",
+        "Service": "services",
+        "Deployment": "deployments.apps",
+        "StatefulSet": "statefulsets.apps",
+        "DaemonSet": "daemonsets.apps",
+        "Secret": "secrets",
+    }.get(kind, kind.lower() + "s")
+
+
+#
+# Controllers.
+CONTROLLERS = ("Deployment", "StatefulSet", "DaemonSet")
+
+
+def template_hash(template):
+    return hashlib.sha1(json.dumps(template, sort_keys=True).encode()).hexdigest()[:10]
+
+
+def owned_pods(ns, kind, name):
+    return [r for r in ns["pods"].values() if r["owner"] == [kind, name]]
+
+
+def reconcile(state, ns_name, kind, name, now, restart_at=None):
+    """Roll the pods of a controller to its current template. With
+    `restart_at`, all pods are replaced from that moment on, even if the
+    template didn't change."""
+    ns = namespace(state, ns_name)
+    obj = ns["objects"][kind][name]
+    template = obj["spec"]["template"]
+    digest = template_hash(template)
+    start = (restart_at or now) + state.sample("controller")
+    replicas = obj["spec"].get("replicas", 1)
+
+    live = sorted((r for r in owned_pods(ns, kind, name) if r["deleting"] is None),
+                  key=lambda r: r["created"])
+    current = [r for r in live if r["hash"] == digest and restart_at is None]
+    outdated = [r for r in live if r not in current]
+
+    for record in current[replicas:]:
+        delete_pod(state, record, start)
+
+    # Replace pods in waves of maxSurge (25%); a wave starts when the
+    # previous one is running.
+    surge = max(1, int(math.ceil(replicas * 0.25)))
+    new = []
+    created = start
+    for i in range(max(0, replicas - len(current))):
+        if i and i % surge == 0:
+            created = max(r["started"] for r in new[-surge:])
+        if kind == "StatefulSet":
+            pod_name = "{}-{}".format(name, i)
+        else:
+            pod_name = "{}-{}-{}".format(name, digest, base36(state.unique()))
+        new.append(create_pod(state, ns_name, pod_name, [kind, name], digest, template, created))
+
+    for i, record in enumerate(outdated):
+        delete_pod(state, record, new[i]["started"] if i < len(new) else start)
+
+
+def controller_status(state, ns_name, kind, name, now):
+    """The status of a controller at `now`, counted from its pods. The
+    simulated cluster has one node, so a DaemonSet wants `replicas` pods
+    like the other controllers do."""
+    ns = namespace(state, ns_name)
+    obj = ns["objects"][kind][name]
+    digest = template_hash(obj["spec"]["template"])
+    desired = obj["spec"].get("replicas", 1)
+    pods = []
+    for record in owned_pods(ns, kind, name):
+        if record["deleting"] is not None and record["deleting"] <= now:
+            continue
+        pod = materialize(ns_name, record, now)
+        if pod is not None:
+            pods.append((record, pod))
+    ready = sum(1 for _, pod in pods if pod["status"]["phase"] == "Running")
+    updated = sum(1 for record, _ in pods if record["hash"] == digest)
+    if kind == "DaemonSet":
+        return {
+            "desiredNumberScheduled": desired,
+            "currentNumberScheduled": len(pods),
+            "updatedNumberScheduled": updated,
+            "numberReady": ready,
+        }
+    return {"replicas": len(pods), "updatedReplicas": updated, "readyReplicas": ready}
+
+
+def base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while True:
+        number, rem = divmod(number, 36)
+        result = digits[rem] + result
+        if not number:
+            return result.rjust(5, "0")
+
+
+def service_changed(state, ns_name, old, new, now):
+    """The orcon operator restarts the consumers of a provided service when
+    its relation data changes."""
+    if old is None or "tengu.io/provides" not in new["metadata"].get("labels", {}):
+        return
+    if old.get("spec") == new.get("spec"):
+        return
+    name = new["metadata"]["name"]
+    ns = namespace(state, ns_name)
+    for dep_name, dep in ns["objects"].get("Deployment", {}).items():
+        labels = dep["spec"]["template"]["metadata"].get("labels", {})
+        if name in labels.get("tengu.io/relations", "").split(","):
+            reconcile(state, ns_name, "Deployment", dep_name, now,
+                      restart_at=now + state.sample("propagation"))
+
+
+def configmap_changed(state, ns_name, old, new, now):
+    """The kubelet updates the files of a mounted ConfigMap after its sync
+    delay, without restarting the pod; containers that mount it print their
+    `echo` again, like a consumer that watches the file."""
+    if old is None or old.get("data") == new.get("data"):
+        return
+    name = new["metadata"]["name"]
+    for record in namespace(state, ns_name)["pods"].values():
+        volumes = [v for v, ref in mounted_configmaps(record["spec"]).items() if ref == name]
+        if record["deleting"] is not None or not volumes:
+            continue
+        at = max(record["started"], now + state.sample("volume_sync"))
+        env = volume_env(state, ns_name, record["spec"])
+        for container in record["spec"].get("containers", []):
+            if not any(m["name"] in volumes for m in container.get("volumeMounts", [])):
+                continue
+            container_vars = container_env(state, ns_name, container)
+            container_vars.update(env)
+            record["logs"].extend([at, line] for line in echoed_lines(container, container_vars))
+        record["logs"].sort(key=lambda entry: entry[0])
+
+
+#
+# Pods.
+def orcon_relations(state, ns_name, labels):
+    """Relation data the orcon webhook injects into a consumer pod."""
+    env = {}
+    if "tengu.io/consumes" not in labels:
+        return env
+    for service in labels.get("tengu.io/relations", "").split(","):
+        obj = get_object(state, ns_name, "Service", service)
+        if obj:
+            env["BASE_URL"] = obj["spec"].get("externalName", "")
+    return env
+
+
+def container_env(state, ns_name, container):
+    env = {}
+    for source in container.get("envFrom", []):
+        ref = source.get("configMapRef")
+        if ref:
+            configmap = get_object(state, ns_name, "ConfigMap", ref["name"]) or {}
+            env.update(configmap.get("data", {}))
+    for var in container.get("env", []):
+        if "value" in var:
+            env[var["name"]] = var["value"]
+    return env
+
+
+def mounted_configmaps(spec):
+    """Volume name to the name of the ConfigMap it mounts."""
+    return {v["name"]: v["configMap"]["name"] for v in spec.get("volumes", []) if "configMap" in v}
+
+
+def volume_env(state, ns_name, spec):
+    """The files of mounted ConfigMaps, as variables of the same name."""
+    env = {}
+    for configmap in mounted_configmaps(spec).values():
+        env.update((get_object(state, ns_name, "ConfigMap", configmap) or {}).get("data", {}))
+    return env
+
+
+def echoed_lines(container, env):
+    """Lines a `bash -c "echo ...; sleep infinity"` style container prints."""
+    script = " ".join(container.get("command", []) + container.get("args", []))
+    lines = []
+    for match in re.finditer(r'echo ([^;]*)', script):
+        lines.append(re.sub(r'\$(\w+)', lambda m: env.get(m.group(1), ""), match.group(1)).strip())
+    return lines
+
+
+def create_pod(state, ns_name, name, owner, digest, template, created):
+    spec = copy.deepcopy(template.get("spec", {}))
+    labels = dict(template.get("metadata", {}).get("labels", {}))
+    relations = orcon_relations(state, ns_name, labels)
+    if relations:
+        labels.update(relations)
+        if state.config.get("orcon_init", True):
+            spec.setdefault("initContainers", []).append({"name": "orcon-init", "image": "orcon-init"})
+
+    scheduled = created + state.sample("schedule")
+    init = None
+    ready_for_start = scheduled
+    if spec.get("initContainers"):
+        init = [scheduled, scheduled + state.sample("init")]
+        ready_for_start = init[1]
+    started = ready_for_start + state.sample("startup")
+
+    logs = []
+    for container in spec.get("containers", []):
+        env = container_env(state, ns_name, container)
+        env.update(volume_env(state, ns_name, spec))
+        env.update(relations)
+        logs.extend([started, line] for line in echoed_lines(container, env))
+
+    record = {
+        "name": name,
+        "labels": labels,
+        "owner": owner,
+        "hash": digest,
+        "spec": spec,
+        "created": created,
+        "scheduled": scheduled,
+        "init": init,
+        "started": started,
+        "deleting": None,
+        "grace": spec.get("terminationGracePeriodSeconds", 30),
+        "removed": None,
+        "logs": logs,
+    }
+    namespace(state, ns_name)["pods"][name] = record
+    return record
+
+
+def add_pod(state, ns_name, name, labels, owner, created, started, logs=None):
+    """Add a pod that isn't managed by a controller, such as a Juju unit."""
+    record = {
+        "name": name,
+        "labels": labels,
+        "owner": owner,
+        "hash": None,
+        "spec": {"containers": [{"name": name}]},
+        "created": created,
+        "scheduled": created,
+        "init": None,
+        "started": started,
+        "deleting": None,
+        "grace": 30,
+        "removed": None,
+        "logs": logs or [],
+    }
+    namespace(state, ns_name, create=True)["pods"][name] = record
+    return record
+
+
+def delete_pod(state, record, at):
+    if record["deleting"] is not None and record["deleting"] <= at:
+        return
+    record["deleting"] = at
+    if record["created"] >= at:
+        # Deleted before it was ever created.
+        record["removed"] = at
+    else:
+        record["removed"] = at + state.sample("termination")
+
+
+def collect_garbage(state, now):
+    for name, ns in list(state.data["namespaces"].items()):
+        for pod_name, record in list(ns["pods"].items()):
+            if record["removed"] is not None and record["removed"] < now - RETENTION:
+                del ns["pods"][pod_name]
+        if ns.get("deleted") is not None and not ns["pods"]:
+            del state.data["namespaces"][name]
+
+
+def transitions(record):
+    times = [record["created"], record["scheduled"], record["started"], record["deleting"]]
+    if record["init"]:
+        times.extend(record["init"])
+    return [t for t in times if t is not None]
+
+
+def resource_version(t):
+    return str(int(t * 1000000))
+
+
+def materialize(ns_name, record, t):
+    """The pod of `record` as it is at time `t`, or None if it doesn't exist."""
+    if t < record["created"] or (record["removed"] is not None and t >= record["removed"]):
+        return None
+    metadata = {
+        "name": record["name"],
+        "namespace": ns_name,
+        "labels": dict(record["labels"]),
+        "creationTimestamp": rfc3339(record["created"]),
+        "resourceVersion": resource_version(max(x for x in transitions(record) if x <= t)),
+    }
+    if record["deleting"] is not None and record["deleting"] <= t:
+        metadata["deletionTimestamp"] = rfc3339(record["deleting"] + record["grace"])
+        metadata["deletionGracePeriodSeconds"] = record["grace"]
+
+    def condition(kind, since):
+        reached = since is not None and since <= t
+        result = {"type": kind, "status": "True" if reached else "False"}
+        if reached:
+            result["lastTransitionTime"] = rfc3339(since)
+        return result
+
+    initialized = record["init"][1] if record["init"] else record["scheduled"]
+    running = record["started"] <= t
+    status = {
+        "phase": "Running" if running else "Pending",
+        "conditions": [
+            condition("PodScheduled", record["scheduled"]),
+            condition("Initialized", initialized),
+            condition("ContainersReady", record["started"]),
+            condition("Ready", record["started"]),
+        ],
+        "containerStatuses": [
+            {
+                "name": c["name"],
+                "ready": running,
+                "state": ({"running": {"startedAt": rfc3339(record["started"])}} if running
+                          else {"waiting": {"reason": "PodInitializing" if record["init"] else "ContainerCreating"}}),
+            }
+            for c in record["spec"].get("containers", [])
+        ],
+    }
+    if record["init"]:
+        init_start, init_finish = record["init"]
+        if t >= init_finish:
+            state = {"terminated": {"startedAt": rfc3339(init_start), "finishedAt": rfc3339(init_finish),
+                                    "exitCode": 0, "reason": "Completed"}}
+        elif t >= init_start:
+            state = {"running": {"startedAt": rfc3339(init_start)}}
+        else:
+            state = {"waiting": {"reason": "PodInitializing"}}
+        status["initContainerStatuses"] = [
+            {"name": c["name"], "state": state} for c in record["spec"]["initContainers"]]
+    return {
+        "kind": "Pod",
+        "apiVersion": "v1",
+        "metadata": metadata,
+        "spec": record["spec"],
+        "status": status,
+    }
+
+
+#
+# Selectors.
+def parse_selector(selector):
+    terms = []
+    for term in filter(None, (s.strip() for s in (selector or "").split(","))):
+        if "!=" in term:
+            key, value = term.split("!=", 1)
+            terms.append((key.strip(), "!=", value.strip()))
+        elif "==" in term or "=" in term:
+            key, value = re.split("==?", term, 1)
+            terms.append((key.strip(), "=", value.strip()))
+        elif term.startswith("!"):
+            terms.append((term[1:], "!", None))
+        else:
+            terms.append((term, "exists", None))
+    return terms
+
+
+def matches(values, terms):
+    for key, op, value in terms:
+        if op == "=" and values.get(key) != value:
+            return False
+        if op == "!=" and values.get(key) == value:
+            return False
+        if op == "exists" and key not in values:
+            return False
+        if op == "!" and key in values:
+            return False
+    return True
+
+
+def pod_fields(pod):
+    return {
+        "metadata.name": pod["metadata"]["name"],
+        "metadata.namespace": pod["metadata"]["namespace"],
+        "status.phase": pod["status"]["phase"],
+    }
+
+
+def pods_at(state, ns_name, t, label_selector=None, field_selector=None):
+    ns = state.data["namespaces"].get(ns_name, {"pods": {}})
+    labels = parse_selector(label_selector)
+    fields = parse_selector(field_selector)
+    result = []
+    for record in ns["pods"].values():
+        pod = materialize(ns_name, record, t)
+        if pod and matches(pod["metadata"]["labels"], labels) and matches(pod_fields(pod), fields):
+            result.append(pod)
+    return sorted(result, key=lambda p: p["metadata"]["name"])
+
+
+#
+# Read API, shared by `kubectl get --raw` and the HTTP API server.
+def list_pods(state, ns_name, query, now):
+    token = query.get("continue")
+    if token:
+        token = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+        t, after = token["t"], token["after"]
+    else:
+        t, after = now, None
+    pods = pods_at(state, ns_name, t, query.get("labelSelector"), query.get("fieldSelector"))
+    if after is not None:
+        pods = [p for p in pods if p["metadata"]["name"] > after]
+    metadata = {"resourceVersion": resource_version(t)}
+    limit = int(query.get("limit") or 0)
+    if limit and len(pods) > limit:
+        pods = pods[:limit]
+        metadata["continue"] = base64.urlsafe_b64encode(json.dumps(
+            {"t": t, "after": pods[-1]["metadata"]["name"]}).encode()).decode()
+        metadata["remainingItemCount"] = 0
+    return {"kind": "PodList", "apiVersion": "v1", "metadata": metadata, "items": pods}
+
+
+def watch_pods(read_state, ns_name, query, interval):
+    """Yield watch events as JSON lines, forever. `read_state` returns the
+    latest state."""
+    since = query.get("resourceVersion")
+    t = int(since) / 1000000.0 if since else time.time()
+    labels, fields = query.get("labelSelector"), query.get("fieldSelector")
+    previous = {p["metadata"]["name"]: p for p in pods_at(read_state(), ns_name, t, labels, fields)}
+    if not since:
+        for pod in previous.values():
+            yield json.dumps({"type": "ADDED", "object": pod})
+    while True:
+        time.sleep(interval)
+        now = time.time()
+        state = read_state()
+        current = {p["metadata"]["name"]: p for p in pods_at(state, ns_name, now, labels, fields)}
+        events = []
+        for name, pod in current.items():
+            if name not in previous:
+                events.append(("ADDED", pod))
+            elif pod["metadata"]["resourceVersion"] != previous[name]["metadata"]["resourceVersion"]:
+                events.append(("MODIFIED", pod))
+        for name, pod in previous.items():
+            if name not in current:
+                record = state.data["namespaces"].get(ns_name, {"pods": {}})["pods"].get(name)
+                removed = record["removed"] if record and record["removed"] else now
+                pod = copy.deepcopy(pod)
+                pod["metadata"]["resourceVersion"] = resource_version(removed)
+                events.append(("DELETED", pod))
+        events.sort(key=lambda e: int(e[1]["metadata"]["resourceVersion"]))
+        for kind, pod in events:
+            yield json.dumps({"type": kind, "object": pod})
+        previous = current
+
+
+def pod_record(state, ns_name, name):
+    record = state.data["namespaces"].get(ns_name, {"pods": {}})["pods"].get(name)
+    if record is None:
+        raise not_found("pods", name)
+    return record
+
+
+def log_line(t, line, timestamps):
+    return "{} {}\n".format(rfc3339_nano(t), line) if timestamps else line + "\n"
+
+
+def pod_log(state, ns_name, name, now, since=None, tail=None, timestamps=False):
+    record = pod_record(state, ns_name, name)
+    if materialize(ns_name, record, now) is None:
+        raise not_found("pods", name)
+    if record["started"] > now:
+        raise ApiError(400, "BadRequest", 'container "{}" in pod "{}" is waiting to start: ContainerCreating'.format(
+            record["spec"]["containers"][0]["name"], name))
+    lines = [(t, line) for t, line in record["logs"] if t <= now and (since is None or t >= since)]
+    if tail is not None and tail >= 0:
+        lines = lines[len(lines) - tail:] if tail else []
+    return "".join(log_line(t, line, timestamps) for t, line in lines)
+
+
+def follow_log(read_state, ns_name, name, interval, since=None, timestamps=False):
+    """Yield the log lines of a pod as they are written, until it is gone."""
+    sent = 0
+    while True:
+        now = time.time()
+        state = read_state()
+        record = pod_record(state, ns_name, name)
+        lines = [(t, line) for t, line in record["logs"] if t <= now and (since is None or t >= since)]
+        for t, line in lines[sent:]:
+            yield log_line(t, line, timestamps)
+        sent = len(lines)
+        if materialize(ns_name, record, now) is None:
+            return
+        time.sleep(interval)
+
+
+def parse_since(value):
+    return parse_rfc3339(value) if value else None
+
+
+def node_list(config):
+    """The configured nodes, with what harness.store records of them."""
+    items = []
+    for node in config.get("nodes", []):
+        items.append({
+            "apiVersion": "v1",
+            "kind": "Node",
+            "metadata": {"name": node["name"]},
+            "status": {
+                "capacity": {"cpu": node.get("cpu"), "memory": node.get("memory")},
+                "nodeInfo": {
+                    "kubeletVersion": node.get("kubelet", "v1.20.0-sim"),
+                    "containerRuntimeVersion": node.get("runtime", "simulator://1"),
+                    "osImage": node.get("os", "Simulated Linux"),
+                },
+            },
+        })
+    return {"kind": "NodeList", "apiVersion": "v1", "metadata": {"resourceVersion": ""}, "items": items}
+
+
+def handle_get(read_state, path, now, interval):
+    """Serve a GET of the API. Returns a dict, a string, or a generator of
+    strings for streaming responses."""
+    url = urlparse(path)
+    query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+    parts = [p for p in url.path.split("/") if p]
+    if parts == ["api", "v1", "nodes"]:
+        return node_list(read_state().config)
+    if parts[:3] == ["apis", "apps", "v1"] and len(parts) == 7 and parts[3] == "namespaces":
+        # /apis/apps/v1/namespaces/{ns}/{plural}/{name}
+        state = read_state()
+        ns_name, plural, name = parts[4:]
+        kind = kind_of(plural)
+        obj = get_object(state, ns_name, kind, name)
+        if kind not in CONTROLLERS or obj is None:
+            raise not_found(plural, name)
+        return dict(obj, status=controller_status(state, ns_name, kind, name, now))
+    if parts[:3] != ["api", "v1", "namespaces"] or len(parts) < 5 or parts[4] != "pods":
+        raise ApiError(404, "NotFound", "the server could not find the requested resource")
+    ns_name = parts[3]
+    if len(parts) == 5:
+        if query.get("watch") in ("1", "true"):
+            return watch_pods(read_state, ns_name, query, interval)
+        return list_pods(read_state(), ns_name, query, now)
+    name = parts[5]
+    if len(parts) == 6:
+        pod = materialize(ns_name, pod_record(read_state(), ns_name, name), now)
+        if pod is None:
+            raise not_found("pods", name)
+        return pod
+    if len(parts) == 7 and parts[6] == "log":
+        since = parse_since(query.get("sinceTime"))
+        timestamps = query.get("timestamps") in ("1", "true")
+        if query.get("follow") in ("1", "true"):
+            pod_log(read_state(), ns_name, name, now)
+            return follow_log(read_state, ns_name, name, interval, since, timestamps)
+        tail = int(query["tailLines"]) if "tailLines" in query else None
+        return pod_log(read_state(), ns_name, name, now, since, tail, timestamps)
+    raise ApiError(404, "NotFound", "the server could not find the requested resource")
@@ -0,0 +1,202 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# The subset of `helm` the benchmark scripts use: install, upgrade,
+# uninstall and template of the sse-relations chart.
+#
+# The simulator doesn't implement Go templates; `render` produces the same
+# objects as helm/sse-relations/templates/deployment.yaml.
+#
+import base64
+import gzip
+import os
+import sys
+import time
+
+import yaml
+
+from simulator import cluster
+from simulator.state import State
+
+
+# Revisions helm keeps of a release, like `helm upgrade --history-max`.
+HISTORY_MAX=10
+
+
+def parse(args):
+    options = {"positional": [], "set": []}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ("-n", "--namespace"):
+            i += 1
+            options["namespace"] = args[i]
+        elif arg == "--set":
+            i += 1
+            options["set"].append(args[i])
+        elif arg.startswith("--set="):
+            options["set"].append(arg.split("=", 1)[1])
+        elif arg.startswith("-"):
+            options.setdefault("flags", []).append(arg)
+        else:
+            options["positional"].append(arg)
+        i += 1
+    return options
+
+
+def set_value(values, assignment):
+    key, value = assignment.split("=", 1)
+    target = values
+    parts = key.split(".")
+    for part in parts[:-1]:
+        target = target.setdefault(part, {})
+    target[parts[-1]] = yaml.safe_load(value) if value else ""
+
+
+def load_values(chart, assignments):
+    with open(os.path.join(chart, "Chart.yaml")) as f:
+        name = yaml.safe_load(f)["name"]
+    if name != "sse-relations":
+        raise cluster.ApiError(400, "BadRequest", "the simulator can only render the sse-relations chart")
+    with open(os.path.join(chart, "values.yaml")) as f:
+        values = yaml.safe_load(f) or {}
+    for assignment in assignments:
+        set_value(values, assignment)
+    return values
+
+
+def consumer(name, base_url, kind="Deployment", replicas=1):
+    obj = {
+        "apiVersion": "apps/v1",
+        "kind": kind,
+        "metadata": {"name": name, "labels": {"app": name}},
+        "spec": {
+            "replicas": replicas,
+            "selector": {"matchLabels": {"app": name}},
+            "template": {
+                "metadata": {"labels": {"app": name, "base-url": base_url}},
+                "spec": {
+                    "terminationGracePeriodSeconds": 2,
+                    "containers": [{
+                        "name": name,
+                        "image": "tutum/curl",
+                        "command": ["bash", "-c"],
+                        "args": ["echo BASE_URL: $BASE_URL; /bin/sleep infinity"],
+                        "imagePullPolicy": "IfNotPresent",
+                        "envFrom": [{"configMapRef": {"name": "sse-consumer-config"}}],
+                    }],
+                },
+            },
+        },
+    }
+    if kind == "StatefulSet":
+        obj["spec"]["serviceName"] = name
+        obj["spec"]["podManagementPolicy"] = "Parallel"
+    return obj
+
+
+def render(values):
+    base_url = str(values["sseServerBaseUrl"])
+    documents = [{
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": "sse-consumer-config"},
+        "data": {"BASE_URL": base_url},
+    }]
+    topology = values.get("topology", "deployments")
+    if topology == "deployments":
+        for i in range(int(values["numConsumers"])):
+            documents.append(consumer("sse-consumer-{}".format(i), base_url))
+    else:
+        kind = "StatefulSet" if topology == "statefulset" else "Deployment"
+        documents.append(consumer("sse-consumer", base_url, kind, int(values["numConsumers"])))
+    return documents
+
+
+def manifest(documents):
+    return yaml.safe_dump_all(documents, default_flow_style=False)
+
+
+def release_secret(release, revision, text):
+    # Helm stores every revision as a gzipped, base64 encoded secret.
+    payload = base64.b64encode(gzip.compress(text.encode())).decode()
+    return {
+        "apiVersion": "v1",
+        "kind": "Secret",
+        "metadata": {
+            "name": "sh.helm.release.v1.{}.v{}".format(release, revision),
+            "labels": {"owner": "helm", "name": release, "version": str(revision)},
+        },
+        "type": "helm.sh/release.v1",
+        "data": {"release": payload},
+    }
+
+
+def releases(state, ns_name):
+    return state.data["helm"].setdefault(ns_name, {})
+
+
+def install(state, ns_name, release, documents, now, upgrade):
+    existing = releases(state, ns_name).get(release)
+    if upgrade and existing is None:
+        raise cluster.ApiError(400, "BadRequest", 'UPGRADE FAILED: "{}" has no deployed releases'.format(release))
+    if not upgrade and existing is not None:
+        raise cluster.ApiError(400, "BadRequest", "INSTALLATION FAILED: cannot re-use a name that is still in use")
+    revision = existing["revision"] + 1 if existing else 1
+    refs = [[d["kind"], d["metadata"]["name"]] for d in documents]
+    for obj in documents:
+        cluster.apply(state, ns_name, obj, now)
+    for kind, name in (existing or {}).get("objects", []):
+        if [kind, name] not in refs:
+            cluster.delete(state, ns_name, kind, name, now)
+    cluster.apply(state, ns_name, release_secret(release, revision, manifest(documents)), now)
+    if revision > HISTORY_MAX:
+        cluster.delete(state, ns_name, "Secret", "sh.helm.release.v1.{}.v{}".format(release, revision - HISTORY_MAX), now)
+    releases(state, ns_name)[release] = {"revision": revision, "objects": refs}
+    return revision
+
+
+def uninstall(state, ns_name, release, now):
+    existing = releases(state, ns_name).pop(release, None)
+    if existing is None:
+        raise cluster.ApiError(404, "NotFound", "uninstall: Release not loaded: {}: release: not found".format(release))
+    for kind, name in existing["objects"]:
+        cluster.delete(state, ns_name, kind, name, now)
+    for revision in range(max(1, existing["revision"] - HISTORY_MAX + 1), existing["revision"] + 1):
+        try:
+            cluster.delete(state, ns_name, "Secret", "sh.helm.release.v1.{}.v{}".format(release, revision), now)
+        except cluster.ApiError:
+            pass
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    command, options = args[0], parse(args[1:])
+    ns_name = options.get("namespace", "default")
+    now = time.time()
+    try:
+        if command in ("install", "upgrade", "template"):
+            release, chart = options["positional"][:2]
+            documents = render(load_values(chart, options["set"]))
+            if command == "template":
+                sys.stdout.write(manifest(documents))
+                return 0
+            with State.locked() as state:
+                cluster.collect_garbage(state, now)
+                revision = install(state, ns_name, release, documents, now, command == "upgrade")
+            print('Release "{}" has been {}. Happy Helming!'.format(
+                release, "upgraded" if command == "upgrade" else "installed"))
+            print("NAME: {}\nNAMESPACE: {}\nSTATUS: deployed\nREVISION: {}".format(release, ns_name, revision))
+        elif command == "uninstall":
+            release = options["positional"][0]
+            with State.locked() as state:
+                uninstall(state, ns_name, release, now)
+            print('release "{}" uninstalled'.format(release))
+        else:
+            print('Error: unknown command "{}" for "helm"'.format(command), file=sys.stderr)
+            return 1
+    except cluster.ApiError as e:
+        print("Error: {}".format(e.message), file=sys.stderr)
+        return 1
+    return 0
@@ -0,0 +1,243 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# The subset of `juju` the benchmark scripts use, for Kubernetes models.
+#
+# Every model is a namespace of the simulated cluster and every unit a pod
+# labelled `juju-application`. Consumers related to the endpoint print
+# `BASE_URL: <base-url>` when they start and whenever the endpoint's
+# `base-url` changes, after a sampled propagation delay.
+#
+import json
+import sys
+import time
+
+import yaml
+
+from simulator import cluster
+from simulator.state import State
+
+
+def parse(args):
+    options = {"positional": [], "flags": []}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ("-m", "--model"):
+            i += 1
+            options["model"] = args[i]
+        elif arg == "--format":
+            i += 1
+            options["format"] = args[i]
+        elif arg.startswith("--format="):
+            options["format"] = arg.split("=", 1)[1]
+        elif arg.startswith("-"):
+            options["flags"].append(arg)
+        else:
+            options["positional"].append(arg)
+        i += 1
+    return options
+
+
+class JujuError(Exception):
+    pass
+
+
+def models(state):
+    return state.data["juju"]["models"]
+
+
+def get_model(state, name):
+    model = models(state).get(name)
+    if model is None:
+        raise JujuError('model "{}" not found'.format(name))
+    return model
+
+
+def add_model(state, name, cloud, now):
+    if name in models(state):
+        raise JujuError('model "{}" already exists'.format(name))
+    models(state)[name] = {"cloud": cloud, "applications": {}, "relations": []}
+    cluster.namespace(state, name, create=True)
+
+
+def destroy_model(state, name, now):
+    get_model(state, name)
+    del models(state)[name]
+    cluster.delete_namespace(state, name, now)
+
+
+def add_application(state, model_name, app, charm, scale, options, created):
+    model = get_model(state, model_name)
+    existing = model["applications"].get(app)
+    if existing is not None and existing["removed"] is None:
+        # Bundles reuse applications that already exist.
+        return
+    application = {"charm": charm, "options": dict(options or {}), "units": {}, "removed": None}
+    model["applications"][app] = application
+    for i in range(scale):
+        unit = "{}/{}".format(app, i)
+        pod_name = "{}-{}".format(app, i)
+        pod_created = created + state.sample("controller")
+        started = pod_created + state.sample("schedule") + state.sample("startup")
+        cluster.add_pod(state, model_name, pod_name, {"juju-application": app},
+                        ["juju", app], pod_created, started)
+        application["units"][unit] = {
+            "pod": pod_name,
+            "created": created,
+            "started": started,
+            "active": started + state.sample("hook"),
+            "busy": [],
+        }
+
+
+def unit_log(state, model_name, unit, at, line):
+    record = cluster.pod_record(state, model_name, unit["pod"])
+    record["logs"].append([at, line])
+    record["logs"].sort(key=lambda entry: entry[0])
+
+
+def consumers_of(model, app):
+    result = []
+    for relation in model["relations"]:
+        ends = [end.split(":")[0] for end in relation]
+        if app in ends:
+            result.extend(end for end in ends if end != app)
+    return result
+
+
+def add_relation(state, model_name, relation):
+    model = get_model(state, model_name)
+    if relation in model["relations"]:
+        return
+    model["relations"].append(relation)
+    provider, consumer = [end.split(":")[0] for end in relation]
+    base_url = model["applications"][provider]["options"].get("base-url")
+    for unit in model["applications"][consumer]["units"].values():
+        unit_log(state, model_name, unit, unit["active"], "BASE_URL: {}".format(base_url))
+
+
+def deploy(state, model_name, source, app_name, now):
+    model = get_model(state, model_name)
+    if not source.endswith(".yaml"):
+        add_application(state, model_name, app_name or source.rstrip("/").split("/")[-1], source, 1, {},
+                        now + state.sample("hook"))
+        return
+    with open(source) as f:
+        bundle = yaml.safe_load(f)
+    # The controller deploys the applications of a bundle one by one.
+    created = now
+    for app, spec in bundle.get("applications", {}).items():
+        created = created + state.sample("hook") / 2
+        add_application(state, model_name, app, spec["charm"], spec.get("scale", 1),
+                        spec.get("options"), created)
+    for relation in bundle.get("relations") or []:
+        add_relation(state, model_name, relation)
+
+
+def set_config(state, model_name, app, assignments, now):
+    model = get_model(state, model_name)
+    application = model["applications"][app]
+    for assignment in assignments:
+        key, value = assignment.split("=", 1)
+        application["options"][key] = value
+        if key != "base-url":
+            continue
+        for consumer in consumers_of(model, app):
+            for unit in model["applications"][consumer]["units"].values():
+                if unit["active"] > now:
+                    # Not running yet, it picks up the new value when it starts.
+                    unit_log(state, model_name, unit, unit["active"], "BASE_URL: {}".format(value))
+                    continue
+                seen = now + state.sample("propagation")
+                unit_log(state, model_name, unit, seen, "BASE_URL: {}".format(value))
+                unit["busy"].append([now, seen + state.sample("hook")])
+
+
+def remove_application(state, model_name, app, now):
+    model = get_model(state, model_name)
+    application = model["applications"].get(app)
+    if application is None:
+        raise JujuError('application "{}" not found'.format(app))
+    application["removed"] = now
+    for unit in application["units"].values():
+        cluster.delete_pod(state, cluster.pod_record(state, model_name, unit["pod"]), now + state.sample("controller"))
+    model["relations"] = [r for r in model["relations"] if app not in [e.split(":")[0] for e in r]]
+
+
+def unit_status(unit, t):
+    if t < unit["started"]:
+        return ("waiting", "waiting for container"), "allocating"
+    if t < unit["active"]:
+        return ("maintenance", "installing charm software"), "executing"
+    if any(start <= t < end for start, end in unit["busy"]):
+        return ("maintenance", "configuring"), "executing"
+    return ("active", "ready"), "idle"
+
+
+def status(state, model_name, now):
+    model = get_model(state, model_name)
+    ns = state.data["namespaces"].get(model_name, {"pods": {}})
+    applications = {}
+    for app, application in model["applications"].items():
+        units = {}
+        for name, unit in application["units"].items():
+            record = ns["pods"].get(unit["pod"])
+            if application["removed"] is not None and (record is None or cluster.materialize(model_name, record, now) is None):
+                continue
+            (workload, message), agent = unit_status(unit, now)
+            units[name] = {
+                "workload-status": {"current": workload, "message": message},
+                "juju-status": {"current": agent},
+            }
+        if application["removed"] is not None and not units:
+            continue
+        applications[app] = {
+            "charm": application["charm"],
+            "scale": len(application["units"]),
+            "units": units,
+        }
+    return {
+        "model": {"name": model_name, "type": "caas", "cloud": model["cloud"]},
+        "machines": {},
+        "applications": applications,
+    }
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    command, options = args[0], parse(args[1:])
+    positional = options["positional"]
+    now = time.time()
+    try:
+        if command == "status":
+            result = status(State.read(), options["model"], now)
+            if options.get("format") == "json":
+                print(json.dumps(result))
+            else:
+                print(yaml.safe_dump(result, default_flow_style=False))
+            return 0
+        with State.locked() as state:
+            cluster.collect_garbage(state, now)
+            if command == "add-model":
+                add_model(state, positional[0], positional[1] if len(positional) > 1 else None, now)
+            elif command == "destroy-model":
+                destroy_model(state, positional[0], now)
+            elif command == "deploy":
+                deploy(state, options["model"], positional[0], positional[1] if len(positional) > 1 else None, now)
+            elif command == "config":
+                set_config(state, options["model"], positional[0], positional[1:], now)
+            elif command in ("add-relation", "relate"):
+                add_relation(state, options["model"], positional[:2])
+            elif command == "remove-application":
+                for app in positional:
+                    remove_application(state, options["model"], app, now)
+            elif command == "remove-machine":
+                raise JujuError("machine {} not found".format(positional[0]))
+            else:
+                raise JujuError('unrecognized command: juju {}'.format(command))
+    except JujuError as e:
+        print("ERROR {}".format(e), file=sys.stderr)
+        return 1
+    return 0
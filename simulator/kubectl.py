@@ -0,0 +1,245 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# The subset of `kubectl` the benchmark scripts use.
+#
+import json
+import sys
+import time
+
+import yaml
+
+from simulator import cluster
+from simulator.state import State, load_config
+
+
+VERBS = ("get", "logs", "apply", "delete", "create", "patch", "version")
+# Flags that take a value. `-f` means --follow for `logs`.
+VALUE_FLAGS = {
+    "-n": "namespace", "--namespace": "namespace",
+    "-o": "output", "--output": "output",
+    "-l": "selector", "--selector": "selector",
+    "-f": "filename", "--filename": "filename",
+    "-p": "patch", "--patch": "patch",
+    "-c": "container", "--container": "container",
+    "--raw": "raw",
+    "--since-time": "since_time",
+    "--tail": "tail",
+    "--field-selector": "field_selector",
+    "--type": "type",
+    "--chunk-size": "chunk_size",
+    "--request-timeout": "request_timeout",
+    "--field-manager": "field_manager",
+}
+BOOL_FLAGS = {
+    "--follow": "follow",
+    "--prefix": "prefix",
+    "--timestamps": "timestamps",
+    "--ignore-not-found": "ignore_not_found",
+    "--all": "all",
+    "--server-side": "server_side",
+    "--force-conflicts": "force_conflicts",
+    "--wait": "wait",
+}
+
+
+def parse(args):
+    options = {"positional": []}
+    verb = None
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        flag, _, inline = arg.partition("=") if arg.startswith("--") else (arg, None, None)
+        if verb == "logs" and arg == "-f":
+            options["follow"] = True
+        elif flag in BOOL_FLAGS:
+            options[BOOL_FLAGS[flag]] = inline not in ("false", "0")
+        elif flag in VALUE_FLAGS:
+            if inline:
+                options[VALUE_FLAGS[flag]] = inline
+            else:
+                i += 1
+                options[VALUE_FLAGS[flag]] = args[i]
+        elif arg.startswith("-"):
+            pass
+        elif verb is None and arg in VERBS:
+            verb = arg
+        else:
+            options["positional"].append(arg)
+        i += 1
+    return verb, options
+
+
+def load_documents(filename):
+    if filename == "-":
+        text = sys.stdin.read()
+    else:
+        with open(filename) as f:
+            text = f.read()
+    documents = []
+    for doc in yaml.safe_load_all(text):
+        if not doc:
+            continue
+        if doc.get("kind") == "List":
+            documents.extend(doc["items"])
+        else:
+            documents.append(doc)
+    return documents
+
+
+def object_ref(obj):
+    kind = obj["kind"].lower()
+    if obj["kind"] in cluster.CONTROLLERS:
+        kind = kind + ".apps"
+    return "{}/{}".format(kind, obj["metadata"]["name"])
+
+
+def stream(lines):
+    try:
+        for line in lines:
+            sys.stdout.write(line if line.endswith("\n") else line + "\n")
+            sys.stdout.flush()
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+
+
+def cmd_get(state_reader, options, now, interval):
+    if "raw" in options:
+        result = cluster.handle_get(state_reader, options["raw"], now, interval)
+        if isinstance(result, dict):
+            print(json.dumps(result))
+        elif isinstance(result, str):
+            sys.stdout.write(result)
+        else:
+            stream(result)
+        return
+    positional = options["positional"]
+    if not positional or positional[0] not in ("pods", "pod", "po"):
+        raise cluster.ApiError(400, "BadRequest", "the simulator only serves pods")
+    ns_name = options.get("namespace", "default")
+    if len(positional) > 1:
+        pods = [cluster.handle_get(state_reader, "/api/v1/namespaces/{}/pods/{}".format(ns_name, positional[1]),
+                                   now, interval)]
+        output = pods[0]
+    else:
+        pods = cluster.pods_at(state_reader(), ns_name, now, options.get("selector"), options.get("field_selector"))
+        output = {"kind": "List", "apiVersion": "v1", "metadata": {"resourceVersion": ""}, "items": pods}
+    if options.get("output") == "json":
+        print(json.dumps(output, indent=4))
+    elif options.get("output") == "name":
+        for pod in pods:
+            print("pod/{}".format(pod["metadata"]["name"]))
+    else:
+        print("NAME{}STATUS".format(" " * 40))
+        for pod in pods:
+            print("{:<44}{}".format(pod["metadata"]["name"], pod["status"]["phase"]))
+
+
+def cmd_logs(state_reader, options, now, interval):
+    ns_name = options.get("namespace", "default")
+    since = cluster.parse_since(options.get("since_time"))
+    tail = int(options["tail"]) if "tail" in options else None
+    if options.get("selector"):
+        # Like kubectl, only the last 10 lines of every pod unless told otherwise.
+        pods = cluster.pods_at(state_reader(), ns_name, now, options["selector"])
+        for pod in pods:
+            name = pod["metadata"]["name"]
+            try:
+                output = cluster.pod_log(state_reader(), ns_name, name, now, since, 10 if tail is None else tail)
+            except cluster.ApiError:
+                continue
+            if options.get("prefix"):
+                output = "".join("[pod/{}/{}] {}\n".format(name, pod["spec"]["containers"][0]["name"], line)
+                                 for line in output.splitlines())
+            sys.stdout.write(output)
+        return
+    name = options["positional"][0].split("/")[-1]
+    if options.get("follow"):
+        cluster.pod_log(state_reader(), ns_name, name, now)
+        stream(cluster.follow_log(state_reader, ns_name, name, interval, since, options.get("timestamps")))
+        return
+    sys.stdout.write(cluster.pod_log(state_reader(), ns_name, name, now, since, tail, options.get("timestamps")))
+
+
+def cmd_apply(options, now):
+    ns_name = options.get("namespace", "default")
+    documents = load_documents(options["filename"])
+    with State.locked() as state:
+        cluster.collect_garbage(state, now)
+        for obj in documents:
+            result = cluster.apply(state, obj["metadata"].get("namespace", ns_name), obj, now)
+            print("{} {}".format(object_ref(obj), result))
+
+
+def cmd_delete(options, now):
+    ns_name = options.get("namespace", "default")
+    positional = options["positional"]
+    with State.locked() as state:
+        cluster.collect_garbage(state, now)
+        if positional and positional[0] in ("namespace", "ns"):
+            for name in positional[1:]:
+                cluster.delete_namespace(state, name, now)
+                print('namespace "{}" deleted'.format(name))
+            return
+        for obj in load_documents(options["filename"]):
+            try:
+                cluster.delete(state, obj["metadata"].get("namespace", ns_name),
+                               obj["kind"], obj["metadata"]["name"], now)
+                print('{} "{}" deleted'.format(cluster.resource_name(obj["kind"]), obj["metadata"]["name"]))
+            except cluster.ApiError:
+                if not options.get("ignore_not_found"):
+                    raise
+
+
+def cmd_patch(options, now):
+    ns_name = options.get("namespace", "default")
+    positional = options["positional"]
+    resource, name = positional[0].split("/", 1) if "/" in positional[0] else positional[:2]
+    if options.get("type", "strategic") not in ("strategic", "merge"):
+        raise cluster.ApiError(400, "BadRequest", "the simulator only supports strategic and merge patches")
+    kind = cluster.kind_of(resource)
+    with State.locked() as state:
+        cluster.collect_garbage(state, now)
+        result = cluster.patch(state, ns_name, kind, name, json.loads(options["patch"]), now)
+    print("{} {}".format(object_ref({"kind": kind, "metadata": {"name": name}}),
+                         "patched (no change)" if result == "unchanged" else "patched"))
+
+
+def cmd_create(options, now):
+    positional = options["positional"]
+    if positional[:1] not in (["namespace"], ["ns"]):
+        raise cluster.ApiError(400, "BadRequest", "the simulator can only create namespaces")
+    with State.locked() as state:
+        cluster.collect_garbage(state, now)
+        cluster.create_namespace(state, positional[1])
+    print("namespace/{} created".format(positional[1]))
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    verb, options = parse(args)
+    now = time.time()
+    interval = load_config()["watch_interval"]
+    try:
+        if verb == "get":
+            cmd_get(lambda: State.read(), options, now, interval)
+        elif verb == "logs":
+            cmd_logs(lambda: State.read(), options, now, interval)
+        elif verb == "apply":
+            cmd_apply(options, now)
+        elif verb == "delete":
+            cmd_delete(options, now)
+        elif verb == "create":
+            cmd_create(options, now)
+        elif verb == "patch":
+            cmd_patch(options, now)
+        elif verb == "version":
+            print("Client Version: simulator\nServer Version: simulator")
+        else:
+            print('error: unknown command "{}" for "kubectl"'.format(verb), file=sys.stderr)
+            return 1
+    except cluster.ApiError as e:
+        print("Error from server ({}): {}".format(e.reason, e.message), file=sys.stderr)
+        return 1
+    return 0
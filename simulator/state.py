@@ -0,0 +1,150 @@
+#
+# Copyright © 2019 Ghent University and imec.
+# License is described in `LICENSE` file.
+#
+# Persistent state of the simulated cluster.
+#
+# Every `kubectl`, `helm` and `juju` call is a separate process, so the state
+# lives in a JSON file in SIMULATOR_STATE. Writers hold an exclusive lock and
+# replace the file atomically, readers just load the latest version.
+#
+# Nothing in the simulator runs in the background. When an object changes,
+# the simulator samples when everything that follows from it will happen
+# (pod scheduled, started, removed, ...) and stores those timestamps. Every
+# read then shows the cluster as it is at that moment.
+#
+import calendar
+import copy
+import fcntl
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from contextlib import contextmanager
+
+
+STATE_DIR = os.environ.get(
+    "SIMULATOR_STATE", os.path.join(tempfile.gettempdir(), "k8s-relations-simulator"))
+
+# Latencies in seconds. Every entry is a distribution, see `sample`.
+DEFAULT_CONFIG = {
+    "seed": None,
+    "latency": {
+        # Controller reacting to a changed object.
+        "controller": {"dist": "uniform", "low": 0.05, "high": 0.2},
+        # Pod created until scheduled on a node.
+        "schedule": {"dist": "exponential", "mean": 0.3},
+        # Init containers of a pod, if it has any.
+        "init": {"dist": "lognormal", "median": 2.0, "sigma": 0.3},
+        # Pod scheduled (and initialized) until its containers run.
+        "startup": {"dist": "lognormal", "median": 1.5, "sigma": 0.4},
+        # Deletion requested until the pod is gone.
+        "termination": {"dist": "uniform", "low": 2.0, "high": 3.0},
+        # Changed relation data until a consumer sees it (orcon, Juju).
+        "propagation": {"dist": "lognormal", "median": 5.0, "sigma": 0.5},
+        # Changed ConfigMap until the kubelet updates the files of the pods
+        # that mount it: up to its sync period plus the cache TTL.
+        "volume_sync": {"dist": "uniform", "low": 1.0, "high": 60.0},
+        # Juju hook execution after a unit starts or its relation changes.
+        "hook": {"dist": "uniform", "low": 1.0, "high": 4.0},
+    },
+    # Seconds between two checks of a `watch` or `logs -f` stream.
+    "watch_interval": 0.05,
+    # Nodes the API lists. Pods aren't placed on them.
+    "nodes": [
+        {"name": "sim-node-{}".format(i), "cpu": "4", "memory": "16Gi"} for i in range(3)
+    ],
+}
+
+
+def load_config():
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    path = os.environ.get("SIMULATOR_CONFIG")
+    if path:
+        with open(path) as f:
+            custom = json.load(f)
+        config["latency"].update(custom.pop("latency", {}))
+        config.update(custom)
+    return config
+
+
+def empty_state():
+    return {
+        "samples": 0,
+        "counter": 0,
+        "namespaces": {},
+        "helm": {},
+        "juju": {"models": {}},
+    }
+
+
+class State(object):
+    def __init__(self, data, config=None):
+        self.data = data
+        self.config = config or load_config()
+
+    @staticmethod
+    def path():
+        return os.path.join(STATE_DIR, "state.json")
+
+    @classmethod
+    def read(cls):
+        try:
+            with open(cls.path()) as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            return cls(empty_state())
+
+    @classmethod
+    @contextmanager
+    def locked(cls):
+        """Load the state for modification and save it when the block exits
+        without an exception."""
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(os.path.join(STATE_DIR, "state.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = cls.read()
+            yield state
+            fd, tmp = tempfile.mkstemp(dir=STATE_DIR)
+            with os.fdopen(fd, "w") as f:
+                json.dump(state.data, f)
+            os.replace(tmp, cls.path())
+
+    def sample(self, name):
+        """Sample a latency from the configured distribution `name`."""
+        spec = self.config["latency"][name]
+        seed = self.config.get("seed")
+        rng = random.Random("{}-{}".format(seed, self.data["samples"])) if seed is not None else random
+        self.data["samples"] += 1
+        dist = spec.get("dist", "constant")
+        if dist == "constant":
+            return spec["value"]
+        if dist == "uniform":
+            return rng.uniform(spec["low"], spec["high"])
+        if dist == "exponential":
+            return rng.expovariate(1.0 / spec["mean"]) if spec["mean"] else 0.0
+        if dist == "normal":
+            return max(0.0, rng.gauss(spec["mean"], spec["stddev"]))
+        if dist == "lognormal":
+            return rng.lognormvariate(math.log(spec["median"]), spec["sigma"])
+        raise ValueError("Unknown distribution {}".format(dist))
+
+    def unique(self):
+        self.data["counter"] += 1
+        return self.data["counter"]
+
+
+def rfc3339(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+def rfc3339_nano(timestamp):
+    """`timestamp` like the kubelet prefixes log lines with."""
+    return "{}.{:09d}Z".format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)),
+                               int(round(timestamp % 1 * 1e9)) % 1000000000)
+
+
+def parse_rfc3339(value):
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))